@@ -1,180 +1,292 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, ForeignKey, DateTime
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import func
+from typing import List, Optional
 from datetime import datetime
-import re  # For regular expressions
-import os
+from sqlalchemy import select, func
 import logging
-from utils.table_hierarchy import find_relationships,find_bottom_most_level
+from utils.schema_registry import registry
+from utils.templating import compile_template, TemplateError
+from utils.fanout import fan_out, fan_out_page
+from utils.hierarchy_targets import level_table_name, target_users_query, targets_exist, save_targets
+from utils.jobs import job_queue, complete_in
+from utils.campaign_stats import record_sent, add_sent
+from utils.campaign_scheduler import schedule_campaign, load_campaign, load_campaigns, cancel_campaign
+from utils.push import push_hub
+from utils.http_cache import response_cache
+from utils.template_store import template_store, template_usage
 
 # Initialize FastAPI Router
 router = APIRouter()
 
-# Database setup
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mydatabase")
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)  # Correct sessionmaker setup
-metadata = MetaData()
-
-
-metadata.reflect(bind=engine)
+# Database setup (shared engine and pool)
+from utils.database import run_db
 
 
 # Define Pydantic model for input data
+# Target: `btm_lvl` (one bottom-most node), or `targets` at any `target_level`
+# (e.g. target_level="Region", targets=["North", "South"]); default level is the bottom-most.
+# With `template_id`, the name, title and content default to the saved template's and the
+# send counts as one use of it.
+# With `send_at` (a future time) and/or `rate` (max messages per second) the campaign is
+# scheduled instead, see utils/campaign_scheduler.py.
 class ReferenceDataInput(BaseModel):
-    template_name: str
-    message_title: str
-    message_content: str
-    btm_lvl: str
+    template_id: Optional[int] = None
+    template_name: Optional[str] = None
+    message_title: Optional[str] = None
+    message_content: Optional[str] = None
+    btm_lvl: Optional[str] = None
+    target_level: Optional[str] = None
+    targets: Optional[List[str]] = None
     user_count: int
+    send_at: Optional[datetime] = None
+    rate: Optional[float] = None
 
-# Endpoint to save reference data and create `exp_message`
+# Endpoint to save reference data and create `exp_message`.
+# The send runs in the background; poll GET /api/v1/jobs/{job_id} for its progress, or
+# GET /api/v1/expMessages/scheduled/{campaign_id} for a scheduled campaign.
 @router.post("/")
 async def expMessage(data: ReferenceDataInput):
-    session = Session()  # Correct session creation
-    relationships = find_relationships(engine)
-    bottom_most = find_bottom_most_level(relationships)
-    bottom_most_name = bottom_most[4:]  # Removing 'lvl_' prefix
-    bottom_most_name_with_suffix = f"{bottom_most_name}_name"
-    try:
-
+    if data.template_id is None:
+        missing = [field for field in TEMPLATE_FIELDS if not getattr(data, field)]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Missing {', '.join(missing)} (or a template_id)")
+    if data.rate is not None and data.rate <= 0:
+        raise HTTPException(status_code=400, detail="rate must be a positive number of messages per second")
+
+    if data.send_at is not None or data.rate is not None:
+        campaign = await run_db(schedule_send, data)
+        return {
+            "message": "Campaign scheduled",
+            "campaign_id": campaign["id"],
+            "status": campaign["status"],
+            "send_at": campaign["send_at"],
+            "rate": campaign["rate"],
+        }
 
-        # Create tables if they don't exist
-        logging.debug(f'bmn: {bottom_most_name_with_suffix}')
-        reference_table = Table(
-            "reference_table",
-            metadata,
-            Column("id", Integer, primary_key=True, autoincrement=True),
-            Column("template_name", String, nullable=False),
-            Column("message_title", String, nullable=False),
-            Column("message_content", String, nullable=False),
-            Column(bottom_most_name_with_suffix, String, nullable=False),  # Correct column name
-            Column("user_count", Integer, nullable=False),
-            extend_existing=True
-        )
+    job = await job_queue.submit("message-send", data.model_dump(mode="json", exclude={"send_at", "rate"}))
+    return {
+        "message": "Message send queued",
+        "job_id": job.id,
+        "status": job.status,
+    }
+
+
+# Runs queued sends, in this worker or in another one after a restart (see utils/jobs.py)
+async def run_send_job(job, payload: dict):
+    return await run_db(send_messages, ReferenceDataInput(**payload), job)
+
+
+job_queue.register("message-send", run_send_job)
+
+
+def schedule_send(session, data: ReferenceDataInput) -> dict:
+    # Checked now, so a bad template or target is the caller's 4xx rather than a failed
+    # campaign later. The payload keeps the template's name, title and content as they
+    # are now: editing the template afterwards doesn't change the scheduled send.
+    plan = prepare_send(session, data)
+    payload = plan.data.model_dump(mode="json", exclude={"send_at", "rate"})
+    return schedule_campaign(session, payload, data.send_at, data.rate)
+
+
+TEMPLATE_FIELDS = ("template_name", "message_title", "message_content")
+
+
+def apply_template(session, data: ReferenceDataInput) -> ReferenceDataInput:
+    # Fill the fields left out from the saved template (cached rows)
+    if data.template_id is None:
+        return data
+    template = template_store.get(session, data.template_id)
+    if template is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return data.model_copy(update={field: getattr(data, field) or template[field] for field in TEMPLATE_FIELDS})
+
+
+class SendPlan:
+    # A send resolved once: tables, targets, compiled template and the recipients query
+    def __init__(self, data: ReferenceDataInput, schema, level_table: str, names: List[str], template):
+        self.data = data
+        self.schema = schema
+        self.level_table = level_table
+        self.names = names
+        self.target_label = ", ".join(names)
+        self.template = template
+        self.users_query = target_users_query(schema, level_table, names)
+        self.reference_id = None
+        self.total = None
+
+
+def prepare_send(session, data: ReferenceDataInput, template_applied: bool = False) -> SendPlan:
+    # `template_applied`: the fields were copied from the template already (scheduled payload)
+    if not template_applied:
+        data = apply_template(session, data)
+    # The message tables are created with the hierarchy (utils/message_tables.py), never here
+    schema = registry.snapshot(session)
+    if not (schema.has_table("reference_table") and schema.has_table("exp_message")):
+        schema = registry.load(session)  # Created by another worker since our last check
+    if schema.bottom_most is None:
+        raise HTTPException(status_code=400, detail="No hierarchy uploaded yet")
+    if not (schema.has_table("reference_table") and schema.has_table("exp_message")):
+        raise HTTPException(status_code=503, detail="Message tables are not set up yet, retry shortly")
+    bottom_most = schema.bottom_most
+
+    # Resolve the targets (any level) to their bottom-most descendants
+    level_table = level_table_name(data.target_level) if data.target_level else bottom_most
+    names = data.targets or ([data.btm_lvl] if data.btm_lvl else [])
+    if not names:
+        raise HTTPException(status_code=400, detail="Either 'btm_lvl' or 'targets' is required")
 
-        exp_message = Table(
-            "exp_message",
-            metadata,
-            Column("id", Integer, primary_key=True, autoincrement=True),
-            Column("user_id", Integer, nullable=False),  # This should be set to the relevant user ID
-            Column("channel", String, nullable=False),
-            Column("msg_title", String, nullable=False),
-            Column("msg_content", String, nullable=False),
-            Column("reference_id", Integer, ForeignKey("reference_table.id"), nullable=False),  # Reference to ReferenceTable
-            Column("sent_time", DateTime, server_default=func.now()),  # Time when sent
-            Column("msg_read_time", DateTime, nullable=True),  # Time when read
-            Column("read_status", String, default="unread"),  # Default to "unread"
-            extend_existing=True
+    try:
+        template = compile_template(data.message_content, data.template_id)  # Parsed once for all users, cached
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not targets_exist(session, schema, level_table, names):
+        raise HTTPException(status_code=404, detail=f"No {level_table[4:]} found with name '{', '.join(names)}'")
+
+    return SendPlan(data, schema, level_table, names, template)
+
+
+def insert_reference(session, plan: SendPlan) -> int:
+    # Insert into `reference_table` (committed together with the messages)
+    reference_table = plan.schema.table("reference_table")  # Ensure correct table reference
+    values = {
+        "template_name": plan.data.template_name,
+        "message_title": plan.data.message_title,
+        "message_content": plan.data.message_content,
+        f"{plan.schema.bottom_most_name}_name": plan.target_label,  # Correct key
+        "user_count": plan.data.user_count,
+    }
+    # A plain btm_lvl send keeps target_level NULL; otherwise the names are also stored one
+    # per row, since the joined label cannot be split back safely
+    targeted = bool(plan.data.targets or plan.data.target_level)
+    if targeted and "target_level" in reference_table.c:  # Tables created before targeting lack it
+        values["target_level"] = plan.level_table[4:]
+    reference_id = session.execute(reference_table.insert().values(**values)).inserted_primary_key[0]
+    if targeted:
+        save_targets(session, reference_id, plan.names)
+    return reference_id
+
+
+def send_messages(session, data: ReferenceDataInput, job=None):
+    try:
+        plan = prepare_send(session, data)
+        data = plan.data
+        reference_id = insert_reference(session, plan)
+
+        # Stream users below every target (one joined query) and write messages in batches
+        stats = fan_out(
+            session,
+            plan.users_query,
+            plan.schema.table("exp_message"),
+            plan.template,
+            reference_id,
+            data.message_title,
+            on_batch=job.progress if job else None,
         )
 
-        # Create all tables in the database
-        metadata.create_all(engine)
-
-        
-        metadata.reflect(bind=engine)
-        # Insert into `reference_table`
-        reference_table = Table("reference_table", metadata, autoload_with=engine)  # Ensure correct table reference
-        ins = reference_table.insert().values(
-        template_name=data.template_name,
-        message_title=data.message_title,
-        message_content=data.message_content,
-        **{bottom_most_name_with_suffix: data.btm_lvl},  # Correct key
-        user_count=data.user_count
-    )
-
-        result = session.execute(ins)  # Execute with the session
-        session.commit()  # Commit the `reference_table` insertion
-        
-        reference_id = result.inserted_primary_key[0]  # Get the auto-generated ID
-
-        # Find branch_id from branch name
-        btm_lvl_table = Table(bottom_most, metadata, autoload_with=engine)
-        btm = session.execute(
-            btm_lvl_table.select().where(btm_lvl_table.c.name == data.btm_lvl)
-        ).fetchone()
-
-        logging.debug(f'btm fetch one: {btm}')
-
-        if not btm:
-            raise HTTPException(status_code=404, detail=f"No branch found with name '{data.btm_lvl}'")
-
-        btm_id = btm.id  # Get the branch ID
-        logging.debug(f'btm id fetch one: {btm_id}')
-        user_btm_lvl=f'{bottom_most_name}_id'
-        logging.debug(f'user_btm_lvl: {user_btm_lvl}')
-
-        # Fetch users based on branch_id
-        users_table = Table("users", metadata, autoload_with=engine)
-        logging.debug(f'users_table: {users_table}')
-        users = session.execute(
-            users_table.select().where(getattr(users_table.c, user_btm_lvl) == btm_id) # Fetch users with correct branch_id
-        ).fetchall()
-        logging.debug(f'users: {users}')
-        if not users:
-            raise HTTPException(status_code=404, detail=f"No users found for branch '{data.btm_lvl}'")
-
-        # Get variable names from message content
-        variable_pattern = re.compile(r"\{\{([a-zA-Z_]+)\}\}")  # Regex to find variables
-        variables = variable_pattern.findall(data.message_content)
-        logging.debug(f'variables: {variables}')
-
-        # Create `exp_message` list with personalized content
-        exp_messages = []
-        for user in users:
-            personalized_content = data.message_content
-
-            # Replace variables with user attributes
-            for var in variables:
-                logging.debug(f'var: {var}')
-                user_attr = getattr(user, var, None)  # Get user attribute
-                logging.debug(f'user_attr: {user_attr}')
-
-                if user_attr:
-                    personalized_content = re.sub(
-                        f"\{{{{{var}}}}}", str(user_attr), personalized_content
-                    )
-                    logging.debug(f'personalized_content: {personalized_content}')
-
-            exp_messages.append(
-                {
-                    "user_id": user.id,
-                    "channel": "webhooks",  # Or appropriate communication channel
-                    "reference_id": reference_id,
-                    "sent_time": datetime.now(),
-                    "read_status": "unread",
-                    "msg_title":data.message_title,
-                    "msg_content": personalized_content,
-                }
-            )
-
-        # Insert all `exp_message` into the database
-        exp_message_table = Table("exp_message", metadata, autoload_with=engine)  # Ensure correct table reference
-        session.execute(exp_message_table.insert(), exp_messages)  # Use a list of dictionaries
-        session.commit()  # Commit all exp_messages
+        if not stats.recipients:
+            raise HTTPException(status_code=404, detail=f"No users found for {plan.level_table[4:]} '{plan.target_label}'")
 
-        return {
+        record_sent(session, reference_id, stats.recipients, stats.sent_time)
+        result = {
             "message": "Reference data and exp_messages created successfully",
-            "exp_message_count": len(exp_messages),
+            "reference_id": reference_id,
+            "exp_message_count": stats.recipients,
+            "stats": stats.to_dict(),
         }
+        if job is not None:
+            complete_in(session, job, result)  # A rerun after this commit is a no-op
 
+        session.commit()  # Commit the reference row and all exp_messages
+
+    except HTTPException:
+        session.rollback()
+        raise
     except Exception as e:
         session.rollback()  # Rollback on error
         raise HTTPException(status_code=500, detail=f"Error creating reference data and exp_messages: {str(e)}")
 
-    finally:
-        session.close()  # Ensure session is closed
-
-
+    # Committed: nothing below may report the send as failed (clients would resend it)
+    after_send(session, reference_id, data.template_id)
+    logging.info(f'fan-out for reference {reference_id}: {stats.to_dict()}')
+    return result
 
 
+def after_send(session, reference_id: int, template_id: Optional[int] = None, user_range: Optional[tuple] = None):
+    # Side effects of a committed send; failures are logged, the messages are delivered anyway
+    try:
+        response_cache.invalidate("campaigns", "inboxes")
+        if template_id is not None:
+            template_usage.add(template_id)  # Written in the next batched flush
+        push_hub.notify_sent(session, reference_id, user_range)  # Deliver to connected users
+    except Exception:
+        logging.exception(f'post-send steps for reference {reference_id} failed')
+
+
+class ScheduledSend:
+    # The send steps of a scheduled campaign, run page by page by utils/campaign_scheduler.py
+
+    def prepare(self, session, payload: dict, reference_id: Optional[int]) -> SendPlan:
+        # On the first claim the reference row (and its stats row) is written; the
+        # scheduler commits it together with the campaign.
+        # The payload holds the template's fields as they were when scheduled (campaigns
+        # scheduled before that was the case only have the template_id)
+        data = ReferenceDataInput(**payload)
+        plan = prepare_send(session, data, template_applied=all(getattr(data, field) for field in TEMPLATE_FIELDS))
+        if reference_id is not None:
+            plan.reference_id = reference_id
+            return plan
+
+        plan.total = session.execute(
+            select(func.count()).select_from(plan.users_query.order_by(None).subquery())
+        ).scalar()
+        if not plan.total:
+            raise HTTPException(status_code=404, detail=f"No users found for {plan.level_table[4:]} '{plan.target_label}'")
+        plan.reference_id = insert_reference(session, plan)
+        record_sent(session, plan.reference_id, 0, datetime.now())
+        return plan
+
+    def write_page(self, session, plan: SendPlan, after_user_id: int, limit: int):
+        # Not committed: the scheduler commits the page with the campaign's progress
+        count, last_user_id, _ = fan_out_page(
+            session,
+            plan.users_query,
+            plan.schema.table("exp_message"),
+            plan.template,
+            plan.reference_id,
+            plan.data.message_title,
+            after_user_id,
+            limit,
+        )
+        if count:
+            add_sent(session, plan.reference_id, count)
+        return count, last_user_id
 
+    def page_sent(self, session, plan: SendPlan, after_user_id: int, last_user_id: int):
+        after_send(session, plan.reference_id, user_range=(after_user_id, last_user_id))
 
+    def finished(self, session, plan: SendPlan):
+        if plan.data.template_id is not None:
+            template_usage.add(plan.data.template_id)
 
 
+# Scheduled campaigns (POST with `send_at` / `rate`): progress, newest first
+@router.get("/scheduled")
+async def list_scheduled(
+    status: Optional[str] = Query(default=None, pattern="^(scheduled|running|completed|failed|cancelled)$"),
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: Optional[str] = None,
+):
+    return await run_db(load_campaigns, status, limit, cursor)
 
 
+# One scheduled campaign: status, sent_count / total, progress (%), eta_seconds
+@router.get("/scheduled/{campaign_id}")
+async def get_scheduled(campaign_id: int):
+    return await run_db(load_campaign, campaign_id)
 
 
+# Cancel a scheduled campaign; a running one stops after its current page
+@router.post("/scheduled/{campaign_id}/cancel")
+async def cancel_scheduled(campaign_id: int):
+    return await run_db(cancel_campaign, campaign_id)
@@ -1,11 +1,19 @@
-from fastapi import APIRouter, HTTPException,Query
+from fastapi import APIRouter, HTTPException,Query, Request
 from pydantic import BaseModel
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, ForeignKey,text,select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey, UniqueConstraint, select, bindparam
 from sqlalchemy.exc import SQLAlchemyError
-from typing import List, Dict
-import logging
+from typing import List, Dict, Optional
 import os
+import threading
+from utils.schema_registry import registry
+from utils.hierarchy_loader import HierarchyLoader
+from utils.hierarchy_closure import add_nodes, descendant_ids, ancestors_query
+from utils.hierarchy_targets import level_table_name
+from utils.message_tables import ensure_message_tables
+from utils.hierarchy_tree import hierarchy_tree, json_payload
+from utils.http_cache import etag_response
+from utils.upload_stream import iter_rows, batched
+from utils.jobs import jobs
 
 # FILTER BASED on FILTER TYPE AND VALUE.. INNER JOIN...
 # SELECT
@@ -22,13 +30,8 @@ import os
 #     r.name = 'North America';
 
 
-logging.basicConfig(level=logging.DEBUG)
-
-# Database URL from environment variable
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mydatabase")
-
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+# Shared database access (async engine, or sync engine in a thread pool)
+from utils.database import run_db
 
 # FastAPI router
 router = APIRouter()
@@ -39,7 +42,7 @@ class HierarchicalInput(BaseModel):
     data: List[Dict[str, str]]  # List of dictionaries with hierarchical data
 
 # Function to create tables dynamically with "lvl_" prefix
-def create_dynamic_tables(hierarchy: List[str]):
+def create_dynamic_tables(session, hierarchy: List[str]):
     metadata = MetaData()
     tables = {}
     parent = None
@@ -58,92 +61,59 @@ def create_dynamic_tables(hierarchy: List[str]):
             Column("id", Integer, primary_key=True),
             Column("name", String(50)),
             Column(f"{parent}_id", Integer, fk) if parent else None,
+            # Lets bulk uploads use INSERT ... ON CONFLICT DO NOTHING
+            UniqueConstraint("name", f"{parent}_id") if parent else UniqueConstraint("name"),
         )
 
         tables[table_name] = table  # Store reference to created tables
         parent = table_name  # Update the parent for the next level
 
-    metadata.create_all(engine)  # Create all tables in the database
+    # Only creates missing tables; the schema registry is refreshed if anything changed
+    registry.ensure_tables(session, tables.values())
+    ensure_message_tables(session)  # reference_table / exp_message, named after the bottom-most level
     return tables  # Return the table references
 
-# Helper function to insert or fetch ID for a given data
-def insert_or_get(session, table, item_data: Dict[str, str], parent_column=None):
-    # Query to check if the record exists
-    query = select(table).where(table.c.name == item_data["name"])
-
-    # If there's a parent column, add it to the query
-    if parent_column and parent_column in item_data:
-        query = query.where(table.c[parent_column] == item_data[parent_column])
-
-    # Fetch the first record
-    existing_record = session.execute(query).fetchone()
-
-    if existing_record:
-        return existing_record.id
+# Every key in the data must be one of the hierarchy levels
+def check_level_keys(hierarchy: List[str], data: List[Dict[str, str]]):
+    levels = {level.lower() for level in hierarchy}
+    for item in data:
+        for key in item:
+            if key.lower() not in levels:
+                raise HTTPException(status_code=500, detail=f"Table 'lvl_{key.lower()}' does not exist")
 
-    # If not found, insert and get the new ID
-    result = session.execute(table.insert().values(item_data))
-    session.commit()  # Commit to get the ID
-    return result.inserted_primary_key[0]
 
 @router.post("/upload-branch-data")
 async def create_tables_and_add_data(request: HierarchicalInput):
-    # Start a new database session
-    session = Session()
+    return await run_db(upload_branch_data, request)
 
+
+def upload_branch_data(session, request: HierarchicalInput):
     try:
         # Create tables based on hierarchy
-        created_tables = create_dynamic_tables(request.hierarchy)
-
-        # Reflect existing table structure
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-
-        # To track parent-child relationships
-        parent_id_map = {}
-
-        # Loop through each dictionary in the input data
-        for item in request.data:
-            previous_table_name = None
-            previous_id = None
+        created_tables = create_dynamic_tables(session, request.hierarchy)
 
-            # Insert based on hierarchy order
-            for key, value in item.items():
-                # Convert key to "lvl_" prefixed table name
-                table_name = f"lvl_{key.lower()}"
-                table = metadata.tables.get(table_name)
+        # Cached table structure (refreshed by create_dynamic_tables if it changed)
+        metadata = registry.snapshot(session).metadata
 
-                if table is None:
-                    raise HTTPException(status_code=500, detail=f"Table '{table_name}' does not exist")
+        check_level_keys(request.hierarchy, request.data)
 
-                # Determine if this entry has a parent
-                parent_column = None
-                if previous_table_name:
-                    parent_column = f"{previous_table_name}_id"
-
-                # Prepare the data for insertion
-                insert_data = {"name": value}
-                if parent_column and previous_id is not None:
-                    insert_data[parent_column] = previous_id
-
-                # Insert or fetch the existing record's ID
-                new_id = insert_or_get(session, table, insert_data, parent_column)
-
-                # Update the previous table name and ID for parent references
-                previous_table_name = table_name
-                previous_id = new_id
+        # Insert level by level (set-based), resolving parent ids in memory
+        loader = HierarchyLoader(metadata, request.hierarchy)
+        stats = loader.load(session, request.data)
+        add_nodes(session, loader.levels, loader.last_inserted)  # Closure rows of the new nodes
+        session.commit()  # One commit for the whole upload
+        hierarchy_tree.refresh_after_upload(session)
 
         return {
             "message": "Tables and data created successfully",
             "created_tables": list(created_tables.keys()),
+            "levels": stats,
         }
 
     except SQLAlchemyError as e:
         session.rollback()  # Rollback on error
         raise HTTPException(status_code=500, detail=f"Error inserting data: {str(e)}")
 
-    finally:
-        session.close()  # Ensure session closure
 
 
 
@@ -155,83 +125,106 @@ async def create_tables_and_add_data(request: HierarchicalInput):
 
 
 
-# 
-# API to fetch hierarchy
-# Also the top most and bottom most tables
-# 
+# STREAMING UPLOAD (CSV / NDJSON)
 
-from utils.table_hierarchy import find_relationships,find_top_most_level,find_bottom_most_level
+# Rows written per transaction while streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "2000"))
 
 
-# Function to traverse the hierarchy and return an ordered list of tables
-def get_ordered_table_hierarchy(relationships, top_most_level):
-    # Create an ordered list with the topmost level at the start
-    ordered_hierarchy = [top_most_level]
-    current_level = top_most_level
+def setup_stream_loader(session, hierarchy: List[str]):
+    created_tables = create_dynamic_tables(session, hierarchy)
+    metadata = registry.snapshot(session).metadata
+    return list(created_tables.keys()), HierarchyLoader(metadata, hierarchy)
 
-    # Traverse the relationships to build the hierarchy
-    while True:
-        # Get the child tables that have the current level as their parent
-        child_tables = []
-        for table, parent_columns in relationships.items():
-            # Check if the current level is a parent to any other table
-            if current_level in [parent[0] for parent in parent_columns]:
-                child_tables.append(table)
 
-        if not child_tables:
-            # If no child tables found, we've reached the bottommost level
-            break
+def load_stream_batch(session, loader: HierarchyLoader, batch: List[Dict[str, str]]):
+    try:
+        loader.load(session, batch)
+        add_nodes(session, loader.levels, loader.last_inserted)
+        session.commit()
+        hierarchy_tree.refresh_after_upload(session)
+    except SQLAlchemyError as e:
+        session.rollback()
+        raise HTTPException(status_code=500, detail=f"Error inserting data: {str(e)}")
+
+
+# Body is a chunked CSV (header row = hierarchy levels) or NDJSON stream. Rows are loaded
+# in batches of STREAM_BATCH_SIZE; progress is visible at GET /api/v1/jobs/{job_id}.
+@router.post("/upload-branch-data/stream")
+async def stream_branch_data(
+    request: Request,
+    format: str = Query("csv", description="'csv' or 'ndjson'"),
+    hierarchy: Optional[str] = Query(None, description="Comma separated levels (default: CSV header / first NDJSON keys)"),
+    job_id: Optional[str] = Query(None, description="Client chosen job id, to poll progress while uploading"),
+):
+    if job_id and await jobs.find(job_id):
+        raise HTTPException(status_code=409, detail="Job id already in use")
+
+    job = jobs.create("hierarchy-upload", job_id)
+    job.start()
+    levels = [level.strip() for level in hierarchy.split(",")] if hierarchy else None
+    created_tables, loader = [], None
+
+    try:
+        async for batch in batched(iter_rows(request.stream(), format.lower()), STREAM_BATCH_SIZE):
+            if loader is None:
+                levels = levels or list(batch[0].keys())
+                created_tables, loader = await run_db(setup_stream_loader, levels)
 
-        # Add the first child table to the hierarchy (assuming a single hierarchy path)
-        ordered_hierarchy.append(child_tables[0])
-        current_level = child_tables[0]
+            check_level_keys(levels, batch)
+            await run_db(load_stream_batch, loader, batch)
+            job.progress(len(batch))
+            job.details["levels"] = loader.stats
+
+    except HTTPException as e:
+        job.fail(str(e.detail))
+        raise
+    except Exception as e:
+        job.fail(str(e))
+        raise HTTPException(status_code=500, detail=f"Error streaming data: {str(e)}")
+
+    job.finish({"created_tables": created_tables})
+    return {
+        "message": "Tables and data created successfully",
+        "job_id": job.id,
+        "rows": job.rows,
+        "created_tables": created_tables,
+        "levels": loader.stats if loader else {},
+    }
+
+
+# 
+# API to fetch hierarchy
+# Also the top most and bottom most tables
+# 
 
-    return ordered_hierarchy
 
 
 
 # Get Values for each hierarchy level (Use in dropdown in the frontend):
+# Served from the in-memory hierarchy tree, with an ETag (304 when unchanged)
 @router.get("/lvl-values")
-async def get_lvl_tables_data():
-    session = Session()  # Create a session for database operations
-    data = {}
+async def get_lvl_tables_data(request: Request):
+    if hierarchy_tree.needs_check():
+        await run_db(hierarchy_tree.ensure_fresh)
+    body, etag = hierarchy_tree.lvl_values()
+    return etag_response(request, body, etag)
 
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
 
-    try:
-        # Get all tables starting with 'lvl_'
-        relationships = find_relationships(engine)
-            # Find the top-most and bottom-most levels
-        top_most = find_top_most_level(relationships)
-        lvl_tables = get_ordered_table_hierarchy(relationships, top_most)
-        logging.debug(f'lvl_tables: {lvl_tables}')
-        if not lvl_tables:
-            return {"error": "No tables found starting with 'lvl_'"}
-
-        # Retrieve data from each table
-        for table_name in lvl_tables:  # Iterate over table names
-            # Execute the select statement and fetch the data
-            table = metadata.tables[table_name]  # Get the table object
-            select_stmt = table.select()  # Create a select statement
-            result = session.execute(select_stmt)  # Execute the query
-
-            table_data = []
-            for row in result.fetchall():  # Fetch all rows
-                # Construct dictionary using column values
-                row_dict = {table.columns[i].name: row[i] for i in range(len(row))}
-                table_data.append(row_dict)  # Add the dictionary to the list
-
-            data[table_name] = table_data  # Store in dictionary with the modified table name as key
-
-        return data  # Return the dictionary with all the data
+# Children of one node (`level` + `id`), or the top-most nodes without `level`
+@router.get("/children-of")
+async def get_children_of(request: Request, level: Optional[str] = None, id: Optional[int] = None):
+    if hierarchy_tree.needs_check():
+        await run_db(hierarchy_tree.ensure_fresh)
 
-    except Exception as e:
-        session.rollback()  # Rollback if there's an error
-        raise HTTPException(status_code=500, detail=f"Error fetching data: {str(e)}")
+    level_table = level_table_name(level) if level else None
+    if level_table is not None and level_table not in hierarchy_tree.levels:
+        raise HTTPException(status_code=400, detail=f"Invalid level '{level}'")
+    if level_table is not None and id is None:
+        raise HTTPException(status_code=400, detail="'id' is required with 'level'")
 
-    finally:
-        session.close() # Ensure the session is closed to prevent resource leaks
+    body, etag = json_payload(hierarchy_tree.children_of(level_table, id))
+    return etag_response(request, body, etag)
 
 # @router.get("/lvl_info")
 # async def get_lvl_info():
@@ -270,76 +263,139 @@ async def get_lvl_tables_data():
 
 
 
+#----------------------------- DESCENDANTS / ANCESTORS (closure table) -----------------------------
+
+
+def find_level_nodes(session, level: str, name: str):
+    schema = registry.snapshot(session)
+    level_table = level_table_name(level)
+    if level_table not in schema.ordered_hierarchy:
+        raise HTTPException(status_code=400, detail=f"Invalid level '{level}'")
+    table = schema.table(level_table)
+    return schema, level_table, select(table.c.id).where(table.c.name == name)
+
+
+# All nodes of `to_level` (default: bottom-most) below every `level` node called `name`
+@router.get("/descendants")
+async def get_descendants(level: str, name: str, to_level: Optional[str] = None):
+    return await run_db(load_descendants, level, name, to_level)
+
+
+def load_descendants(session, level: str, name: str, to_level: Optional[str] = None):
+    schema, level_table, node_ids = find_level_nodes(session, level, name)
+    target_table = level_table_name(to_level) if to_level else schema.bottom_most
+    if target_table not in schema.ordered_hierarchy:
+        raise HTTPException(status_code=400, detail=f"Invalid level '{to_level}'")
+
+    target = schema.table(target_table)
+    rows = session.execute(
+        select(target.c.id, target.c.name)
+        .where(target.c.id.in_(descendant_ids(level_table, node_ids, target_table)))
+        .order_by(target.c.id)
+    ).fetchall()
+    return {"level": target_table[4:], "nodes": [{"id": row.id, "name": row.name} for row in rows]}
+
+
+# Path from the top of the hierarchy to every `level` node called `name`
+@router.get("/ancestors")
+async def get_ancestors(level: str, name: str):
+    return await run_db(load_ancestors, level, name)
+
+
+def load_ancestors(session, level: str, name: str):
+    schema, level_table, node_ids = find_level_nodes(session, level, name)
+    rows = session.execute(ancestors_query(level_table, node_ids)).fetchall()
+
+    # Names of the ancestors, one primary key lookup per level
+    names = {}
+    wanted = {}
+    for row in rows:
+        wanted.setdefault(row.ancestor_level, set()).add(row.ancestor_id)
+    for ancestor_level, ids in wanted.items():
+        table = schema.table(ancestor_level)
+        for node in session.execute(select(table.c.id, table.c.name).where(table.c.id.in_(ids))):
+            names[(ancestor_level, node.id)] = node.name
+
+    nodes = {node_id: [] for node_id in session.execute(node_ids).scalars()}
+    for row in rows:
+        nodes[row.descendant_id].append({
+            "level": row.ancestor_level[4:],
+            "id": row.ancestor_id,
+            "name": names.get((row.ancestor_level, row.ancestor_id)),
+        })
+    if not nodes:
+        raise HTTPException(status_code=404, detail=f"No {level_table[4:]} found with name '{name}'")
+
+    return {"nodes": [{"id": node_id, "name": name, "ancestors": path} for node_id, path in nodes.items()]}
+
+
 #----------------------------- FILTER BRANCH VALUES API  -------------------------------------------
 
 
-# Adjust the function to initialize the stack from the correct table
-def generate_query_string(relationships, filter_type, filter_value):
+# Filter statements, built once per (level table, schema version); only the bound
+# `filter_value` changes between calls, so the database can reuse the plan.
+_filter_statements = {}
+_filter_statements_lock = threading.Lock()
+
+
+def filter_statement(schema, filter_type: str):
     table_name = f"lvl_{filter_type.lower()}"
 
     # Check if the given filter type is valid
-    if table_name not in relationships:
+    if table_name not in schema.ordered_hierarchy:
         raise HTTPException(status_code=400, detail="Invalid filter type")
 
-    # Build the INNER JOINs based on the hierarchy
-    top_most_table = find_top_most_level(relationships)
-    join_clauses = []
-    visited = set()
-    stack = [(table_name, None)]  # Initialize from the current table, not top-most
+    key = (table_name, schema.version)
+    statement = _filter_statements.get(key)
+    if statement is not None:
+        return statement
 
-    while stack:
-        current_table, parent_table = stack.pop()
-        visited.add(current_table)
+    # INNER JOINs down the whole hierarchy, top-most to bottom-most
+    path = [schema.table(name) for name in schema.ordered_hierarchy]
+    joined = path[0]
+    for parent, child in zip(path, path[1:]):
+        joined = joined.join(child, child.c[f"{parent.name}_id"] == parent.c.id)
 
-        if parent_table:
-            join_clause = f"INNER JOIN {current_table} ON {parent_table}.id = {current_table}.{parent_table}_id"
-            join_clauses.append(join_clause)
+    def name_column(table):
+        return table.c.name.label(f"{table.name[4:]}_name")  # e.g. "branch_name"
 
-        # Add child tables to ensure all relationships are connected
-        for child in relationships.get(current_table, []):
-            if child[0] not in visited:
-                stack.append((child[0], current_table))
-
-    # Determine the SELECT clause based on the given level
-    bottom_most_table = find_bottom_most_level(relationships)
-
-    if table_name == top_most_table:
+    level = schema.table(table_name)
+    bottom = path[-1]
+    if table_name == schema.top_most:
         # For top-most level, return bottom-most level values
-        select_clause = f"{bottom_most_table}.name"
-    elif table_name == bottom_most_table:
+        columns = [name_column(bottom)]
+    elif table_name == schema.bottom_most:
         # For bottom-most level, return all data in the hierarchy
-        select_clause = ", ".join([f"{table}.name" for table in visited])
+        columns = [name_column(table) for table in path]
     else:
         # For intermediate level, return parent data and bottom-most level data
-        select_clause = ", ".join([f"{bottom_most_table}.name"] + [f"{table}.name" for table in relationships[table_name]])
+        parent = path[schema.ordered_hierarchy.index(table_name) - 1]
+        columns = [name_column(bottom), name_column(parent)]
 
-    # WHERE clause with the filter condition
-    where_clause = f"WHERE {table_name}.name = '{filter_value}'"
+    statement = (
+        select(*columns)
+        .select_from(joined)
+        .where(level.c.name == bindparam("filter_value"))
+        .order_by(bottom.c.id)
+    )
 
-    # Construct the query string with FROM, INNER JOINs, SELECT, and WHERE clauses
-    query_str = f"SELECT {select_clause} FROM {top_most_table} {' '.join(join_clauses)} {where_clause};"
-    logging.debug(f'query_str: {query_str}')
-    return query_str
+    with _filter_statements_lock:
+        # Statements of older schema versions can't be used anymore
+        for stale in [k for k in _filter_statements if k[1] != schema.version]:
+            del _filter_statements[stale]
+        _filter_statements[key] = statement
+    return statement
 
 
 # Function to execute the query and retrieve results
-def get_query_results(engine, query_str):
-    with engine.connect() as connection:
-        query = text(query_str)
-        result = connection.execute(query)
-        rows = result.fetchall()
+def get_query_results(session, statement, filter_value: str):
+    rows = session.execute(statement, {"filter_value": filter_value}).fetchall()
 
     if not rows:
         raise HTTPException(status_code=404, detail="No results found")
 
-    # Return the results as a list of dictionaries for proper retrieval
-    result_data = []
-    for row in rows:
-        row_dict = {f"column_{i}": col for i, col in enumerate(row)}
-        result_data.append(row_dict)
-
-
-    return result_data
+    # Rows keyed by their column names (e.g. "branch_name")
+    return [dict(row._mapping) for row in rows]
 
 
 # FastAPI endpoint to get filtered results
@@ -348,15 +404,16 @@ async def get_filtered_results(
     filter_type: str = Query(..., description="Type of filter"),
     filter_value: str = Query(..., description="Value to filter by"),
 ):
-    try:
-        # Get relationships between tables
-        relationships = find_relationships(engine)
+    return await run_db(filter_results, filter_type, filter_value)
 
-        # Generate the query string with INNER JOINs
-        query_str = generate_query_string(relationships, filter_type, filter_value)
+
+def filter_results(session, filter_type: str, filter_value: str):
+    try:
+        # Cached, parameterized statement for this level
+        statement = filter_statement(registry.snapshot(session), filter_type)
 
         # Get query results and return them
-        results = get_query_results(engine, query_str)
+        results = get_query_results(session, statement, filter_value)
 
         return {
             "message": "Filtered results",
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, HTTPException
+
+from utils.jobs import jobs
+
+router = APIRouter()
+
+# Status of a background job (upload, message send, ...), from any worker
+@router.get("/{job_id}")
+async def get_job_status(job_id: str):
+    job = await jobs.find(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
@@ -0,0 +1,82 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+import os
+
+from utils.bootstrap import boot_timer
+from utils.database import pool_stats, run_db
+from utils.http_cache import response_cache
+from utils.jobs import job_queue
+from utils.observability import metrics
+from utils.push import push_hub
+from utils.read_receipts import read_receipts
+from utils.template_store import template_usage
+from utils.campaign_scheduler import campaign_scheduler
+from utils.indexes import verify_indexes
+from utils.partitions import partition_report
+
+router = APIRouter()
+
+# Connection pool usage for this worker (use it to size DB_POOL_SIZE per worker count)
+@router.get("/pool")
+async def get_pool_metrics():
+    return {
+        "pid": os.getpid(),
+        "pool": pool_stats(),
+    }
+
+
+# Expected exp_message indexes (present / missing / different columns) and partitions
+@router.get("/schema")
+async def get_schema_metrics():
+    return await run_db(schema_report)
+
+
+def schema_report(session):
+    return {
+        "indexes": verify_indexes(session),
+        "partitioning": partition_report(session),
+    }
+
+
+# Response cache of this worker (entries, hits, 304s)
+@router.get("/cache")
+async def get_cache_metrics():
+    return {
+        "pid": os.getpid(),
+        "cache": response_cache.stats(),
+    }
+
+
+# Boot phases of this worker (seconds after import: imports, schema, ready, first request)
+@router.get("/boot")
+async def get_boot_metrics():
+    return boot_timer.report()
+
+
+# Slowest statements by fingerprint (over SLOW_QUERY_MS), most total time first
+@router.get("/slow-queries")
+async def get_slow_queries():
+    return {"pid": os.getpid(), "queries": metrics.slow_query_report()}
+
+
+# Everything above in the Prometheus text format, for scraping (per worker)
+@router.get("/prometheus", response_class=PlainTextResponse)
+async def get_prometheus_metrics():
+    pool = pool_stats()
+    cache = response_cache.stats()
+    gauges = {
+        "db_pool_checked_out": ("Connections in use", pool.get("checkedout", 0)),
+        "db_pool_idle": ("Idle pooled connections", pool.get("idle", 0)),
+        "db_pool_overflow": ("Connections over the pool size", pool.get("overflow", 0)),
+        "response_cache_entries": ("Cached responses", cache["entries"]),
+        "job_queue_pending": ("Queued background jobs", job_queue.pending),
+        "read_receipts_pending": ("Read receipts waiting for a flush", read_receipts.pending),
+        "template_uses_pending": ("Templates with use counts waiting for a flush", template_usage.pending),
+        "push_connections": ("Open push streams", push_hub.connections),
+        "scheduled_messages_sent": ("Messages of scheduled campaigns sent by this worker", campaign_scheduler.sent),
+    }
+    counters = {
+        "response_cache_hits_total": ("Responses served from the cache without a version check", cache["hits"]),
+        "response_cache_not_modified_total": ("304 responses", cache["not_modified"]),
+    }
+    return PlainTextResponse(metrics.render(gauges, counters), media_type="text/plain; version=0.0.4")
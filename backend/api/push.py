@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+import asyncio
+
+from utils.push import push_hub, format_event, PUSH_HEARTBEAT
+
+router = APIRouter()
+
+# Server-Sent Events stream of a user's new messages ("message" events, plus "resync"
+# when the client fell behind and should reload its inbox)
+@router.get("/users/{user_id}")
+async def stream_user_messages(user_id: int, request: Request):
+    subscriber = push_hub.subscribe(user_id)
+
+    async def events():
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=PUSH_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # Keeps proxies from closing idle streams
+                    continue
+                yield format_event(event)
+        finally:
+            push_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Connected streams in this worker
+@router.get("/connections")
+async def get_connections():
+    return {"connections": push_hub.connections}
@@ -1,37 +1,17 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, select, DateTime
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select, func, tuple_
 from sqlalchemy.exc import SQLAlchemyError
+from typing import Optional
 import logging
 from datetime import datetime
 
-logging.basicConfig(level=logging.DEBUG)
 # Database configuration
-import os
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mydatabase")
-
-router = APIRouter()
-
-engine = create_engine(DATABASE_URL)
-metadata = MetaData()
-
-# Define the templates table
-templates = Table(
-    "templates",
-    metadata,
-    Column("template_id", Integer, primary_key=True),
-    Column("template_name", String),
-    Column("message_title", String),
-    Column("message_content", String),
-    Column("template_useCount", Integer, default=0),
-    Column("createdAt", DateTime, default=datetime.now()),
-    Column("modifiedAt", DateTime, default=datetime.now()),
-
-)
-
-# Create the table if it doesn't exist
-metadata.create_all(engine)
+from utils.database import run_db
+from utils.schema_registry import registry
+from utils.templating import compile_template, template_cache, TemplateError
+from utils.pagination import encode_cursor, decode_cursor
+from utils.template_store import templates, template_store, template_to_dict
 
 # Define Pydantic models
 class TemplateCreate(BaseModel):
@@ -39,6 +19,12 @@ class TemplateCreate(BaseModel):
     message_title: str
     message_content: str
 
+# Fields left out are kept
+class TemplateUpdate(BaseModel):
+    template_name: Optional[str] = None
+    message_title: Optional[str] = None
+    message_content: Optional[str] = None
+
 class Template(BaseModel):
     template_id: int
     template_name: str
@@ -54,19 +40,147 @@ router = APIRouter()
 # Create a Template (POST)
 @router.post("/", response_model=Template)
 async def create_template(template: TemplateCreate):
+    return await run_db(insert_template, template)
+
+
+# Columns every users table has, for templates created before any user exists
+BASE_USER_COLUMNS = ["id", "username", "email", "role"]
+
+
+def validate_template(session, content: str):
+    # Placeholders must parse, leave no stray {{ }} behind and name a column of `users`
     try:
-        Session = sessionmaker(bind=engine)
-        session = Session()
+        compiled = compile_template(content)
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    malformed = compiled.malformed_placeholders()
+    if malformed:
+        raise HTTPException(status_code=400, detail=f"Malformed template placeholders: {', '.join(malformed)}")
+
+    schema = registry.snapshot(session)
+    columns = schema.table("users").c.keys() if schema.has_table("users") else BASE_USER_COLUMNS
+    unknown = compiled.unknown_variables(columns)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown template variables: {', '.join(unknown)}")
+
+
+def insert_template(session, template: TemplateCreate):
+    validate_template(session, template.message_content)
+    try:
+        now = datetime.now()
         new_template = {
             "template_name": template.template_name,
             "message_title": template.message_title,
-            "message_content": template.message_content
+            "message_content": template.message_content,
+            "createdAt": now,
+            "modifiedAt": now,
         }
         result = session.execute(templates.insert(), new_template)
         session.commit()
-        created_template = session.execute(select(templates).where(templates.c.template_id == result.inserted_primary_key[0])).fetchone()
-        session.close()
-        return created_template
+        return template_store.get(session, result.inserted_primary_key[0])
     except SQLAlchemyError as e:
         logging.error(e)
-        raise HTTPException(status_code=500, detail="Error creating template")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Error creating template")
+
+
+# List templates, one page at a time: newest first ("recent") or most used first
+# ("popular"). Pass `next_cursor` back as `cursor` for the next page.
+@router.get("/")
+async def list_templates(
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    sort: str = Query(default="recent", pattern="^(recent|popular)$"),
+):
+    return await run_db(load_templates, limit, cursor, sort)
+
+
+def load_templates(session, limit: int = 20, cursor: Optional[str] = None, sort: str = "recent"):
+    uses = func.coalesce(templates.c.template_useCount, 0)
+    query = select(templates).limit(limit + 1)
+    if sort == "popular":
+        query = query.order_by(uses.desc(), templates.c.template_id.desc())
+        if cursor:
+            last_uses, last_id = decode_cursor(cursor, int, int)
+            query = query.where(tuple_(uses, templates.c.template_id) < (last_uses, last_id))
+    else:
+        query = query.order_by(templates.c.template_id.desc())
+        if cursor:
+            last_id, = decode_cursor(cursor, int)
+            query = query.where(templates.c.template_id < last_id)
+
+    rows = [template_to_dict(row) for row in session.execute(query)]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = (
+            encode_cursor(last["template_useCount"], last["template_id"]) if sort == "popular"
+            else encode_cursor(last["template_id"])
+        )
+    return {"templates": rows[:limit], "next_cursor": next_cursor}
+
+
+# Get one template (served from the template cache when recently read)
+@router.get("/{template_id}", response_model=Template)
+async def get_template(template_id: int):
+    return await run_db(load_template, template_id)
+
+
+def load_template(session, template_id: int):
+    template = template_store.get(session, template_id)
+    if template is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return template
+
+
+# Update a template (only the given fields)
+@router.put("/{template_id}", response_model=Template)
+async def update_template(template_id: int, template: TemplateUpdate):
+    return await run_db(save_template, template_id, template)
+
+
+def save_template(session, template_id: int, template: TemplateUpdate):
+    changes = {key: value for key, value in template.model_dump().items() if value is not None}
+    if not changes:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    if "message_content" in changes:
+        validate_template(session, changes["message_content"])
+
+    try:
+        result = session.execute(
+            templates.update()
+            .where(templates.c.template_id == template_id)
+            .values(**changes, modifiedAt=datetime.now())
+        )
+        if not result.rowcount:
+            session.rollback()
+            raise HTTPException(status_code=404, detail="Template not found")
+        session.commit()
+    except SQLAlchemyError as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail="Error updating template")
+
+    template_store.invalidate(template_id)
+    template_cache.discard(template_id)
+    return template_store.get(session, template_id)
+
+
+# Delete a template (messages already sent with it are kept)
+@router.delete("/{template_id}")
+async def delete_template(template_id: int):
+    return await run_db(remove_template, template_id)
+
+
+def remove_template(session, template_id: int):
+    try:
+        result = session.execute(templates.delete().where(templates.c.template_id == template_id))
+        if not result.rowcount:
+            session.rollback()
+            raise HTTPException(status_code=404, detail="Template not found")
+        session.commit()
+    except SQLAlchemyError as e:
+        logging.error(e)
+        raise HTTPException(status_code=500, detail="Error deleting template")
+
+    template_store.invalidate(template_id)
+    template_cache.discard(template_id)
+    return {"message": "Template deleted", "template_id": template_id}
@@ -1,10 +1,11 @@
 from fastapi import APIRouter, HTTPException, Query
-from sqlalchemy import create_engine, MetaData, Table, select, text
-from sqlalchemy.orm import sessionmaker
-import os
-import logging
+from sqlalchemy import select, text
+from typing import Optional
+from utils.schema_registry import registry
+from utils.pagination import encode_cursor, decode_cursor
+from utils.campaign_stats import campaign_stats, get_stats
 
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 
 # Define the time zone for IST
@@ -13,151 +14,161 @@ ist = pytz.timezone('Asia/Kolkata')
 # Initialize FastAPI Router
 router = APIRouter()
 
-# Database setup
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mydatabase")
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)  # Correct sessionmaker setup
+# Database setup (shared engine and pool)
+from utils.database import run_db
 
 
 
 # FETCH ALL MESSAGES SENT...
+# One row per campaign (reference_table row), newest first, with recipient and read
+# counts from the campaign_stats table. Pass `next_cursor` back as `cursor` for the next page.
 @router.get("/")
-async def view_messages(limit: int = Query(default=10, description="Limit the number of messages to fetch")):
-    session = Session()
-    try:
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-        
-        # Reflect both exp_message and reference_table
-        exp_message_table = Table("exp_message", metadata, autoload_with=engine)
-        reference_table = Table("reference_table", metadata, autoload_with=engine)
-
-        # Join exp_message and reference_table on the reference_id column
-        join_condition = exp_message_table.c.reference_id == reference_table.c.id
-        joined_tables = exp_message_table.join(reference_table, join_condition)
-        logging.debug(f'joined_tables: {joined_tables}')
-
+async def view_messages(
+    limit: int = Query(default=10, ge=1, le=100, description="Limit the number of campaigns to fetch"),
+    cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page"),
+):
+    return await run_db(list_sent_messages, limit, cursor)
 
-        # Construct the SQL query to fetch messages with limited results
-        query = text(
-            f"""
-            SELECT 
-                {exp_message_table.name}.sent_time,
-                {reference_table.name}.template_name,
-                {reference_table.name}.id
-            FROM 
-                {exp_message_table.name}
-            JOIN 
-                {reference_table.name} 
-            ON 
-                {exp_message_table.name}.reference_id = {reference_table.name}.id
-            ORDER BY 
-                {exp_message_table.name}.sent_time DESC
-            LIMIT 
-                :limit
-            """
-        ).bindparams(limit=limit)
-        logging.debug(f'query: {query}')
 
+def format_sent_time(sent_time) -> Optional[str]:
+    if sent_time is None:
+        return None
+    if isinstance(sent_time, str):  # SQLite returns timestamps as text
+        sent_time = datetime.fromisoformat(sent_time)
+    sent_time_ist = sent_time.astimezone(pytz.utc).astimezone(ist)  # Convert to UTC, then IST
+    return sent_time_ist.strftime('%d-%m-%Y %H:%M')
 
-        # Execute the query and fetch all results
-        result = session.execute(query).fetchall()
-        logging.debug(f'result: {result}')
 
-        # Transform the result into a list of dictionaries
-        unique_reference_ids = set()
-        messages = []
+def list_sent_messages(session, limit: int, cursor: Optional[str] = None):
+    try:
+        # Cached exp_message and reference_table
+        schema = registry.snapshot(session)
+        if not schema.has_table("reference_table"):
+            return {"messages": [], "next_cursor": None}  # Nothing sent yet
+        reference_table = schema.table("reference_table")
+
+        # Keyset page of campaigns (ids grow with send time); one extra row tells if there's more
+        page = (
+            select(reference_table.c.id, reference_table.c.template_name, reference_table.c.message_title)
+            .order_by(reference_table.c.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor:
+            last_id, = decode_cursor(cursor, int)
+            page = page.where(reference_table.c.id < last_id)
+        page = page.subquery()
+
+        # Counts come from campaign_stats (primary key lookups), never from exp_message
+        query = (
+            select(
+                page,
+                campaign_stats.c.first_sent_time.label("sent_time"),
+                campaign_stats.c.sent_count.label("recipients"),
+                campaign_stats.c.read_count,
+            )
+            .outerjoin(campaign_stats, campaign_stats.c.reference_id == page.c.id)
+            .order_by(page.c.id.desc())
+        )
+        rows = session.execute(query).fetchall()
+
+        messages = [
+            {
+                "sent_time": format_sent_time(row.sent_time),
+                "template_name": row.template_name,
+                "message_title": row.message_title,
+                "reference_id": row.id,
+                "recipients": row.recipients or 0,
+                "read_count": row.read_count or 0,
+            }
+            for row in rows[:limit]
+        ]
+        next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+
+        return {"messages": messages, "next_cursor": next_cursor}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        # If an error occurs, raise an HTTPException with a 500 status code and the error detail
+        raise HTTPException(status_code=500, detail=f"Error fetching messages: {str(e)}")
 
-        for row in result:
-            sent_time_utc = row[0].astimezone(pytz.utc)  # Convert to UTC
-            sent_time_ist = sent_time_utc.astimezone(ist)  # Convert to IST
 
-            # Remove seconds from the time format
-            sent_time_ist = sent_time_ist.replace(second=0, microsecond=0)
 
-            reference_id = row[2]
-            if reference_id not in unique_reference_ids:
-                message_dict = {
-                    "sent_time": sent_time_ist.strftime('%d-%m-%Y %H:%M'),
-                    "template_name": row[1],
-                    "reference_id": reference_id
-                }
-                messages.append(message_dict)
-                unique_reference_ids.add(reference_id)
 
-        return {"messages": messages}
-    
-    except Exception as e:
-        # If an error occurs, raise an HTTPException with a 500 status code and the error detail
-        raise HTTPException(status_code=500, detail=f"Error fetching messages: {str(e)}")
 
-    finally:
-        session.close()  # Close the session to prevent resource leaks
 
 
 
+from utils.user_filter import user_filtering
+from utils.hierarchy_targets import load_targets
 
 
+# Delivery/read counters of a campaign (sent, read, first and last read time)
+@router.get("/{id}/stats")
+async def get_campaign_stats(id: int):
+    return await run_db(load_campaign_stats, id)
 
 
+def load_campaign_stats(session, id: int):
+    stats = get_stats(session, [id])
+    if not stats:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return stats[0]
 
-from utils.table_hierarchy import find_relationships,find_bottom_most_level
-from utils.user_filter import user_filtering
 
 
 # FETCH A PARTICULAR MESSAGE FOR USER...
 @router.get("/{id}")
 async def get_reference_details(id: int):
+    return await run_db(load_reference_details, id)
+
+
+def load_reference_details(session, id: int):
     try:
-        # Create metadata
-        metadata = MetaData()
-        metadata.reflect(bind=engine)
-
-        # Get exp_message_table and reference_table
-        exp_message_table = Table("exp_message", metadata, autoload_with=engine)
-        reference_table = Table("reference_table", metadata, autoload_with=engine)
-
-        # Start a new session
-        with Session() as session:
-            # Fetch details from the reference table
-            query = text(
-                f"""
-                SELECT * FROM {reference_table.name}
-                WHERE {reference_table.c.id} = :id
-                """
-            )
+        # Get exp_message_table and reference_table from the cached schema
+        schema = registry.snapshot(session)
+        exp_message_table = schema.table("exp_message")
+        reference_table = schema.table("reference_table")
 
-            # Execute the query
-            reference_details = session.execute(query, {"id": id}).fetchone()
+        # Fetch details from the reference table
+        query = text(
+            f"""
+            SELECT * FROM {reference_table.name}
+            WHERE {reference_table.c.id} = :id
+            """
+        )
 
-            if not reference_details:
-                raise HTTPException(status_code=404, detail="Reference table entry not found")
+        # Execute the query
+        reference_details = session.execute(query, {"id": id}).fetchone()
 
-            logging.debug(f'reference_details: {reference_details}')
+        if not reference_details:
+            raise HTTPException(status_code=404, detail="Reference table entry not found")
 
-            # Fetch column names dynamically
-            column_names = reference_table.columns.keys()
-            logging.debug(f'column_names: {column_names}')
+        # Fetch column names dynamically
+        column_names = reference_table.columns.keys()
 
-            # Create a dictionary to store reference details
-            reference_dict = {}
+        # Create a dictionary to store reference details
+        reference_dict = {}
 
-            for idx, column_name in enumerate(column_names):
-                reference_dict[column_name] = reference_details[idx]
+        for idx, column_name in enumerate(column_names):
+            reference_dict[column_name] = reference_details[idx]
 
-            # Find bottom most level
-            relationships = find_relationships(engine)
-            btm_lvl = find_bottom_most_level(relationships)
+        # Find bottom most level
+        btm_lvl = schema.bottom_most
 
-            # Remove "lvl_" prefix and add "_name" suffix
-            btm_lvl_name = btm_lvl.replace("lvl_", "") + "_name"
+        # Remove "lvl_" prefix and add "_name" suffix
+        btm_lvl_name = btm_lvl.replace("lvl_", "") + "_name"
 
-            # Replace "branch_name" with btm_lvl_name
-            reference_dict["btm_lvl"] = reference_dict.pop(btm_lvl_name, None)
-            users=user_filtering(reference_dict["btm_lvl"])
+        # Replace "branch_name" with btm_lvl_name
+        reference_dict["btm_lvl"] = reference_dict.pop(btm_lvl_name, None)
+        reference_dict["targets"] = load_targets(session, id)
+        users=user_filtering(session, reference_dict["btm_lvl"], reference_dict.get("target_level"),
+                             reference_dict["targets"])
 
-            # Return the reference details
-            return {"reference_data":reference_dict},users
+        # Return the reference details
+        return {"reference_data":reference_dict},users
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching reference details: {str(e)}")
@@ -0,0 +1,415 @@
+# Benchmark harness for the hot endpoints (a measuring tool, not a test suite).
+#
+#   cd backend
+#   python -m benchmarks.run --scale small
+#   python -m benchmarks.run --scale small --baseline benchmarks/baselines/sqlite-small.json
+#   python -m benchmarks.run --scale large --database-url postgresql://... --save-baseline benchmarks/baselines/pg-large.json
+#
+# The app runs in-process (httpx ASGITransport, with its lifespan) against a fresh
+# database: a temporary SQLite file by default, or --database-url, which must point to an
+# EMPTY database since it is filled with synthetic data (see benchmarks/synthetic.py).
+#
+# Every endpoint is driven with --requests requests, --concurrency at a time, after
+# --warmup requests. Reported per endpoint: throughput, p50/p95/p99 latency, and the peak
+# Python memory (tracemalloc) of a separate, smaller pass, so tracing doesn't skew the
+# latencies. /expMessages is timed until its background job completes.
+#
+# With --baseline, results are compared with a saved run and an endpoint whose p95 or
+# throughput is more than --tolerance worse, or whose error count or error rate went up,
+# is flagged (exit code 1 with --fail-on-regression). Baselines are only comparable on the same machine, database and scale.
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from benchmarks.synthetic import SCALES, SyntheticHierarchy, user_csv_chunks
+
+API = "/api/v1"
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class EndpointResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.rows = 0
+        self.errors = 0
+        self.first_error: Optional[str] = None
+        self.seconds = 0.0
+        self.peak_memory_kb: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        result = {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "throughput": round(len(latencies) / self.seconds, 2) if self.seconds else 0,
+            "p50_ms": percentile_ms(latencies, 50),
+            "p95_ms": percentile_ms(latencies, 95),
+            "p99_ms": percentile_ms(latencies, 99),
+            "peak_memory_kb": self.peak_memory_kb,
+        }
+        if self.rows:
+            result["rows_per_second"] = round(self.rows / self.seconds, 1) if self.seconds else 0
+        if self.first_error:
+            result["first_error"] = self.first_error
+        return result
+
+
+def percentile_ms(latencies: List[float], p: float) -> Optional[float]:
+    # Nearest-rank percentile of sorted latencies (seconds), in milliseconds
+    if not latencies:
+        return None
+    rank = max(0, min(len(latencies) - 1, round(p / 100 * len(latencies)) - 1))
+    return round(latencies[rank] * 1000, 2)
+
+
+def check(response, expected=(200,)):
+    if response.status_code not in expected:
+        raise BenchmarkError(f"{response.request.method} {response.request.url.path}: "
+                             f"{response.status_code} {response.text[:200]}")
+    return response
+
+
+async def measure(name: str, call: Callable[[], Awaitable[int]], requests: int, concurrency: int,
+                  warmup: int, memory_requests: int) -> EndpointResult:
+    # `call` performs one request and returns the number of rows it processed
+    result = EndpointResult(name)
+    for _ in range(warmup):
+        await call()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                rows = await call()
+            except Exception as e:
+                result.errors += 1
+                result.first_error = result.first_error or str(e)
+                return
+            result.latencies.append(time.perf_counter() - started)
+            result.rows += rows or 0
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    result.seconds = time.perf_counter() - started
+
+    if memory_requests:
+        tracemalloc.start()
+        try:
+            for _ in range(memory_requests):
+                await call()
+            result.peak_memory_kb = tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+async def one_shot(name: str, call: Callable[[], Awaitable[int]]) -> EndpointResult:
+    # A single large request (setup uploads), reported as rows per second
+    result = EndpointResult(name)
+    started = time.perf_counter()
+    result.rows = await call()
+    result.seconds = time.perf_counter() - started
+    result.latencies.append(result.seconds)
+    return result
+
+
+class Benchmark:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.hierarchy = SyntheticHierarchy(args.levels, args.branches)
+        self.branch_ids: List[int] = []
+        self.branch_paths: Dict[int, Dict[str, str]] = {}
+        self.user_ids: List[int] = []
+        self.reference_ids: List[int] = []
+        self.counter = itertools.count()
+
+    def options(self) -> dict:
+        return {
+            "requests": self.args.requests,
+            "concurrency": self.args.concurrency,
+            "warmup": self.args.warmup,
+            "memory_requests": self.args.memory_requests,
+        }
+
+    async def run(self) -> Dict[str, EndpointResult]:
+        results = {}
+        results["upload-branch-data/stream (setup)"] = await one_shot("upload", self.upload_hierarchy)
+        results["add-users/csv (setup)"] = await one_shot("users", self.upload_users)
+        await self.create_template()
+
+        send_options = dict(self.options(), requests=self.args.sends, warmup=min(self.args.warmup, 2))
+        results["POST /expMessages"] = await measure("send", self.send, **send_options)
+        results["GET /viewMessages"] = await measure("campaigns", self.view_messages, **self.options())
+        results["GET /viewMessages/{id}"] = await measure("campaign", self.view_message, **self.options())
+        results["GET /users/{user_id}"] = await measure("user", self.user_messages, **self.options())
+        results["POST /add-users"] = await measure("add-users", self.add_users, **self.options())
+        results["POST /upload-branch-data"] = await measure("upload", self.upload_branches, **self.options())
+        return results
+
+    # Setup
+
+    async def upload_hierarchy(self) -> int:
+        check(await self.client.post(
+            f"{API}/hierarchy/upload-branch-data/stream",
+            params={"format": "csv"},
+            content=aiter_chunks(self.hierarchy.csv_chunks()),
+            timeout=None,
+        ))
+        levels = check(await self.client.get(f"{API}/hierarchy/lvl-values")).json()
+        bottom = levels[f"lvl_{self.hierarchy.levels[-1].lower()}"]
+        self.branch_ids = [node["id"] for node in bottom]
+        return self.hierarchy.branches
+
+    async def upload_users(self) -> int:
+        response = check(await self.client.post(
+            f"{API}/users/add-users/csv",
+            content=aiter_chunks(user_csv_chunks(self.args.users, self.branch_ids)),
+            timeout=None,
+        )).json()
+        if response.get("rejected"):
+            raise BenchmarkError(f"users rejected: {response['rejected'][:3]}")
+        self.user_ids = list(range(1, response["inserted"] + 1))
+        return response["inserted"]
+
+    async def create_template(self):
+        check(await self.client.post(f"{API}/templates/", json={
+            "template_name": "bench",
+            "message_title": "Benchmark",
+            "message_content": "Hello {{username}}, your email is {{email}}",
+        }))
+
+    # Scenarios
+
+    async def send(self) -> int:
+        target = self.hierarchy.random_target(self.rng)
+        job = check(await self.client.post(f"{API}/expMessages/", json={
+            "template_name": "bench",
+            "message_title": f"Benchmark {next(self.counter)}",
+            "message_content": "Hello {{username}}, your email is {{email}}",
+            "target_level": target["target_level"],
+            "targets": [target["name"]],
+            "user_count": 0,
+        })).json()
+        while True:
+            status = check(await self.client.get(f"{API}/jobs/{job['job_id']}")).json()
+            if status["status"] == "completed":
+                self.reference_ids.append(status["details"]["reference_id"])
+                return status["details"]["exp_message_count"]
+            if status["status"] == "failed":
+                raise BenchmarkError(f"send failed: {status['errors']}")
+            await asyncio.sleep(0.005)
+
+    async def view_messages(self) -> int:
+        check(await self.client.get(f"{API}/viewMessages/", params={"limit": 10}))
+        return 0
+
+    async def view_message(self) -> int:
+        check(await self.client.get(f"{API}/viewMessages/{self.rng.choice(self.reference_ids)}"))
+        return 0
+
+    async def user_messages(self) -> int:
+        # Users without messages answer 404, which is a valid (and cheap) outcome
+        check(await self.client.get(f"{API}/users/{self.rng.choice(self.user_ids)}"), (200, 404))
+        return 0
+
+    async def add_users(self) -> int:
+        batch = next(self.counter)
+        users = [
+            {"username": f"bench{batch}x{i}", "email": f"bench{batch}x{i}@bench.example",
+             "role": "member", "btm_lvl_id": self.rng.choice(self.branch_ids)}
+            for i in range(self.args.batch_size)
+        ]
+        check(await self.client.post(f"{API}/users/add-users", json={"users": users}))
+        return len(users)
+
+    async def upload_branches(self) -> int:
+        # New bottom-most nodes under existing parents
+        batch = next(self.counter)
+        rows = []
+        for i in range(self.args.batch_size):
+            row = self.hierarchy.path(self.rng.randrange(self.hierarchy.branches))
+            row[self.hierarchy.levels[-1]] = f"{self.hierarchy.levels[-1]}-new{batch}x{i}"
+            rows.append(row)
+        check(await self.client.post(f"{API}/hierarchy/upload-branch-data",
+                                     json={"hierarchy": self.hierarchy.levels, "data": rows}))
+        return len(rows)
+
+
+async def aiter_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    # Endpoints clearly slower than the baseline (p95 up, or throughput down, by > tolerance),
+    # or failing more often than in it (any increase in error count or rate)
+    regressions = []
+    for name, result in current["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if not base:
+            continue
+        errors, base_errors = result["errors"], base.get("errors", 0)
+        rate, base_rate = error_rate(result), error_rate(base)
+        if errors > base_errors or rate > base_rate:
+            regressions.append(f"{name}: errors {base_errors} ({base_rate:.1%}) -> {errors} ({rate:.1%})")
+        if not result["requests"] or name.endswith("(setup)"):
+            continue
+        if base["p95_ms"] and result["p95_ms"] > base["p95_ms"] * (1 + tolerance) \
+                and result["p95_ms"] - base["p95_ms"] > 1:  # Ignore sub-millisecond noise
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {result['p95_ms']} ms")
+        if base["throughput"] and result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput']} -> {result['throughput']} req/s")
+    return regressions
+
+
+def error_rate(result: dict) -> float:
+    # Share of attempted requests that failed (`requests` counts only the successful ones)
+    attempted = result["requests"] + result.get("errors", 0)
+    return result.get("errors", 0) / attempted if attempted else 0.0
+
+
+def print_report(report: dict, baseline: Optional[dict]):
+    print(f"\n{report['meta']['database']} | scale {report['meta']['scale']} | "
+          f"max RSS {report['meta']['max_rss_mb']} MB")
+    header = f"{'endpoint':<36}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KB':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, result in report["endpoints"].items():
+        print(f"{name:<36}{result['throughput']:>10}{result['p50_ms'] or '-':>10}{result['p95_ms'] or '-':>10}"
+              f"{result['p99_ms'] or '-':>10}{result['peak_memory_kb'] or '-':>10}{result['errors']:>8}")
+        if "rows_per_second" in result:
+            print(f"{'':<36}{result['rows_per_second']:>10} rows/s")
+        if baseline and name in baseline["endpoints"]:
+            base = baseline["endpoints"][name]
+            print(f"{'  baseline':<36}{base['throughput']:>10}{base['p50_ms'] or '-':>10}"
+                  f"{base['p95_ms'] or '-':>10}{base['p99_ms'] or '-':>10}{base['peak_memory_kb'] or '-':>10}")
+        if result.get("first_error"):
+            print(f"  first error: {result['first_error']}")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot endpoints in-process.")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--levels", type=int, help="Hierarchy levels (default: from --scale)")
+    parser.add_argument("--branches", type=int, help="Bottom-most nodes (default: from --scale)")
+    parser.add_argument("--users", type=int, help="Users (default: from --scale)")
+    parser.add_argument("--database-url", help="Empty database to fill (default: temporary SQLite file)")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per endpoint")
+    parser.add_argument("--sends", type=int, default=30, help="Measured /expMessages sends")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--memory-requests", type=int, default=10, help="Requests traced for peak memory (0: off)")
+    parser.add_argument("--batch-size", type=int, default=20, help="Rows per /add-users and /upload-branch-data")
+    parser.add_argument("--no-response-cache", action="store_true", help="Measure GETs without the response cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Compare with this saved run")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+    for key, value in SCALES[args.scale].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args
+
+
+async def run(args) -> dict:
+    # The app reads its configuration at import time: environment first
+    from httpx import ASGITransport, AsyncClient
+    from main import app
+    from utils.database import DATABASE_URL
+    from sqlalchemy.engine import make_url
+
+    async with app.router.lifespan_context(app):
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = await Benchmark(client, args).run()
+
+    return {
+        "meta": {
+            "scale": args.scale,
+            "levels": args.levels,
+            "branches": args.branches,
+            "users": args.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "response_cache": not args.no_response_cache,
+            "database": make_url(DATABASE_URL).get_backend_name(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "revision": git_revision(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        "endpoints": {name: result.to_dict() for name, result in results.items()},
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{directory}/bench.db"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ.setdefault("SLOW_QUERY_MS", "1000000")  # No slow-query logging while measuring
+        if args.no_response_cache:
+            os.environ["RESPONSE_CACHE_SIZE"] = "0"
+            os.environ["RESPONSE_CACHE_TTL"] = "0"
+        report = asyncio.run(run(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+
+    if baseline is None:
+        return 0
+    if (baseline["meta"]["database"], baseline["meta"]["scale"]) != (report["meta"]["database"], report["meta"]["scale"]):
+        print("\nwarning: the baseline was measured on another database or scale")
+    regressions = compare(report, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"\nno regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# Synthetic data for the benchmarks: a balanced hierarchy and users spread over its
+# bottom-most nodes. Everything is generated lazily, as CSV chunks for the streaming
+# upload endpoints, so the large scale (1M users) stays cheap in memory.
+import math
+import random
+from typing import Dict, Iterator, List
+
+# Presets for --scale; every value can be overridden on the command line
+SCALES = {
+    "small": {"levels": 3, "branches": 500, "users": 5_000},
+    "medium": {"levels": 4, "branches": 5_000, "users": 100_000},
+    "large": {"levels": 5, "branches": 50_000, "users": 1_000_000},
+}
+
+LEVEL_NAMES = ["Region", "Zone", "Area", "Cluster", "Branch"]
+CHUNK_ROWS = 5000
+
+
+class SyntheticHierarchy:
+    # `branches` bottom-most nodes under `levels` levels, every parent with `fanout` children
+    def __init__(self, levels: int, branches: int):
+        if levels <= len(LEVEL_NAMES):
+            self.levels = LEVEL_NAMES[-levels:]
+        else:
+            self.levels = [f"Level{i + 1}" for i in range(levels - 1)] + ["Branch"]
+        self.branches = branches
+        self.fanout = max(2, math.ceil(branches ** (1 / levels)))
+        # Nodes per level, top-down
+        self.counts = [math.ceil(branches / self.fanout ** (levels - 1 - i)) for i in range(levels)]
+
+    def node_name(self, level: int, index: int) -> str:
+        return f"{self.levels[level]}-{index}"
+
+    def path(self, branch: int) -> Dict[str, str]:
+        # One upload row: the names of a bottom-most node and all of its ancestors
+        depth = len(self.levels)
+        return {
+            self.levels[level]: self.node_name(level, branch // self.fanout ** (depth - 1 - level))
+            for level in range(depth)
+        }
+
+    def rows(self) -> Iterator[Dict[str, str]]:
+        for branch in range(self.branches):
+            yield self.path(branch)
+
+    def csv_chunks(self) -> Iterator[bytes]:
+        yield (",".join(self.levels) + "\n").encode()
+        for start in range(0, self.branches, CHUNK_ROWS):
+            lines = (
+                ",".join(self.path(branch).values())
+                for branch in range(start, min(start + CHUNK_ROWS, self.branches))
+            )
+            yield ("\n".join(lines) + "\n").encode()
+
+    def random_target(self, rng: random.Random) -> Dict[str, str]:
+        # A node one level above the bottom (about `fanout` branches of users)
+        level = max(0, len(self.levels) - 2)
+        return {"target_level": self.levels[level], "name": self.node_name(level, rng.randrange(self.counts[level]))}
+
+
+def user_csv_chunks(count: int, branch_ids: List[int], prefix: str = "user") -> Iterator[bytes]:
+    # Users spread evenly over the bottom-most nodes (ids as returned by /lvl-values)
+    yield b"username,email,role,btm_lvl_id\n"
+    for start in range(0, count, CHUNK_ROWS):
+        lines = (
+            f"{prefix}{n},{prefix}{n}@bench.example,member,{branch_ids[n % len(branch_ids)]}"
+            for n in range(start, min(start + CHUNK_ROWS, count))
+        )
+        yield ("\n".join(lines) + "\n").encode()
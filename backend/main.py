@@ -1,11 +1,79 @@
+from utils.bootstrap import boot_timer, setup_schema, FirstRequestMiddleware
+from utils.observability import configure_logging, install_query_events, RequestMetricsMiddleware
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from api.hierarchy import router as hierarchy
 from api.user_router import router as user_router
 from api.template_router import router as template_router
-from api.exp_messages import router as exp_messages
+from api.exp_messages import router as exp_messages, ScheduledSend
 from api.view_messages import router as view_messages
-app = FastAPI()
+from api.metrics import router as metrics
+from api.jobs import router as jobs
+from api.push import router as push
+from utils.template_store import templates
+from utils.campaign_scheduler import campaign_schedule, campaign_scheduler
+from utils.hierarchy_targets import reference_targets
+from utils.database import engine, run_db
+from utils.jobs import jobs as job_registry, job_queue, job_rows
+from utils.push import push_hub
+from utils.read_receipts import read_receipts
+from utils.hierarchy_tree import hierarchy_tree
+from utils.template_store import template_usage
+from utils.partitions import maintain_partitions, PARTITION_CHECK_INTERVAL
+from utils.http_cache import ConditionalCacheMiddleware
+from utils.data_versions import CACHED_ROUTES
+import asyncio
+import logging
+
+configure_logging()  # LOG_LEVEL, default INFO
+boot_timer.mark("imports")
+
+
+# Create next months' exp_message partitions (and drop expired ones) in the background
+async def partition_maintenance():
+    while True:
+        await asyncio.sleep(PARTITION_CHECK_INTERVAL)
+        try:
+            await run_db(maintain_partitions)
+        except Exception:
+            logging.exception('exp_message partition maintenance failed')
+
+
+# Worker startup and shutdown: schema first, then the background services
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    install_query_events(engine)  # DB time per request and slow-query log
+
+    # Reflect the database once per worker instead of on every request
+    await run_db(setup_schema, [templates, campaign_schedule, reference_targets, job_rows])
+    boot_timer.mark("schema")
+    await run_db(hierarchy_tree.reload)  # Warm the dropdown data before the first request
+
+    await job_registry.start()  # Job status written to the `jobs` table
+    await job_queue.start()  # Background workers for message sends
+    await read_receipts.start()  # Batched read receipts, flushed on shutdown
+    await template_usage.start()  # Batched template use counts, flushed on shutdown
+    await push_hub.start()  # Push channel (LISTEN/NOTIFY across workers on Postgres)
+    await campaign_scheduler.start(ScheduledSend())  # Due scheduled campaigns, paced by their rate
+    partition_task = asyncio.create_task(partition_maintenance())
+    boot_timer.mark("ready")
+    try:
+        yield
+    finally:
+        partition_task.cancel()
+        await campaign_scheduler.stop()  # Hands a campaign being sent back to the other workers
+        await job_queue.stop()  # Running sends finish, queued ones stay in the table
+        await job_registry.stop()
+        await read_receipts.stop()
+        await template_usage.stop()
+        await push_hub.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# ETag / 304 and a short-lived response cache for the polled GET endpoints
+app.add_middleware(ConditionalCacheMiddleware, rules=CACHED_ROUTES)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,9 +83,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Time to first request, see /metrics/boot
+app.add_middleware(FirstRequestMiddleware)
+
+# Latency and DB time per route, slow queries, profiles (outermost: sees every response)
+app.add_middleware(RequestMetricsMiddleware)
+
 # Include the routers for different APIs
 app.include_router(hierarchy,prefix='/api/v1/hierarchy')
 app.include_router(user_router,prefix='/api/v1/users')
 app.include_router(template_router,prefix='/api/v1/templates')
 app.include_router(exp_messages,prefix='/api/v1/expMessages')
 app.include_router(view_messages,prefix='/api/v1/viewMessages')
+app.include_router(metrics,prefix='/api/v1/metrics')
+app.include_router(jobs,prefix='/api/v1/jobs')
+app.include_router(push,prefix='/api/v1/push')
@@ -0,0 +1,65 @@
+# Job rows: a periodic flush must never undo a completion committed with the job's work.
+#
+#   cd backend
+#   python -m pytest tests
+import copy
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from utils.jobs import Job, job_rows, insert_job, claim_job, complete_in, write_jobs
+
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}")
+    job_rows.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def status_of(session, job):
+    return session.execute(select(job_rows.c.status).where(job_rows.c.id == job.id)).scalar()
+
+
+def running_job(session):
+    job = Job("message-send", payload={"user_count": 1})
+    insert_job(session, job)
+    assert claim_job(session, job.id)
+    job.start()
+    return job
+
+
+def test_stale_running_flush_after_complete_in_keeps_completed(session):
+    job = running_job(session)
+    stale = copy.copy(job)  # What a flush captured before the send committed
+    stale.progress(10)
+
+    complete_in(session, job, {"reference_id": 1})
+    session.commit()
+
+    write_jobs(session, [stale])
+    assert status_of(session, job) == "completed"
+
+
+def test_flush_updates_running_job(session):
+    job = running_job(session)
+    job.progress(5)
+    write_jobs(session, [job])
+    row = session.execute(select(job_rows).where(job_rows.c.id == job.id)).first()
+    assert (row.status, row.rows) == ("running", 5)
+    assert row.heartbeat_at is not None
+
+    job.fail("boom")
+    write_jobs(session, [job])
+    assert status_of(session, job) == "failed"
+
+
+def test_complete_in_refuses_a_finished_job(session):
+    job = running_job(session)
+    complete_in(session, job)
+    session.commit()
+    with pytest.raises(RuntimeError):
+        complete_in(session, job)
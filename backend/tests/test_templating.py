@@ -0,0 +1,132 @@
+# Template compiler: placeholders, filters, defaults and the compiled-template cache.
+#
+#   cd backend
+#   python -m pytest tests
+from datetime import date, datetime
+
+import pytest
+
+from utils.templating import CompiledTemplate, TemplateCache, TemplateError
+
+
+def render(content, **values):
+    return CompiledTemplate(content).render(values)
+
+
+# Placeholders
+
+def test_plain_placeholders():
+    assert render("Hi {{username}} ({{ email }})", username="a", email="a@x.com") == "Hi a (a@x.com)"
+
+
+def test_missing_value_renders_placeholder_source():
+    assert render("Hi {{nickname}}!") == "Hi {{nickname}}!"
+    assert render("Hi {{nickname | upper}}!") == "Hi {{nickname | upper}}!"
+
+
+def test_variables_in_order_without_duplicates():
+    compiled = CompiledTemplate("{{b}} {{a}} {{b | upper}}")
+    assert compiled.variables == ["b", "a"]
+    assert compiled.unknown_variables(["a"]) == ["b"]
+
+
+# Filters
+
+@pytest.mark.parametrize("content, expected", [
+    ("{{name | upper}}", "JANE DOE"),
+    ("{{name | lower}}", "jane doe"),
+    ("{{name | title}}", "Jane Doe"),
+    ("{{name | capitalize}}", "Jane doe"),
+    ("{{padded | trim}}", "x"),
+    ("{{padded | trim | upper}}", "X"),
+])
+def test_filters(content, expected):
+    assert render(content, name="jAne dOE", padded="  x  ") == expected
+
+
+def test_date_filter():
+    created = datetime(2024, 3, 5, 14, 30)
+    assert render("{{created | date}}", created=created) == "05/03/2024"
+    assert render('{{created | date:"%Y-%m-%d %H:%M"}}', created=created) == "2024-03-05 14:30"
+    assert render('{{created | date:"%Y"}}', created=date(2024, 3, 5)) == "2024"
+    # SQLite returns ISO strings; anything else is left as is
+    assert render("{{created | date}}", created="2024-03-05T14:30:00") == "05/03/2024"
+    assert render("{{created | date}}", created="soon") == "soon"
+
+
+def test_unknown_filter_is_an_error():
+    with pytest.raises(TemplateError):
+        CompiledTemplate("{{username | shout}}")
+
+
+# default:
+
+def test_default_used_when_value_missing():
+    assert render('{{role | default:"member"}}') == "member"
+    assert render('{{role | default:"member"}}', role=None) == "member"
+    assert render('{{role | default:"member"}}', role="admin") == "admin"
+
+
+def test_default_goes_through_the_other_filters():
+    assert render('{{role | default:"member" | upper}}') == "MEMBER"
+
+
+@pytest.mark.parametrize("value, expected", [(0, "0"), (False, "False"), ("", "")])
+def test_falsy_values_are_not_replaced_by_default(value, expected):
+    assert render('{{count | default:"none"}}', count=value) == expected
+    assert render("{{count}}", count=value) == expected
+
+
+# Malformed placeholders
+
+@pytest.mark.parametrize("content, malformed", [
+    ("Hi {{username | Upper}}", ["{{username | Upper}}"]),
+    ("Hi {{user-name}}", ["{{user-name}}"]),
+    ("Hi {{username}", ["{{"]),
+    ("Hi username}}", ["}}"]),
+    ("Hi {{ {{username}} }}", ["{{", "}}"]),
+    ("Hi {{username}} and {{ email | lower }}", []),
+    ("No placeholders at all", []),
+])
+def test_malformed_placeholders(content, malformed):
+    assert CompiledTemplate(content).malformed_placeholders() == malformed
+
+
+# Cache
+
+def test_cache_returns_the_same_compiled_template():
+    cache = TemplateCache()
+    assert cache.get("Hi {{username}}", 1) is cache.get("Hi {{username}}", 1)
+
+
+def test_cache_key_includes_id_and_content():
+    cache = TemplateCache()
+    first = cache.get("Hi {{username}}", 1)
+    # Same id, edited content: compiled again
+    edited = cache.get("Hello {{username}}", 1)
+    assert edited is not first
+    assert edited.render({"username": "a"}) == "Hello a"
+    # Same content under another id (or none) is its own entry
+    assert cache.get("Hi {{username}}", 2) is not first
+    assert cache.get("Hi {{username}}") is not first
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TemplateCache(max_size=2)
+    a = cache.get("a", 1)
+    b = cache.get("b", 2)
+    assert cache.get("a", 1) is a  # a is now the most recent
+    cache.get("c", 3)  # evicts b
+    assert cache.get("a", 1) is a
+    assert cache.get("b", 2) is not b
+
+
+def test_cache_discard_forgets_every_version_of_a_template():
+    cache = TemplateCache()
+    v1 = cache.get("v1", 1)
+    v2 = cache.get("v2", 1)
+    other = cache.get("v1", 2)
+    cache.discard(1)
+    assert cache.get("v1", 1) is not v1
+    assert cache.get("v2", 1) is not v2
+    assert cache.get("v1", 2) is other
@@ -0,0 +1,97 @@
+# Worker bootstrap: everything that needs the database runs here, once per worker, from
+# the FastAPI lifespan (see main.py) -- never at import time.
+#
+# DDL (tables, indexes, partitions) runs under a Postgres advisory lock, so workers
+# starting together create the schema one after the other instead of racing; the ones
+# that wait find everything in place and only reflect it. Boot phases are timed
+# (imports, schema, services, first request), logged and exposed at /metrics/boot.
+from contextlib import contextmanager
+from sqlalchemy import text
+import logging
+import os
+import time
+
+from utils.campaign_stats import ensure_stats_table
+from utils.db_lock import db_sleep
+from utils.hierarchy_closure import ensure_closure_table
+from utils.indexes import ensure_indexes, verify_indexes
+from utils.message_tables import ensure_message_tables
+from utils.partitions import maintain_partitions
+from utils.schema_registry import registry
+
+# Any constant shared by all workers of the deployment
+BOOTSTRAP_LOCK_KEY = int(os.getenv("BOOTSTRAP_LOCK_KEY", "720240117"))
+# Seconds between two attempts of a worker waiting for the lock
+BOOTSTRAP_LOCK_POLL = float(os.getenv("BOOTSTRAP_LOCK_POLL", "0.2"))
+
+
+class BootTimer:
+    # Seconds since the bootstrap module was imported (first import of main.py)
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase: str):
+        if phase not in self.phases:
+            self.phases[phase] = round(time.perf_counter() - self.started, 4)
+            logging.info(f'boot: {phase} after {self.phases[phase]}s (pid {os.getpid()})')
+
+    def report(self) -> dict:
+        return {"pid": os.getpid(), "phases": dict(self.phases)}
+
+
+@contextmanager
+def bootstrap_lock(session):
+    # Session-level advisory lock on a dedicated connection: the session commits between
+    # DDL steps and may get a different pooled connection each time.
+    # Waiting workers poll with pg_try_advisory_lock, outside any transaction: a backend
+    # blocked in pg_advisory_lock holds a snapshot, and the CREATE INDEX CONCURRENTLY run
+    # by the lock holder would wait for it (a deadlock). No statement_timeout applies.
+    engine = session.get_bind()
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text("SET statement_timeout = 0"))
+        waited = time.perf_counter()
+        while not connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": BOOTSTRAP_LOCK_KEY}).scalar():
+            db_sleep(BOOTSTRAP_LOCK_POLL)
+        logging.info(f'bootstrap lock acquired in {time.perf_counter() - waited:.3f}s')
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": BOOTSTRAP_LOCK_KEY})
+            connection.execute(text("RESET statement_timeout"))
+
+
+def setup_schema(session, tables=()):
+    # Reflect the database once per worker and create whatever is missing
+    with bootstrap_lock(session):
+        registry.setup(session)
+        registry.ensure_tables(session, list(tables))
+        ensure_message_tables(session)  # Once a hierarchy exists; sends never create tables
+        ensure_stats_table(session)
+        ensure_closure_table(session)
+        ensure_indexes(session, concurrently=True)  # Existing tables stay writable
+        for index in verify_indexes(session):
+            if index["status"] not in ("ok", "table missing"):
+                logging.warning(f'index {index["name"]} on {index["table"]}: {index["status"]}')
+        maintain_partitions(session)
+
+
+class FirstRequestMiddleware:
+    # Records when this worker answered its first HTTP request, then gets out of the way
+    def __init__(self, app, timer: BootTimer = None):
+        self.app = app
+        self.timer = timer or boot_timer
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+        if scope["type"] == "http" and "first request" not in self.timer.phases:
+            self.timer.mark("first request")
+
+
+# Started as soon as main.py imports it
+boot_timer = BootTimer()
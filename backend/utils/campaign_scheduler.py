@@ -0,0 +1,359 @@
+# Scheduled and rate-limited campaign sends.
+#
+# POST /api/v1/expMessages with `send_at` and/or `rate` (messages per second) stores the
+# campaign in `campaign_schedule` instead of sending it at once. Every worker runs a
+# CampaignScheduler that polls for due campaigns every SCHEDULER_POLL_INTERVAL seconds
+# and claims one at a time with SELECT ... FOR UPDATE SKIP LOCKED, so a campaign is sent
+# by a single worker.
+#
+# A claimed campaign is written page by page in users.id order; each page is committed
+# together with the campaign's progress (last_user_id, sent_count, heartbeat_at). Pages
+# are paced by a token bucket refilled at `rate`, about one page per second. A restarted
+# campaign resumes after last_user_id: a clean shutdown hands the claim back at once,
+# after a crash another worker takes over when the heartbeat is SCHEDULER_STALE_SECONDS
+# old. A worker that lost its claim (cancelled, taken over) rolls its page back.
+#
+# The send itself (targets, template, messages, push) lives in api/exp_messages.py and is
+# passed to start() as `steps`. SQLite ignores FOR UPDATE: run a single worker there.
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlalchemy import MetaData, Table, Column, Index, Integer, Float, String, Text, DateTime
+from sqlalchemy import select, update, func, and_, or_
+from typing import Optional
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+from utils.database import run_db
+from utils.fanout import FANOUT_BATCH_SIZE
+from utils.pagination import encode_cursor, decode_cursor
+
+# Seconds between looks for due campaigns
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "5"))
+# A running campaign without progress for this long is taken over by another worker
+SCHEDULER_STALE_SECONDS = float(os.getenv("SCHEDULER_STALE_SECONDS", "60"))
+# Longest wait between heartbeats of a slow campaign (keep well under the above)
+SCHEDULER_HEARTBEAT = float(os.getenv("SCHEDULER_HEARTBEAT", "15"))
+# After an unexpected error the campaign is retried this much later, up to N times
+SCHEDULER_RETRY_DELAY = float(os.getenv("SCHEDULER_RETRY_DELAY", "30"))
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "5"))
+
+ACTIVE_STATUSES = ("scheduled", "running")
+
+metadata = MetaData()
+
+# Created at startup, see utils/bootstrap.py
+campaign_schedule = Table(
+    "campaign_schedule",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("status", String(20), nullable=False, default="scheduled"),  # scheduled/running/completed/failed/cancelled
+    Column("send_at", DateTime, nullable=False),
+    Column("rate", Float, nullable=True),  # Messages per second (NULL: as fast as possible)
+    Column("payload", Text, nullable=False),  # The POST body (ReferenceDataInput) as JSON
+    Column("reference_id", Integer, nullable=True),  # Set when the send starts
+    Column("total", Integer, nullable=True),  # Recipients, counted when the send starts
+    Column("sent_count", Integer, nullable=False, default=0),
+    Column("last_user_id", Integer, nullable=False, default=0),  # Resume point (users.id)
+    Column("attempts", Integer, nullable=False, default=0),  # Failed attempts so far
+    Column("error", Text, nullable=True),
+    Column("claimed_by", String(100), nullable=True),  # host:pid of the sending worker
+    Column("heartbeat_at", DateTime, nullable=True),
+    Column("created_at", DateTime, default=datetime.now),
+    Column("started_at", DateTime, nullable=True),
+    Column("finished_at", DateTime, nullable=True),
+    Index("ix_campaign_schedule_due", "status", "send_at"),
+)
+
+
+def campaign_to_dict(row) -> dict:
+    campaign = row._asdict()
+    campaign["payload"] = json.loads(campaign["payload"])
+    campaign.pop("claimed_by", None)
+    total, sent, rate = campaign["total"], campaign["sent_count"], campaign["rate"]
+    campaign["progress"] = round(100 * sent / total, 1) if total else None
+    campaign["eta_seconds"] = (
+        round((total - sent) / rate, 1)
+        if rate and total is not None and campaign["status"] in ACTIVE_STATUSES else None
+    )
+    for key in ("send_at", "heartbeat_at", "created_at", "started_at", "finished_at"):
+        if campaign[key] is not None:
+            campaign[key] = campaign[key].isoformat()
+    return campaign
+
+
+def page_size(rate: Optional[float]) -> int:
+    # About one second of sending per page, at most a fan-out batch
+    if not rate:
+        return FANOUT_BATCH_SIZE
+    return max(1, min(FANOUT_BATCH_SIZE, int(rate)))
+
+
+class TokenBucket:
+    # `rate` tokens per second, at most `capacity` saved up (starts full)
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, tokens: int) -> float:
+        # Seconds until `tokens` are available
+        self._refill()
+        return max(0.0, (min(tokens, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, tokens: int):
+        self._refill()
+        self.tokens -= tokens
+
+
+# Campaign rows (called through run_db)
+
+def schedule_campaign(session, payload: dict, send_at: Optional[datetime], rate: Optional[float]) -> dict:
+    now = datetime.now()
+    if send_at is not None and send_at.tzinfo is not None:
+        send_at = send_at.astimezone().replace(tzinfo=None)  # Stored in server local time
+    result = session.execute(campaign_schedule.insert().values(
+        status="scheduled", send_at=send_at or now, rate=rate, payload=json.dumps(payload), created_at=now,
+    ))
+    session.commit()
+    return load_campaign(session, result.inserted_primary_key[0])
+
+
+def load_campaign(session, campaign_id: int) -> dict:
+    row = session.execute(select(campaign_schedule).where(campaign_schedule.c.id == campaign_id)).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Scheduled campaign not found")
+    return campaign_to_dict(row)
+
+
+def load_campaigns(session, status: Optional[str] = None, limit: int = 20, cursor: Optional[str] = None) -> dict:
+    # Newest first, keyset paginated on id
+    c = campaign_schedule.c
+    query = select(campaign_schedule).order_by(c.id.desc()).limit(limit + 1)
+    if status:
+        query = query.where(c.status == status)
+    if cursor:
+        last_id, = decode_cursor(cursor, int)
+        query = query.where(c.id < last_id)
+
+    rows = [campaign_to_dict(row) for row in session.execute(query)]
+    next_cursor = encode_cursor(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return {"campaigns": rows[:limit], "next_cursor": next_cursor}
+
+
+def cancel_campaign(session, campaign_id: int) -> dict:
+    # A running campaign stops before its next page (its worker sees the status change)
+    c = campaign_schedule.c
+    result = session.execute(
+        update(campaign_schedule)
+        .where(c.id == campaign_id, c.status.in_(ACTIVE_STATUSES))
+        .values(status="cancelled", finished_at=datetime.now())
+    )
+    session.commit()
+    campaign = load_campaign(session, campaign_id)
+    if not result.rowcount:
+        raise HTTPException(status_code=409, detail=f"Campaign is already {campaign['status']}")
+    return campaign
+
+
+def claim_campaign(session, worker_id: str):
+    # The next due campaign, or a running one whose worker went away
+    now = datetime.now()
+    c = campaign_schedule.c
+    due = (
+        select(c.id)
+        .where(or_(
+            and_(c.status == "scheduled", c.send_at <= now),
+            and_(c.status == "running", c.heartbeat_at < now - timedelta(seconds=SCHEDULER_STALE_SECONDS)),
+        ))
+        .order_by(c.send_at, c.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    campaign_id = session.execute(due).scalar()
+    if campaign_id is None:
+        session.rollback()
+        return None
+
+    session.execute(
+        update(campaign_schedule)
+        .where(c.id == campaign_id)
+        .values(status="running", claimed_by=worker_id, heartbeat_at=now, started_at=func.coalesce(c.started_at, now))
+    )
+    campaign = session.execute(select(campaign_schedule).where(c.id == campaign_id)).first()
+    session.commit()
+    return campaign
+
+
+def _update_claimed(session, campaign_id: int, worker_id: str, **values) -> bool:
+    # Only while this worker still holds the campaign; the caller commits or rolls back
+    c = campaign_schedule.c
+    result = session.execute(
+        update(campaign_schedule)
+        .where(c.id == campaign_id, c.status == "running", c.claimed_by == worker_id)
+        .values(**values)
+    )
+    return bool(result.rowcount)
+
+
+def start_campaign(session, campaign, worker_id: str, steps):
+    # Resolve the send; on the first claim its reference row is committed with the campaign
+    plan = steps.prepare(session, json.loads(campaign.payload), campaign.reference_id)
+    if campaign.reference_id is None:
+        if not _update_claimed(session, campaign.id, worker_id, reference_id=plan.reference_id, total=plan.total,
+                               heartbeat_at=datetime.now()):
+            session.rollback()
+            return None
+        session.commit()
+    return plan
+
+
+def send_page(session, campaign_id: int, worker_id: str, steps, plan, after_user_id: int, limit: int):
+    # One page and the campaign's progress in one transaction; a short page is the last.
+    # Returns (messages written, last user id, completed); None when the claim was lost.
+    count, last_user_id = steps.write_page(session, plan, after_user_id, limit)
+    now = datetime.now()
+    completed = count < limit
+    values = {"heartbeat_at": now}
+    if count:
+        values.update(last_user_id=last_user_id, sent_count=campaign_schedule.c.sent_count + count)
+    if completed:
+        values.update(status="completed", finished_at=now)
+    if not _update_claimed(session, campaign_id, worker_id, **values):
+        session.rollback()
+        return None
+    session.commit()
+
+    if count:
+        steps.page_sent(session, plan, after_user_id, last_user_id)
+    if completed:
+        steps.finished(session, plan)
+    return count, last_user_id, completed
+
+
+def heartbeat(session, campaign_id: int, worker_id: str) -> bool:
+    claimed = _update_claimed(session, campaign_id, worker_id, heartbeat_at=datetime.now())
+    session.commit()
+    return claimed
+
+
+def fail_campaign(session, campaign_id: int, worker_id: str, error: str):
+    _update_claimed(session, campaign_id, worker_id, status="failed", error=error, finished_at=datetime.now())
+    session.commit()
+
+
+def release_campaign(session, campaign_id: int, worker_id: str, error: Optional[str] = None):
+    # Hand the campaign back: at once on shutdown, SCHEDULER_RETRY_DELAY later after an error
+    values = {"status": "scheduled", "claimed_by": None}
+    if error is not None:
+        attempts = session.execute(
+            select(campaign_schedule.c.attempts).where(campaign_schedule.c.id == campaign_id)
+        ).scalar() or 0
+        values.update(attempts=attempts + 1, error=error)
+        if attempts + 1 >= SCHEDULER_MAX_ATTEMPTS:
+            values.update(status="failed", finished_at=datetime.now())
+        else:
+            values["send_at"] = datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+    _update_claimed(session, campaign_id, worker_id, **values)
+    session.commit()
+
+
+class CampaignScheduler:
+    def __init__(self, poll_interval: float = SCHEDULER_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.steps = None  # See api/exp_messages.ScheduledSend
+        self.current = None  # id of the campaign being sent by this worker
+        self.sent = 0  # Messages sent by this worker
+        self._task = None
+
+    async def start(self, steps):
+        self.steps = steps
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.current is not None:
+            # Resume right away in the next worker instead of waiting for the heartbeat to expire
+            try:
+                await run_db(release_campaign, self.current, self.worker_id)
+            except Exception:
+                logging.exception(f'scheduler: releasing campaign {self.current} failed')
+            self.current = None
+
+    async def _run(self):
+        while True:
+            try:
+                campaign = await run_db(claim_campaign, self.worker_id)
+            except Exception:
+                logging.exception('scheduler: looking for due campaigns failed')
+                campaign = None
+            if campaign is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            self.current = campaign.id  # Left set when cancelled, for stop()
+            try:
+                await self._send(campaign)
+            except Exception:
+                # Not even recorded: another worker takes it over once the heartbeat is stale
+                logging.exception(f'scheduler: campaign {campaign.id} failed')
+            self.current = None
+
+    async def _send(self, campaign):
+        try:
+            await self._send_pages(campaign)
+        except HTTPException as e:
+            # Invalid targets or template: retrying will not help
+            logging.warning(f'scheduler: campaign {campaign.id} failed: {e.detail}')
+            await run_db(fail_campaign, campaign.id, self.worker_id, str(e.detail))
+        except Exception as e:
+            logging.exception(f'scheduler: campaign {campaign.id} failed, retrying in {SCHEDULER_RETRY_DELAY}s')
+            await run_db(release_campaign, campaign.id, self.worker_id, str(e))
+
+    async def _send_pages(self, campaign):
+        plan = await run_db(start_campaign, campaign, self.worker_id, self.steps)
+        if plan is None:
+            return
+        logging.info(f'scheduler: sending campaign {campaign.id} (reference {plan.reference_id}) '
+                     f'after user {campaign.last_user_id}, rate {campaign.rate or "unlimited"}')
+
+        size = page_size(campaign.rate)
+        bucket = TokenBucket(campaign.rate, size) if campaign.rate else None
+        last_user_id = campaign.last_user_id
+        while True:
+            if bucket is not None:
+                wait = bucket.wait_time(size)
+                while wait > 0:
+                    await asyncio.sleep(min(wait, SCHEDULER_HEARTBEAT))
+                    if wait > SCHEDULER_HEARTBEAT and not await run_db(heartbeat, campaign.id, self.worker_id):
+                        return
+                    wait = bucket.wait_time(size)
+
+            page = await run_db(send_page, campaign.id, self.worker_id, self.steps, plan, last_user_id, size)
+            if page is None:
+                logging.info(f'scheduler: campaign {campaign.id} was cancelled or taken over')
+                return
+            count, last_user_id, completed = page
+            self.sent += count
+            if completed:
+                logging.info(f'scheduler: campaign {campaign.id} completed')
+                return
+            if bucket is not None:
+                bucket.take(count)
+
+
+# Shared scheduler for the whole process
+campaign_scheduler = CampaignScheduler()
@@ -0,0 +1,142 @@
+# Per-campaign delivery/read counters, one row per reference_table id.
+#
+# The row is written with the messages of a send and bumped when a message is first
+# marked read, always in the same transaction, so reading the stats never has to scan
+# `exp_message`. Campaigns sent before the table existed are backfilled at startup, in
+# batches of reference ids (see `backfill`).
+from sqlalchemy import MetaData, Table, Column, Integer, DateTime, select, func, case, exists
+from datetime import datetime
+from typing import List, Optional
+import logging
+import os
+
+from utils.schema_registry import registry
+
+# Reference ids per backfill batch (one transaction each)
+BACKFILL_BATCH = int(os.getenv("CAMPAIGN_STATS_BACKFILL_BATCH", "500"))
+
+metadata = MetaData()
+
+campaign_stats = Table(
+    "campaign_stats",
+    metadata,
+    Column("reference_id", Integer, primary_key=True),  # reference_table.id
+    Column("sent_count", Integer, nullable=False, default=0),
+    Column("read_count", Integer, nullable=False, default=0),
+    Column("first_sent_time", DateTime, nullable=True),
+    Column("first_read_time", DateTime, nullable=True),
+    Column("last_read_time", DateTime, nullable=True),
+)
+
+
+def ensure_stats_table(session) -> bool:
+    # Create the table, then fill it from the messages sent before it existed. Checked on
+    # every start, so an interrupted backfill is resumed.
+    created = registry.ensure_tables(session, [campaign_stats])
+    schema = registry.snapshot(session)
+    if schema.has_table("exp_message") and schema.has_table("reference_table") and (created or backfill_pending(session)):
+        backfill(session)
+    return created
+
+
+def backfill_pending(session) -> bool:
+    # A campaign with messages but no stats row (every send writes one with its messages)
+    schema = registry.snapshot(session)
+    reference_table = schema.table("reference_table")
+    exp_message = schema.table("exp_message")
+    query = (
+        select(reference_table.c.id)
+        .where(~exists().where(campaign_stats.c.reference_id == reference_table.c.id))
+        .where(exists().where(exp_message.c.reference_id == reference_table.c.id))
+        .limit(1)
+    )
+    return session.execute(query).first() is not None
+
+
+def backfill(session) -> int:
+    # One GROUP BY per range of BACKFILL_BATCH reference ids, committed separately: each
+    # statement stays short (statement_timeout) and the work done survives an interruption
+    schema = registry.snapshot(session)
+    exp_message = schema.table("exp_message")
+    reference_table = schema.table("reference_table")
+    first_id, last_id = session.execute(select(func.min(reference_table.c.id), func.max(reference_table.c.id))).one()
+    if first_id is None:
+        return 0
+
+    read = exp_message.c.read_status == "read"
+    filled = 0
+    for start in range(first_id, last_id + 1, BACKFILL_BATCH):
+        counts = (
+            select(
+                exp_message.c.reference_id,
+                func.count(),
+                func.count(case((read, 1))),
+                func.min(exp_message.c.sent_time),
+                func.min(case((read, exp_message.c.msg_read_time))),
+                func.max(case((read, exp_message.c.msg_read_time))),
+            )
+            .where(exp_message.c.reference_id >= start, exp_message.c.reference_id < start + BACKFILL_BATCH)
+            .where(~exists().where(campaign_stats.c.reference_id == exp_message.c.reference_id))
+            .group_by(exp_message.c.reference_id)
+        )
+        filled += session.execute(campaign_stats.insert().from_select(
+            ["reference_id", "sent_count", "read_count", "first_sent_time", "first_read_time", "last_read_time"],
+            counts,
+        )).rowcount
+        session.commit()
+
+    logging.info(f'campaign_stats backfill: {filled} campaigns (reference ids {first_id}-{last_id})')
+    return filled
+
+
+def record_sent(session, reference_id: int, sent_count: int, sent_time: datetime):
+    # Part of the send transaction; the caller commits
+    session.execute(campaign_stats.insert().values(
+        reference_id=reference_id, sent_count=sent_count, read_count=0, first_sent_time=sent_time,
+    ))
+
+
+def add_sent(session, reference_id: int, count: int):
+    # A scheduled send writes its messages page by page; the caller commits
+    session.execute(
+        campaign_stats.update()
+        .where(campaign_stats.c.reference_id == reference_id)
+        .values(sent_count=campaign_stats.c.sent_count + count)
+    )
+
+
+def record_reads(session, reference_id: int, count: int, first_read: datetime, last_read: Optional[datetime] = None):
+    # `count` messages of the reference went from unread to read; the caller commits
+    last_read = last_read or first_read
+    session.execute(
+        campaign_stats.update()
+        .where(campaign_stats.c.reference_id == reference_id)
+        .values(
+            read_count=campaign_stats.c.read_count + count,
+            first_read_time=func.coalesce(campaign_stats.c.first_read_time, first_read),
+            last_read_time=case(
+                (campaign_stats.c.last_read_time > last_read, campaign_stats.c.last_read_time),
+                else_=last_read,
+            ),
+        )
+    )
+
+
+def stats_to_dict(row) -> dict:
+    return {
+        "reference_id": row.reference_id,
+        "sent": row.sent_count,
+        "read": row.read_count,
+        "unread": row.sent_count - row.read_count,
+        "first_sent_time": row.first_sent_time,
+        "first_read_time": row.first_read_time,
+        "last_read_time": row.last_read_time,
+    }
+
+
+def get_stats(session, reference_ids: List[int]) -> List[dict]:
+    # Primary key lookups only
+    rows = session.execute(
+        select(campaign_stats).where(campaign_stats.c.reference_id.in_(reference_ids)).order_by(campaign_stats.c.reference_id)
+    )
+    return [stats_to_dict(row) for row in rows]
@@ -0,0 +1,96 @@
+# Cheap "data versions" the HTTP cache derives ETags from (see utils/http_cache.py).
+#
+# Each version is read with a few primary-key or index lookups instead of the endpoint's
+# own queries. When a version is unchanged, the cached response (or the client's copy)
+# is still valid:
+#   - schema version: in memory; changes whenever a table is created;
+#   - max exp_message id: changes with every send;
+#   - campaign_stats counters: change with every send and every flushed read receipt.
+from sqlalchemy import select, func
+from typing import List
+
+from utils.campaign_stats import campaign_stats
+from utils.http_cache import CacheRule
+from utils.schema_registry import registry
+
+API = "/api/v1"
+
+
+def max_message_id(session, schema) -> int:
+    # Walks the primary key (or each partition's primary key) from the end
+    if not schema.has_table("exp_message"):
+        return 0
+    exp_message_table = schema.table("exp_message")
+    return session.execute(select(func.max(exp_message_table.c.id))).scalar() or 0
+
+
+def stats_version(session, reference_id: int) -> tuple:
+    # Per-reference counters; None until the campaign exists
+    row = session.execute(
+        select(campaign_stats.c.sent_count, campaign_stats.c.read_count, campaign_stats.c.last_read_time)
+        .where(campaign_stats.c.reference_id == reference_id)
+    ).first()
+    return tuple(row) if row else None
+
+
+def campaigns_version(session) -> tuple:
+    # /viewMessages/: campaign_stats has one small row per campaign
+    schema = registry.snapshot(session)
+    totals = session.execute(
+        select(func.count(), func.coalesce(func.sum(campaign_stats.c.read_count), 0))
+    ).one()
+    return (schema.version, max_message_id(session, schema), *totals)
+
+
+def reference_version(session, id: str) -> tuple:
+    # /viewMessages/{id}: the reference row never changes, its targeted users can
+    schema = registry.snapshot(session)
+    max_user_id = None
+    if schema.has_table("users"):
+        max_user_id = session.execute(select(func.max(schema.table("users").c.id))).scalar()
+    return (schema.version, max_user_id)
+
+
+def reference_stats_version(session, id: str) -> tuple:
+    # /viewMessages/{id}/stats
+    return (registry.snapshot(session).version, stats_version(session, int(id)))
+
+
+def user_version(session, user_id: str) -> tuple:
+    # /users/{user_id} and its inbox: new messages anywhere, or this user's reads
+    schema = registry.snapshot(session)
+    unread = None
+    if schema.has_table("exp_message"):
+        exp_message_table = schema.table("exp_message")
+        unread = session.execute(
+            select(func.count())
+            .select_from(exp_message_table)
+            .where(exp_message_table.c.user_id == int(user_id), exp_message_table.c.read_status == "unread")
+        ).scalar()  # ix_exp_message_user_status
+    return (schema.version, max_message_id(session, schema), unread)
+
+
+def campaign_tags() -> List[str]:
+    return ["campaigns"]
+
+
+def reference_tags(id: str) -> List[str]:
+    return [f"reference:{id}", "users"]
+
+
+def reference_stats_tags(id: str) -> List[str]:
+    return [f"reference:{id}"]
+
+
+def user_tags(user_id: str) -> List[str]:
+    return ["inboxes", f"user:{user_id}"]
+
+
+# Read-heavy GET endpoints served through ConditionalCacheMiddleware
+# (/hierarchy/lvl-values keeps its own ETag from the in-memory hierarchy tree)
+CACHED_ROUTES = [
+    CacheRule(rf"^{API}/viewMessages/?$", campaigns_version, campaign_tags),
+    CacheRule(rf"^{API}/viewMessages/(?P<id>\d+)$", reference_version, reference_tags),
+    CacheRule(rf"^{API}/viewMessages/(?P<id>\d+)/stats$", reference_stats_version, reference_stats_tags),
+    CacheRule(rf"^{API}/users/(?P<user_id>\d+)(/inbox)?$", user_version, user_tags),
+]
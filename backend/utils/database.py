@@ -0,0 +1,153 @@
+# Shared database engine for the whole process.
+#
+# Every router and utility imports `engine` / `Session` from here, so each worker
+# has exactly one connection pool. Pool settings come from the environment:
+#
+#   DB_POOL_SIZE              persistent connections per worker (default 5)
+#   DB_MAX_OVERFLOW           extra connections allowed under load (default 10)
+#   DB_POOL_TIMEOUT           seconds to wait for a free connection (default 30)
+#   DB_POOL_RECYCLE           recycle connections older than this, seconds (default 1800)
+#   DB_POOL_PRE_PING          test connections before use (default true)
+#   DB_STATEMENT_TIMEOUT_MS   Postgres statement_timeout, 0 disables it (default 0)
+#   DB_ASYNC                  "auto" (default), "true" or "false", see below
+#
+# Postgres is accessed through SQLAlchemy's async engine (asyncpg) so queries never block
+# the event loop. Handlers keep writing plain SQLAlchemy code in a function that takes a
+# Session and hand it to `run_db`, which runs it with AsyncSession.run_sync. For SQLite
+# (tests) or when asyncpg isn't installed the sync engine is used from a thread pool.
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
+import csv
+import io
+import os
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mydatabase")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+DB_ASYNC = os.getenv("DB_ASYNC", "auto").lower()
+
+
+def engine_options(url: str) -> dict:
+    # Keyword arguments for create_engine based on the environment settings
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        # SQLite (tests) keeps SQLAlchemy's default pool
+        return options
+
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    if backend == "postgresql" and DB_STATEMENT_TIMEOUT_MS > 0:
+        if make_url(url).get_driver_name() == "asyncpg":
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+def use_async_driver(url: str) -> bool:
+    # Async path is only available for Postgres with asyncpg installed
+    if DB_ASYNC in ("0", "false", "no") or make_url(url).get_backend_name() != "postgresql":
+        return False
+    if DB_ASYNC in ("1", "true", "yes"):
+        return True
+    try:
+        import asyncpg  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def async_url(url: str) -> str:
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+
+if use_async_driver(DATABASE_URL):
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    ASYNC_DATABASE_URL = async_url(DATABASE_URL)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+    AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    # Sync facade of the same engine/pool (events, pool stats); only usable inside run_db
+    engine = async_engine.sync_engine
+    Session = None
+else:
+    async_engine = None
+    AsyncSession = None
+
+    engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+    Session = sessionmaker(bind=engine)
+
+
+def _run_sync(fn, *args, **kwargs):
+    with Session() as session:
+        return fn(session, *args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run `fn(session, *args, **kwargs)` without blocking the event loop.
+
+    `fn` receives a regular (sync) Session and is responsible for committing.
+    """
+    if async_engine is not None:
+        async with AsyncSession() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
+    return await run_in_threadpool(_run_sync, fn, *args, **kwargs)
+
+
+def copy_rows(session, table, columns, rows):
+    """Bulk load `rows` (sequences ordered like `columns`) into `table` with Postgres COPY.
+
+    Works inside run_db for both drivers; other databases fall back to executemany.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    connection = session.connection()
+    driver = connection.dialect.driver
+
+    if driver == "asyncpg":
+        from sqlalchemy.util import await_only
+
+        raw = connection.connection.driver_connection
+        await_only(raw.copy_records_to_table(table.name, records=rows, columns=list(columns)))
+    elif driver == "psycopg2":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = connection.connection.dbapi_connection.cursor()
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+    else:
+        session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+    return len(rows)
+
+
+def pool_stats() -> dict:
+    # Snapshot of the connection pool (QueuePool exposes all of these)
+    pool = engine.pool
+    stats = {"pool_class": type(pool).__name__, "async": async_engine is not None}
+
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+
+    stats["max_overflow"] = DB_MAX_OVERFLOW
+    stats["idle"] = stats.get("checkedin", 0)
+    return stats
@@ -0,0 +1,76 @@
+# Re-entrant lock for in-memory state that is filled from the database inside `run_db`
+# (and a sleep that is safe there).
+#
+# On the async engine (asyncpg), run_db runs every function as a greenlet on the event
+# loop thread and switches to another one at each query. A threading lock gives no
+# exclusion there (an RLock even lets every greenlet re-enter it), so greenlets wait on
+# an asyncio.Lock instead, through SQLAlchemy's await_only. Everywhere else (sync
+# engine thread pool, plain code on the loop thread) it is a threading.RLock.
+from sqlalchemy.util import await_only
+from sqlalchemy.util.concurrency import in_greenlet
+import asyncio
+import threading
+import time
+
+
+class DbLock:
+    def __init__(self):
+        self._thread_lock = threading.RLock()
+        self._async_lock = None
+        self._loop = None
+        self._owner = None  # greenlet holding the asyncio lock
+        self._depth = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self):
+        if not in_greenlet():
+            self._thread_lock.acquire()
+            return
+
+        current = _current_greenlet()
+        if self._owner is current:
+            self._depth += 1
+            return
+        await_only(self._loop_lock().acquire())
+        self._owner = current
+        self._depth = 1
+
+    def release(self):
+        if not in_greenlet():
+            self._thread_lock.release()
+            return
+
+        if self._owner is not _current_greenlet():
+            raise RuntimeError("DbLock released by a greenlet that doesn't hold it")
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._async_lock.release()
+
+    def _loop_lock(self) -> asyncio.Lock:
+        # One asyncio.Lock per event loop (tests and benchmarks may start several in turn)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._async_lock = asyncio.Lock()
+        return self._async_lock
+
+
+def db_sleep(seconds: float):
+    # Sleep inside run_db: yields to the event loop on the async engine instead of blocking it
+    if in_greenlet():
+        await_only(asyncio.sleep(seconds))
+    else:
+        time.sleep(seconds)
+
+
+def _current_greenlet():
+    from greenlet import getcurrent  # Installed with SQLAlchemy's asyncio extra
+
+    return getcurrent()
@@ -0,0 +1,86 @@
+# Message fan-out: one `exp_message` row per recipient.
+#
+# Recipients are streamed with a server-side cursor (yield_per) and rows are written in
+# fixed-size batches, so memory stays bounded whatever the number of recipients.
+# Everything happens in the caller's transaction; the caller commits.
+from datetime import datetime
+import os
+import time
+
+from utils.database import copy_rows
+from utils.templating import CompiledTemplate
+
+# Recipients fetched / rows written per batch
+FANOUT_BATCH_SIZE = int(os.getenv("FANOUT_BATCH_SIZE", "5000"))
+# "insert" (multi-row INSERT) or "copy" (Postgres COPY)
+FANOUT_WRITE_MODE = os.getenv("FANOUT_WRITE_MODE", "insert").lower()
+
+MESSAGE_COLUMNS = ["user_id", "channel", "msg_title", "msg_content", "reference_id", "sent_time", "read_status"]
+
+
+class FanoutStats:
+    def __init__(self):
+        self.recipients = 0
+        self.sent_time = None  # sent_time of every row of the send
+        self.batches = 0
+        self._started = time.monotonic()
+        self.elapsed = 0.0
+
+    def add_batch(self, rows: int):
+        self.recipients += rows
+        self.batches += 1
+        self.elapsed = time.monotonic() - self._started
+
+    def to_dict(self) -> dict:
+        return {
+            "recipients": self.recipients,
+            "batches": self.batches,
+            "elapsed_seconds": round(self.elapsed, 3),
+            "messages_per_second": round(self.recipients / self.elapsed, 2) if self.elapsed else 0.0,
+        }
+
+
+def fan_out(session, users_query, exp_message_table, template: CompiledTemplate, reference_id: int,
+            msg_title: str, channel: str = "webhooks", batch_size: int = FANOUT_BATCH_SIZE,
+            on_batch=None) -> FanoutStats:
+    stats = FanoutStats()
+    sent_time = stats.sent_time = datetime.now()
+
+    result = session.execute(users_query.execution_options(yield_per=batch_size))
+    for users in result.partitions():
+        rows = [
+            (user.id, channel, msg_title, template.render(user._mapping), reference_id, sent_time, "unread")
+            for user in users
+        ]
+        write_messages(session, exp_message_table, rows)
+        stats.add_batch(len(rows))
+        if on_batch is not None:
+            on_batch(len(rows))
+
+    return stats
+
+
+def fan_out_page(session, users_query, exp_message_table, template: CompiledTemplate, reference_id: int,
+                 msg_title: str, after_user_id: int, limit: int, channel: str = "webhooks"):
+    # One page of a paced send (utils/campaign_scheduler.py): the next `limit` recipients
+    # after `after_user_id` (users_query is ordered by users.id).
+    # Returns (rows written, last user id, sent_time).
+    user_id = users_query.selected_columns.id
+    users = session.execute(users_query.where(user_id > after_user_id).limit(limit)).all()
+    if not users:
+        return 0, after_user_id, None
+
+    sent_time = datetime.now()
+    rows = [
+        (user.id, channel, msg_title, template.render(user._mapping), reference_id, sent_time, "unread")
+        for user in users
+    ]
+    write_messages(session, exp_message_table, rows)
+    return len(rows), users[-1].id, sent_time
+
+
+def write_messages(session, exp_message_table, rows):
+    if FANOUT_WRITE_MODE == "copy":
+        copy_rows(session, exp_message_table, MESSAGE_COLUMNS, rows)
+    else:
+        session.execute(exp_message_table.insert(), [dict(zip(MESSAGE_COLUMNS, row)) for row in rows])
@@ -0,0 +1,111 @@
+# Closure table over all "lvl_*" tables: one row per (ancestor, descendant) pair,
+# including every node with itself at depth 0.
+#
+# Nodes of different levels live in different tables with their own ids, so a node is
+# identified by (level table name, id). With the closure, "all descendants of X" and
+# "all ancestors of Y" are one indexed lookup instead of a join chain down (or up) the
+# hierarchy. Rows are added by `add_nodes` in the same transaction as the upload that
+# inserted the nodes; `rebuild` recomputes everything from the level tables.
+from sqlalchemy import MetaData, Table, Column, Integer, String, Index, select, literal, delete
+from typing import Dict, List
+
+from utils.schema_registry import registry
+
+# Node ids per INSERT ... SELECT
+BATCH_SIZE = 5000
+
+metadata = MetaData()
+
+# Not named "lvl_*": it must not look like a hierarchy level
+hierarchy_closure = Table(
+    "hierarchy_closure",
+    metadata,
+    Column("ancestor_level", String(60), primary_key=True),
+    Column("ancestor_id", Integer, primary_key=True),
+    Column("descendant_level", String(60), primary_key=True),
+    Column("descendant_id", Integer, primary_key=True),
+    Column("depth", Integer, nullable=False),
+    # Ancestors of a node (the primary key serves descendants)
+    Index("ix_hierarchy_closure_descendant", "descendant_level", "descendant_id"),
+)
+
+
+def ensure_closure_table(session) -> bool:
+    # Create the table; when it is new, compute it for the data already uploaded
+    created = registry.ensure_tables(session, [hierarchy_closure])
+    if created:
+        rebuild(session)
+    return created
+
+
+def _link_rows(session, table, parent_table_name: str, ids=None):
+    # Closure rows of `table` nodes: itself, plus every ancestor of its parent one level up
+    level = table.name
+    nodes = select(literal(level), table.c.id, literal(level), table.c.id, literal(0))
+    if ids is not None:
+        nodes = nodes.where(table.c.id.in_(ids))
+    columns = ["ancestor_level", "ancestor_id", "descendant_level", "descendant_id", "depth"]
+    session.execute(hierarchy_closure.insert().from_select(columns, nodes))
+
+    if parent_table_name is None:
+        return
+
+    parent = hierarchy_closure.alias("parent")
+    inherited = (
+        select(parent.c.ancestor_level, parent.c.ancestor_id, literal(level), table.c.id, parent.c.depth + 1)
+        .join(parent, (parent.c.descendant_level == parent_table_name)
+              & (parent.c.descendant_id == table.c[f"{parent_table_name}_id"]))
+    )
+    if ids is not None:
+        inherited = inherited.where(table.c.id.in_(ids))
+    session.execute(hierarchy_closure.insert().from_select(columns, inherited))
+
+
+def add_nodes(session, levels, new_ids: Dict[str, List[int]]):
+    # `levels` is HierarchyLoader.levels (top-down); parents are always linked first.
+    # Part of the upload transaction; the caller commits.
+    for _, table, parent_column in levels:
+        ids = new_ids.get(table.name)
+        if not ids:
+            continue
+        parent_table_name = parent_column[:-len("_id")] if parent_column else None
+        for start in range(0, len(ids), BATCH_SIZE):
+            _link_rows(session, table, parent_table_name, ids[start:start + BATCH_SIZE])
+
+
+def rebuild(session):
+    # Recompute the whole closure from the level tables, top-down, and commit
+    schema = registry.snapshot(session)
+    session.execute(delete(hierarchy_closure))
+    parent = None
+    for table_name in schema.ordered_hierarchy:
+        _link_rows(session, schema.table(table_name), parent)
+        parent = table_name
+    session.commit()
+
+
+def descendant_ids(level_table: str, node_ids, descendant_level: str):
+    # SELECT of the ids at `descendant_level` below the given nodes (primary key prefix)
+    return select(hierarchy_closure.c.descendant_id).where(
+        hierarchy_closure.c.ancestor_level == level_table,
+        hierarchy_closure.c.ancestor_id.in_(node_ids),
+        hierarchy_closure.c.descendant_level == descendant_level,
+    )
+
+
+def ancestors_query(level_table: str, node_ids):
+    # Every ancestor (level, id, depth) of the given nodes, themselves excluded
+    return (
+        select(
+            hierarchy_closure.c.descendant_id,
+            hierarchy_closure.c.ancestor_level,
+            hierarchy_closure.c.ancestor_id,
+            hierarchy_closure.c.depth,
+        )
+        .where(
+            hierarchy_closure.c.descendant_level == level_table,
+            hierarchy_closure.c.descendant_id.in_(node_ids),
+            hierarchy_closure.c.depth > 0,
+        )
+        .order_by(hierarchy_closure.c.descendant_id, hierarchy_closure.c.depth.desc())
+    )
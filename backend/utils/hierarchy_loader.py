@@ -0,0 +1,109 @@
+# Set-based bulk loader for the "lvl_*" hierarchy tables.
+#
+# Instead of one SELECT + INSERT + COMMIT per cell, every level is handled as a set:
+# names are de-duplicated in memory, existing rows are fetched with one query per chunk,
+# the rest is written with a multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING, and
+# parent ids are resolved through an in-memory map. The caller commits once per upload
+# (or once per batch when streaming, the id maps are kept between batches).
+from sqlalchemy import select, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import Dict, Iterable, List, Optional
+
+# Rows per INSERT / names per IN (...) list, keeps us well below bind parameter limits
+BATCH_SIZE = 5000
+
+
+def _chunks(items: list, size: int = BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class HierarchyLoader:
+    def __init__(self, metadata, hierarchy: List[str]):
+        self.levels = []  # (input key, table, parent column)
+        parent = None
+        for level in hierarchy:
+            table = metadata.tables[f"lvl_{level.lower()}"]
+            self.levels.append((level.lower(), table, f"{parent.name}_id" if parent is not None else None))
+            parent = table
+
+        # (name, parent_id) -> id, per level; kept across batches of the same upload
+        self.ids = [{} for _ in self.levels]
+        self.stats = {table.name: {"inserted": 0, "reused": 0} for _, table, _ in self.levels}
+        # Ids inserted by this loader, per table (used to refresh caches afterwards)
+        self.inserted_ids = {table.name: [] for _, table, _ in self.levels}
+        # Ids inserted by the last `load` call only (closure table maintenance)
+        self.last_inserted = {table.name: [] for _, table, _ in self.levels}
+
+    def load(self, session, rows: Iterable[Dict[str, str]]):
+        # Level keys are matched case-insensitively, like the table names
+        rows = [{key.lower(): value for key, value in row.items()} for row in rows]
+        self.last_inserted = {table.name: [] for _, table, _ in self.levels}
+        parent_ids: List[Optional[int]] = [None] * len(rows)
+
+        for depth, (key, table, parent_column) in enumerate(self.levels):
+            keys = []
+            for index, row in enumerate(rows):
+                name = row.get(key)
+                # A row without this level (or without a parent) stops here
+                if not name or (depth and parent_ids[index] is None):
+                    keys.append(None)
+                else:
+                    keys.append((name, parent_ids[index]))
+
+            known = self.ids[depth]
+            missing = list(dict.fromkeys(k for k in keys if k is not None and k not in known))
+            if missing:
+                self._resolve(session, depth, table, parent_column, missing)
+
+            parent_ids = [known[k] if k is not None else None for k in keys]
+
+        return self.stats
+
+    def _resolve(self, session, depth, table, parent_column, keys):
+        known = self.ids[depth]
+        name_column = table.c.name
+        parent = table.c[parent_column] if parent_column else None
+
+        # 1. Reuse rows that already exist
+        self._fetch_existing(session, depth, table, parent, keys)
+        new_keys = [k for k in keys if k not in known]
+
+        # 2. Insert the rest, skipping rows a concurrent upload inserted meanwhile
+        columns = [table.c.id, name_column] + ([parent] if parent is not None else [])
+        for chunk in _chunks(new_keys):
+            values = [
+                {"name": name, parent_column: parent_id} if parent_column else {"name": name}
+                for name, parent_id in chunk
+            ]
+            stmt = self._insert(session, table).values(values).returning(*columns)
+            for row in session.execute(stmt):
+                known[(row[1], row[2] if parent is not None else None)] = row[0]
+                self.inserted_ids[table.name].append(row[0])
+                self.last_inserted[table.name].append(row[0])
+                self.stats[table.name]["inserted"] += 1
+
+        # 3. Whatever lost the race now exists
+        lost = [k for k in new_keys if k not in known]
+        if lost:
+            self._fetch_existing(session, depth, table, parent, lost)
+
+    def _fetch_existing(self, session, depth, table, parent, keys):
+        known = self.ids[depth]
+        wanted = set(keys)
+        columns = [table.c.id, table.c.name] + ([parent] if parent is not None else [])
+
+        for chunk in _chunks(list(dict.fromkeys(name for name, _ in keys))):
+            for row in session.execute(select(*columns).where(table.c.name.in_(chunk))):
+                key = (row[1], row[2] if parent is not None else None)
+                if key in wanted and key not in known:
+                    known[key] = row[0]
+                    self.stats[table.name]["reused"] += 1
+
+    def _insert(self, session, table):
+        dialect = session.get_bind().dialect.name
+        if dialect == "postgresql":
+            return postgresql.insert(table).on_conflict_do_nothing()
+        if dialect == "sqlite":
+            return sqlite.insert(table).on_conflict_do_nothing()
+        return insert(table)
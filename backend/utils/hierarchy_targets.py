@@ -0,0 +1,72 @@
+# Resolve message targets anywhere in the hierarchy to bottom-most nodes and users.
+#
+# A target is a level (e.g. "Region") plus one or more node names at that level. All
+# bottom-most descendants are found with one lookup in the closure table.
+#
+# The names of a multi-target send are kept one per row in `reference_targets`, so a name
+# containing ", " survives; reference_table only stores them joined, for display.
+from fastapi import HTTPException
+from sqlalchemy import MetaData, Table, Column, Integer, String, select
+from typing import List, Optional
+
+from utils.hierarchy_closure import descendant_ids
+
+
+metadata = MetaData()
+
+# Created at startup, see utils/bootstrap.py
+reference_targets = Table(
+    "reference_targets",
+    metadata,
+    Column("reference_id", Integer, primary_key=True),  # reference_table.id
+    Column("position", Integer, primary_key=True),  # Order given in the request
+    Column("name", String, nullable=False),
+)
+
+
+def save_targets(session, reference_id: int, names: List[str]):
+    # Part of the send transaction; the caller commits
+    session.execute(reference_targets.insert(), [
+        {"reference_id": reference_id, "position": position, "name": name}
+        for position, name in enumerate(names)
+    ])
+
+
+def load_targets(session, reference_id: int) -> Optional[List[str]]:
+    # None for sends without a target list (btm_lvl, or sent before the table existed)
+    names = session.execute(
+        select(reference_targets.c.name)
+        .where(reference_targets.c.reference_id == reference_id)
+        .order_by(reference_targets.c.position)
+    ).scalars().all()
+    return list(names) or None
+
+
+def level_table_name(level: str) -> str:
+    level = level.lower()
+    return level if level.startswith("lvl_") else f"lvl_{level}"
+
+
+def descendant_bottom_ids(schema, level_table: str, names: List[str]):
+    # SELECT of the bottom-most ids below the named nodes of `level_table`
+    if level_table not in schema.ordered_hierarchy:
+        raise HTTPException(status_code=400, detail=f"Invalid target level '{level_table[4:]}'")
+
+    level = schema.table(level_table)
+    node_ids = select(level.c.id).where(level.c.name.in_(names))
+    return descendant_ids(level_table, node_ids, schema.bottom_most)
+
+
+def target_users_query(schema, level_table: str, names: List[str]):
+    # All users attached to any bottom-most descendant of the targets, by id
+    users_table = schema.table("users")
+    bottom_column = users_table.c[f"{schema.bottom_most_name}_id"]
+    return (
+        users_table.select()
+        .where(bottom_column.in_(descendant_bottom_ids(schema, level_table, names)))
+        .order_by(users_table.c.id)
+    )
+
+
+def targets_exist(session, schema, level_table: str, names: List[str]) -> bool:
+    return session.execute(select(descendant_bottom_ids(schema, level_table, names).exists())).scalar()
@@ -0,0 +1,181 @@
+# In-memory copy of the whole hierarchy, used to answer the admin UI dropdowns
+# (/hierarchy/lvl-values, /hierarchy/children-of) without touching the database.
+#
+# Every level is stored column-wise: parallel arrays of ids and parent ids plus a list
+# of interned names, and a parent id -> positions index for children lookups. The tree
+# is refreshed incrementally: only rows with an id above the highest one already loaded
+# are read, right after an upload in this worker and at most every HIERARCHY_CHECK_INTERVAL
+# seconds for uploads made by other workers. A schema change (new levels) or
+# HIERARCHY_FULL_RELOAD seconds trigger a full reload.
+from array import array
+from sqlalchemy import select, func
+from typing import Dict, List, Optional
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+from utils.db_lock import DbLock
+from utils.schema_registry import registry
+
+HIERARCHY_CHECK_INTERVAL = float(os.getenv("HIERARCHY_CHECK_INTERVAL", "5"))
+HIERARCHY_FULL_RELOAD = float(os.getenv("HIERARCHY_FULL_RELOAD", "600"))
+
+NO_PARENT = -1
+
+
+class LevelNodes:
+    def __init__(self, table_name: str, parent_column: Optional[str]):
+        self.table_name = table_name
+        self.parent_column = parent_column
+        self.ids = array("q")
+        self.parent_ids = array("q")
+        self.names: List[str] = []
+        self.children: Dict[int, array] = {}  # parent id -> positions
+        self.max_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, node_id: int, name: str, parent_id: Optional[int]):
+        position = len(self.ids)
+        self.ids.append(node_id)
+        self.parent_ids.append(NO_PARENT if parent_id is None else parent_id)
+        self.names.append(sys.intern(name) if name is not None else None)
+        if parent_id is not None:
+            self.children.setdefault(parent_id, array("q")).append(position)
+        self.max_id = max(self.max_id, node_id)
+
+    def row(self, position: int) -> dict:
+        # Same shape as a `SELECT *` row of the level table
+        row = {"id": self.ids[position], "name": self.names[position]}
+        if self.parent_column:
+            parent_id = self.parent_ids[position]
+            row[self.parent_column] = None if parent_id == NO_PARENT else parent_id
+        return row
+
+    def rows(self, positions=None) -> List[dict]:
+        return [self.row(position) for position in (range(len(self.ids)) if positions is None else positions)]
+
+
+class HierarchyTree:
+    def __init__(self):
+        self.levels: Dict[str, LevelNodes] = {}  # ordered top-down
+        self.schema_version = None
+        self._lock = DbLock()  # Held across the refresh queries, see utils/db_lock.py
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+        self._payload = None  # (body, etag) of /lvl-values
+
+    def needs_check(self) -> bool:
+        # Decided without the database: never loaded, schema changed or check is due
+        return (
+            self.schema_version is None
+            or self.schema_version != registry.version
+            or time.monotonic() - self._checked_at >= HIERARCHY_CHECK_INTERVAL
+        )
+
+    def ensure_fresh(self, session):
+        with self._lock:
+            schema = registry.snapshot(session)
+            now = time.monotonic()
+            if self.schema_version != schema.version or now - self._loaded_at >= HIERARCHY_FULL_RELOAD:
+                self.reload(session)
+            elif now - self._checked_at >= HIERARCHY_CHECK_INTERVAL:
+                self.refresh(session)
+
+    def reload(self, session):
+        # Built aside and swapped in, so readers never see a half-loaded tree
+        with self._lock:
+            schema = registry.snapshot(session)
+            levels = {}
+            parent = None
+            for table_name in schema.ordered_hierarchy:
+                levels[table_name] = LevelNodes(table_name, f"{parent}_id" if parent else None)
+                parent = table_name
+            self._append_new_rows(session, schema, levels)
+
+            self.levels = levels
+            self.schema_version = schema.version
+            self._loaded_at = self._checked_at = time.monotonic()
+            self._payload = None
+            logging.info(f'hierarchy tree loaded: {({name: len(nodes) for name, nodes in levels.items()})}')
+
+    def refresh_after_upload(self, session):
+        # Uploads call this after their commit; a failure only delays the refresh
+        try:
+            self.refresh(session)
+        except Exception:
+            logging.exception('hierarchy tree refresh failed')
+            self._checked_at = 0.0
+
+    def refresh(self, session) -> int:
+        # Load the rows added since the last refresh (ids above each level's max id)
+        with self._lock:
+            schema = registry.snapshot(session)
+            if schema.version != self.schema_version:
+                self.reload(session)
+                return 0
+
+            added = self._append_new_rows(session, schema, self.levels)
+            self._checked_at = time.monotonic()
+            if added:
+                self._payload = None
+            return added
+
+    @staticmethod
+    def _append_new_rows(session, schema, levels) -> int:
+        added = 0
+        for table_name, nodes in levels.items():
+            table = schema.table(table_name)
+            latest = session.execute(select(func.max(table.c.id))).scalar() or 0
+            if latest <= nodes.max_id:
+                continue
+
+            parent = table.c[nodes.parent_column] if nodes.parent_column else None
+            columns = [table.c.id, table.c.name] + ([parent] if parent is not None else [])
+            query = select(*columns).where(table.c.id > nodes.max_id).order_by(table.c.id)
+            for row in session.execute(query):
+                if row[0] <= nodes.max_id:
+                    continue  # Never append a node twice
+                nodes.add(row[0], row[1], row[2] if parent is not None else None)
+                added += 1
+        return added
+
+    def lvl_values(self):
+        # Serialized once per change: (JSON body, ETag)
+        with self._lock:
+            if self._payload is None:
+                if self.levels:
+                    data = {table_name: nodes.rows() for table_name, nodes in self.levels.items()}
+                else:
+                    data = {"error": "No tables found starting with 'lvl_'"}
+                self._payload = json_payload(data)
+            return self._payload
+
+    def children_of(self, level: Optional[str], node_id: Optional[int]) -> dict:
+        # Children of one node, or the top-most nodes when no level is given
+        with self._lock:
+            names = list(self.levels)
+            if not names:
+                return {"level": None, "children": []}
+            if level is None:
+                return {"level": names[0][4:], "children": self.levels[names[0]].rows()}
+
+            index = names.index(level)
+            if index + 1 >= len(names):
+                return {"level": None, "children": []}  # Bottom-most nodes have no children
+            child_level = self.levels[names[index + 1]]
+            positions = child_level.children.get(node_id, ())
+            return {"level": names[index + 1][4:], "children": child_level.rows(positions)}
+
+
+def json_payload(data) -> tuple:
+    body = json.dumps(data, separators=(",", ":")).encode()
+    return body, f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+# Shared tree for the whole process
+hierarchy_tree = HierarchyTree()
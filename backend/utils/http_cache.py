@@ -0,0 +1,222 @@
+# HTTP caching helpers: ETag / If-None-Match handling for precomputed JSON bodies, and a
+# conditional-GET middleware for the read-heavy endpoints polled by the frontend.
+#
+# Middleware: every cached route has a `version` function (see utils/data_versions.py)
+# that reads a few cheap "data versions" instead of running the endpoint's queries. The
+# ETag is a hash of the request path and query plus those versions, so:
+#   - If-None-Match with the current ETag -> 304, the endpoint does not run at all;
+#   - same versions as the cached body -> the cached body, the endpoint does not run;
+#   - otherwise the endpoint runs and its 200 response is cached.
+# Within RESPONSE_CACHE_TTL seconds of being stored (or revalidated) an entry is served
+# without even reading the versions. Write endpoints in this worker call
+# `response_cache.invalidate(...)` so their changes are visible at once; writes made by
+# other workers are picked up when the TTL runs out.
+from collections import OrderedDict
+from fastapi import Request, Response
+from typing import Callable, Iterable, List, Optional
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from utils.database import run_db
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "2"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    return header_matches(header, etag)
+
+
+def header_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [value.strip().removeprefix("W/") for value in header.split(",")]
+
+
+def cache_control(max_age: int = 0) -> str:
+    return f"private, max-age={max_age}, must-revalidate"
+
+
+def etag_response(request: Request, body: bytes, etag: str, max_age: int = 0) -> Response:
+    # 304 without a body when the client already has this version
+    headers = {"ETag": etag, "Cache-Control": cache_control(max_age)}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class CachedResponse:
+    def __init__(self, etag: str, body: bytes, media_type: str, tags: Iterable[str]):
+        self.etag = etag
+        self.body = body
+        self.media_type = media_type
+        self.tags = frozenset(tags)
+        self.checked_at = time.monotonic()
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() - self.checked_at < RESPONSE_CACHE_TTL
+
+
+class ResponseCache:
+    # LRU of response bodies keyed by path + query string, dropped by tag
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # Invalidated from run_db threads
+        self.generation = 0  # Bumped by every invalidation
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CachedResponse, generation: int):
+        with self._lock:
+            # An invalidation while the endpoint ran: the body may predate the write
+            if generation != self.generation:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *tags: str):
+        # Drop every entry carrying one of the tags (safe from any thread)
+        tags = set(tags)
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._entries.items() if entry.tags & tags]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "ttl": RESPONSE_CACHE_TTL,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
+
+
+class CacheRule:
+    # `version(session, **path_params)` runs in run_db; `tags(**path_params)` names the
+    # invalidation hooks the cached response depends on
+    def __init__(self, pattern: str, version: Callable, tags: Callable[..., List[str]]):
+        self.pattern = re.compile(pattern)
+        self.version = version
+        self.tags = tags
+
+
+def make_etag(key: str, version) -> str:
+    digest = hashlib.sha1(json.dumps([key, version], default=str).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+class ConditionalCacheMiddleware:
+    def __init__(self, app, rules: List[CacheRule], cache: "ResponseCache" = None):
+        self.app = app
+        self.rules = rules
+        self.cache = cache or response_cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        for rule in self.rules:
+            match = rule.pattern.match(scope["path"])
+            if match:
+                scope["path_params"] = match.groupdict()  # Names the route in request metrics
+                return await self._handle(rule, match.groupdict(), scope, receive, send)
+        return await self.app(scope, receive, send)
+
+    async def _handle(self, rule: CacheRule, params: dict, scope, receive, send):
+        query = scope.get("query_string", b"").decode()
+        key = f'{scope["path"]}?{query}'
+        if_none_match = next((value.decode() for name, value in scope["headers"] if name == b"if-none-match"), None)
+        generation = self.cache.generation
+
+        entry = self.cache.get(key)
+        if entry is not None and entry.fresh:
+            self.cache.hits += 1
+            etag = entry.etag
+        else:
+            try:
+                version = await run_db(rule.version, **params)
+            except Exception:
+                logging.exception(f'response cache: reading the data version of {key} failed')
+                return await self.app(scope, receive, send)
+            etag = make_etag(key, version)
+            if entry is not None and entry.etag == etag:
+                self.cache.revalidated += 1
+                entry.checked_at = time.monotonic()
+            else:
+                entry = None
+
+        headers = [(b"etag", etag.encode()), (b"cache-control", cache_control().encode())]
+        if header_matches(if_none_match, etag):
+            self.cache.not_modified += 1
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if entry is not None:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": headers + [
+                    (b"content-type", entry.media_type.encode()),
+                    (b"content-length", str(len(entry.body)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": entry.body})
+            return
+
+        self.cache.misses += 1
+        await self._call_and_store(rule, params, key, etag, generation, headers, scope, receive, send)
+
+    async def _call_and_store(self, rule, params, key, etag, generation, headers, scope, receive, send):
+        # Run the endpoint; a 200 gets the ETag and is kept, anything else passes through
+        start = None
+        chunks = []
+
+        async def capture(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                if message["status"] == 200:
+                    message = dict(message, headers=list(message.get("headers", [])) + headers)
+                await send(message)
+                return
+            if message["type"] == "http.response.body" and start is not None and start["status"] == 200:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    media_type = next((value.decode() for name, value in start.get("headers", [])
+                                       if name == b"content-type"), "application/json")
+                    self.cache.put(key, CachedResponse(etag, b"".join(chunks), media_type, rule.tags(**params)),
+                                   generation)
+            await send(message)
+
+        await self.app(scope, receive, capture)
+
+
+# Shared response cache for the whole process
+response_cache = ResponseCache()
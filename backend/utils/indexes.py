@@ -0,0 +1,47 @@
+# Indexes the application relies on, created at startup (concurrently, on Postgres) and
+# whenever the message tables are first created, then verified against the reflected schema.
+# Entries are (index name, table name, [column, ...]); a column may end with " DESC".
+from utils.schema_registry import registry
+
+MESSAGE_INDEXES = [
+    # Per-campaign counts (campaign_stats backfill, by reference id range), index-only
+    ("ix_exp_message_reference_read", "exp_message", ["reference_id", "read_status", "sent_time"]),
+    # A user's messages, newest first (inbox, user references); id breaks sent_time ties
+    # like the inbox keyset cursor (sent_time, id) does
+    ("ix_exp_message_user_sent_id", "exp_message", ["user_id", "sent_time DESC", "id DESC"]),
+    # Unread count of a user's inbox
+    ("ix_exp_message_user_status", "exp_message", ["user_id", "read_status"]),
+    # Recipients of a reference, and one user's message of a reference
+    ("ix_exp_message_reference_user", "exp_message", ["reference_id", "user_id"]),
+]
+
+# Replaced indexes, dropped where they still exist: (index name, table name)
+RETIRED_INDEXES = [
+    # Superseded by ix_exp_message_user_sent_id (same prefix)
+    ("ix_exp_message_user_sent", "exp_message"),
+]
+
+
+def ensure_indexes(session, concurrently: bool = False) -> bool:
+    # `concurrently` for existing (possibly big) tables: built without blocking writes
+    created = registry.ensure_indexes(session, MESSAGE_INDEXES, concurrently)
+    dropped = registry.drop_indexes(session, RETIRED_INDEXES, concurrently)
+    return created or dropped
+
+
+def verify_indexes(session) -> list:
+    # Compare the expected indexes with the reflected ones (names and column order)
+    schema = registry.snapshot(session)
+    report = []
+    for name, table_name, columns in MESSAGE_INDEXES:
+        expected = [column.split(" ")[0] for column in columns]
+        status = "missing"
+        if schema.has_table(table_name):
+            found = {index.name: index for index in schema.table(table_name).indexes}
+            if name in found:
+                actual = [column.name for column in found[name].columns]
+                status = "ok" if actual == expected else f"columns differ: {actual}"
+        else:
+            status = "table missing"
+        report.append({"name": name, "table": table_name, "columns": columns, "status": status})
+    return report
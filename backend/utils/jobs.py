@@ -0,0 +1,482 @@
+# Long running jobs (uploads, sends) and their progress, plus a small worker pool that
+# runs queued jobs in the background.
+#
+# Every job is also a row of the `jobs` table: changes are written every JOB_FLUSH_MS
+# milliseconds (and on shutdown), so GET /api/v1/jobs/{job_id} answers from any worker
+# and a job still shows what it did after a restart.
+#
+# Queued jobs carry their arguments (`payload`, JSON) and the runner is looked up by
+# kind (JobQueue.register), so any worker can run them: a job is claimed in the table
+# (queued -> running) before it starts. Jobs another worker left behind -- queued for
+# more than JOB_POLL_INTERVAL, or running without a heartbeat for JOB_STALE_SECONDS --
+# are claimed again. A runner must be safe to rerun: a send commits its messages and the
+# job's completion in one transaction (complete_in), so it either happened or not at all.
+# Jobs without a payload (streaming uploads) cannot be rerun and are marked failed.
+#
+# On shutdown running jobs get JOB_DRAIN_SECONDS to finish; jobs still queued here are
+# left in the table for the next worker.
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Text, DateTime
+from sqlalchemy import select, update, delete, and_, or_
+from typing import Optional
+from uuid import uuid4
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from utils.database import run_db
+
+# Finished jobs kept in memory for status polling
+MAX_FINISHED_JOBS = 1000
+# Jobs running concurrently per uvicorn worker
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Job changes are written to the `jobs` table this often
+JOB_FLUSH_MS = int(os.getenv("JOB_FLUSH_MS", "1000"))
+# Seconds between looks for jobs other workers left behind
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+# A running job without a heartbeat for this long belongs to a worker that went away
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "60"))
+# Time given to running jobs on shutdown
+JOB_DRAIN_SECONDS = float(os.getenv("JOB_DRAIN_SECONDS", "30"))
+# Finished jobs kept in the table
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+metadata = MetaData()
+
+# Created at startup, see utils/bootstrap.py
+job_rows = Table(
+    "jobs",
+    metadata,
+    Column("id", String(32), primary_key=True),
+    Column("kind", String(50), nullable=False),
+    Column("status", String(20), nullable=False),  # queued/running/completed/failed
+    Column("rows", Integer, nullable=False, default=0),
+    Column("errors", Text, nullable=True),  # JSON list
+    Column("details", Text, nullable=True),  # JSON object
+    Column("payload", Text, nullable=True),  # JSON arguments of a rerunnable job
+    Column("claimed_by", String(100), nullable=True),  # host:pid of the running worker
+    Column("heartbeat_at", DateTime, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("started_at", DateTime, nullable=True),
+    Column("finished_at", DateTime, nullable=True),
+    Index("ix_jobs_status", "status", "heartbeat_at"),
+)
+
+
+class Job:
+    def __init__(self, kind: str, job_id: Optional[str] = None, payload: Optional[dict] = None):
+        self.id = job_id or uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.rows = 0
+        self.errors = []
+        self.details = {}
+        self.payload = payload
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._started = None  # monotonic clock, for the rate
+        self._finished = None
+        self.persisted = False  # Row inserted in `jobs`
+        self.dirty = True  # Changed since the last flush
+
+    def start(self):
+        self.status = "running"
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self.dirty = True
+
+    def progress(self, rows: int):
+        self.rows += rows
+        self.dirty = True
+
+    def finish(self, details: Optional[dict] = None):
+        self.details.update(details or {})
+        self.status = "completed"
+        self.finished_at = datetime.now()
+        self._finished = time.monotonic()
+        self.dirty = True
+
+    def fail(self, error: str):
+        self.errors.append(error)
+        self.status = "failed"
+        self.finished_at = datetime.now()
+        self._finished = time.monotonic()
+        self.dirty = True
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    @property
+    def elapsed(self) -> float:
+        if self._started is None:
+            # Loaded from the table: wall clock times only
+            if self.started_at is None:
+                return 0.0
+            return ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+        end = self._finished if self.done else time.monotonic()
+        return end - self._started
+
+    def to_dict(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "rows": self.rows,
+            "rate": round(self.rows / elapsed, 2) if elapsed else 0.0,
+            "elapsed_seconds": round(elapsed, 3),
+            "errors": self.errors,
+            "details": self.details,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def to_row(self) -> dict:
+        return {
+            "kind": self.kind,
+            "status": self.status,
+            "rows": self.rows,
+            "errors": json.dumps(self.errors),
+            "details": json.dumps(self.details, default=str),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def job_from_row(row) -> Job:
+    job = Job(row.kind, row.id, json.loads(row.payload) if row.payload else None)
+    job.status = row.status
+    job.rows = row.rows
+    job.errors = json.loads(row.errors) if row.errors else []
+    job.details = json.loads(row.details) if row.details else {}
+    job.created_at = row.created_at
+    job.started_at = row.started_at
+    job.finished_at = row.finished_at
+    job.persisted = True
+    job.dirty = False
+    return job
+
+
+# Job rows (called through run_db)
+
+def insert_job(session, job: Job):
+    session.execute(job_rows.insert().values(
+        id=job.id, payload=json.dumps(job.payload) if job.payload is not None else None,
+        created_at=job.created_at, **job.to_row(),
+    ))
+    session.commit()
+    job.persisted = True
+
+
+def write_jobs(session, changed: list):
+    # Inserts new jobs, updates the others; running jobs of this worker get a heartbeat
+    now = datetime.now()
+    for job in changed:
+        values = job.to_row()
+        if job.status == "running":
+            values["heartbeat_at"] = now
+        if not job.persisted:
+            session.execute(job_rows.insert().values(
+                id=job.id, created_at=job.created_at, claimed_by=WORKER_ID, **values,
+            ))
+        else:
+            # Only a running row: a finished one (e.g. completed by complete_in in the send's
+            # transaction) must never be turned back into running by a stale snapshot
+            session.execute(
+                update(job_rows)
+                .where(job_rows.c.id == job.id, job_rows.c.claimed_by == WORKER_ID, job_rows.c.status == "running")
+                .values(**values)
+            )
+    session.commit()
+    for job in changed:
+        job.persisted = True
+
+
+def load_job(session, job_id: str) -> Optional[Job]:
+    row = session.execute(select(job_rows).where(job_rows.c.id == job_id)).first()
+    return job_from_row(row) if row is not None else None
+
+
+def claim_job(session, job_id: str) -> bool:
+    # queued -> running for this worker; False when another worker got it first
+    now = datetime.now()
+    result = session.execute(
+        update(job_rows)
+        .where(job_rows.c.id == job_id, job_rows.c.status == "queued")
+        .values(status="running", claimed_by=WORKER_ID, heartbeat_at=now, started_at=now)
+    )
+    session.commit()
+    return bool(result.rowcount)
+
+
+def claim_orphan(session) -> Optional[Job]:
+    # A job left queued by a busy or stopped worker, or running on one that went away
+    now = datetime.now()
+    c = job_rows.c
+    stale = c.heartbeat_at < now - timedelta(seconds=JOB_STALE_SECONDS)
+
+    # Running jobs that cannot be rerun are only marked as interrupted
+    session.execute(
+        update(job_rows)
+        .where(c.status == "running", stale, c.payload.is_(None))
+        .values(status="failed", errors=json.dumps(["Interrupted: the worker running it stopped"]), finished_at=now)
+    )
+
+    orphan = (
+        select(c.id)
+        .where(c.payload.is_not(None))
+        .where(or_(
+            and_(c.status == "queued", c.created_at < now - timedelta(seconds=JOB_POLL_INTERVAL)),
+            and_(c.status == "running", stale),
+        ))
+        .order_by(c.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    job_id = session.execute(orphan).scalar()
+    if job_id is None:
+        session.commit()
+        return None
+    session.execute(
+        update(job_rows)
+        .where(c.id == job_id)
+        .values(status="running", claimed_by=WORKER_ID, heartbeat_at=now, started_at=now)
+    )
+    row = session.execute(select(job_rows).where(c.id == job_id)).first()
+    session.commit()
+    return job_from_row(row)
+
+
+def release_job(session, job_id: str):
+    # Stopped before it finished: back in the queue for the next worker
+    session.execute(
+        update(job_rows)
+        .where(job_rows.c.id == job_id, job_rows.c.status == "running", job_rows.c.claimed_by == WORKER_ID)
+        .values(status="queued", claimed_by=None, heartbeat_at=None)
+    )
+    session.commit()
+
+
+def complete_in(session, job: Job, details: Optional[dict] = None):
+    # Mark the job completed inside the caller's transaction (committed with its work).
+    # Raises when this worker no longer holds the job, so the caller rolls back.
+    now = datetime.now()
+    result = session.execute(
+        update(job_rows)
+        .where(job_rows.c.id == job.id, job_rows.c.status == "running", job_rows.c.claimed_by == WORKER_ID)
+        .values(status="completed", rows=job.rows, details=json.dumps(details or {}, default=str), finished_at=now)
+    )
+    if not result.rowcount:
+        raise RuntimeError(f"Job {job.id} is no longer held by this worker")
+
+
+def prune_jobs(session):
+    session.execute(delete(job_rows).where(
+        job_rows.c.status.in_(("completed", "failed")),
+        job_rows.c.created_at < datetime.now() - timedelta(days=JOB_RETENTION_DAYS),
+    ))
+    session.commit()
+
+
+class JobRegistry:
+    def __init__(self, max_finished: int = MAX_FINISHED_JOBS, flush_ms: int = JOB_FLUSH_MS):
+        self.max_finished = max_finished
+        self.flush_interval = flush_ms / 1000
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._flush_lock = None  # One flush at a time (created in start, on the loop)
+        self._task = None
+
+    def create(self, kind: str, job_id: Optional[str] = None, payload: Optional[dict] = None) -> Job:
+        return self.add(Job(kind, job_id, payload))
+
+    def add(self, job: Job) -> Job:
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def discard(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    async def find(self, job_id: str) -> Optional[Job]:
+        # This worker's jobs first, then the table (jobs of other workers, or older ones)
+        job = self.get(job_id)
+        if job is None:
+            job = await run_db(load_job, job_id)
+        return job
+
+    def _prune(self):
+        # Forget the oldest finished jobs (dicts keep insertion order)
+        finished = [job_id for job_id, job in self._jobs.items() if job.done and not job.dirty]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    async def start(self):
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> int:
+        if self._flush_lock is None:
+            return await self._flush()
+        async with self._flush_lock:
+            return await self._flush()
+
+    async def _flush(self) -> int:
+        with self._lock:
+            changed = [job for job in self._jobs.values() if job.dirty or job.status == "running"]
+        if not changed:
+            return 0
+        for job in changed:
+            job.dirty = False
+        try:
+            await run_db(write_jobs, changed)
+        except Exception:
+            logging.exception(f'jobs: writing {len(changed)} jobs failed, retrying later')
+            for job in changed:
+                job.dirty = True
+            return 0
+        return len(changed)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Not cut short by stop(): its final flush waits for this one
+            await asyncio.shield(self.flush())
+
+
+class JobQueue:
+    """Runs queued jobs on JOB_WORKERS asyncio tasks: `await runner(job, payload)`."""
+
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.runners = {}  # kind -> async fn(job, payload) returning the job details
+        self._queue = None
+        self._tasks = []
+        self._running = {}  # job id -> Job, started by this worker
+        self._closing = False
+
+    def register(self, kind: str, runner):
+        self.runners[kind] = runner
+
+    async def start(self):
+        self._closing = False
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._poll()))
+
+    async def stop(self):
+        # Let running jobs finish; what is still queued stays in the table
+        self._closing = True
+        deadline = time.monotonic() + JOB_DRAIN_SECONDS
+        while self._running and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        interrupted = list(self._running.values())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        for job in interrupted:
+            logging.warning(f'job {job.id} interrupted by shutdown, requeued')
+            try:
+                await run_db(release_job, job.id)
+            except Exception:
+                logging.exception(f'job {job.id}: requeue failed')
+            job.status = "queued"
+            job.dirty = False
+        self._running.clear()
+
+    async def submit(self, kind: str, payload: dict) -> Job:
+        if self._queue is None or self._closing:
+            raise HTTPException(status_code=503, detail="Job queue is not running")
+        job = Job(kind, payload=payload)
+        await run_db(insert_job, job)  # Durable before it is acknowledged
+        job.dirty = False
+        jobs.add(job)
+        self._queue.put_nowait(job)
+        return job
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while not self._closing:
+            job = await self._queue.get()
+            try:
+                if self._closing:
+                    continue
+                if await run_db(claim_job, job.id):
+                    await self._run_job(job)
+                else:
+                    jobs.discard(job.id)  # Taken by another worker: its row has the status
+            except Exception:
+                logging.exception(f'job {job.id}: claim failed')
+            finally:
+                self._queue.task_done()
+
+    async def _poll(self):
+        last_prune = 0.0
+        while not self._closing:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if time.monotonic() - last_prune > 3600:
+                    await run_db(prune_jobs)
+                    last_prune = time.monotonic()
+                job = await run_db(claim_orphan)
+                if job is not None:
+                    logging.info(f'job {job.id} ({job.kind}) taken over by {WORKER_ID}')
+                    jobs.add(job)
+                    task = asyncio.create_task(self._run_job(job))
+                    self._tasks.append(task)
+                    task.add_done_callback(self._forget_task)
+            except Exception:
+                logging.exception('jobs: looking for orphaned jobs failed')
+
+    def _forget_task(self, task):
+        if task in self._tasks:
+            self._tasks.remove(task)
+
+    async def _run_job(self, job: Job):
+        runner = self.runners.get(job.kind)
+        job.start()
+        self._running[job.id] = job
+        try:
+            if runner is None:
+                raise RuntimeError(f"No runner for {job.kind} jobs")
+            job.finish(await runner(job, job.payload))
+        except HTTPException as e:
+            job.fail(str(e.detail))
+        except Exception as e:
+            logging.exception(f'job {job.id} failed')
+            job.fail(str(e))
+        finally:
+            self._running.pop(job.id, None)
+
+
+# Shared registry and queue for the whole process
+jobs = JobRegistry()
+job_queue = JobQueue()
@@ -0,0 +1,60 @@
+# `reference_table` (one row per send) and `exp_message` (one row per recipient).
+#
+# reference_table names its target column after the bottom-most hierarchy level
+# (e.g. "branch_name"), so both tables are created once a hierarchy exists: by
+# setup_schema at startup (under the bootstrap lock) and by the hierarchy upload that
+# creates the levels. Sends only read them from the schema registry.
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy.sql import func
+
+from utils.indexes import ensure_indexes
+from utils.partitions import partitioning_enabled, exp_message_table_options, ensure_partitions
+from utils.schema_registry import registry
+
+
+def message_tables(session, bottom_most_name: str) -> list:
+    metadata = MetaData()
+    reference_table = Table(
+        "reference_table",
+        metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("template_name", String, nullable=False),
+        Column("message_title", String, nullable=False),
+        Column("message_content", String, nullable=False),
+        Column(f"{bottom_most_name}_name", String, nullable=False),  # Target name(s), ", " separated
+        Column("target_level", String, nullable=True),  # Level of the targets (NULL: bottom-most)
+        Column("user_count", Integer, nullable=False),
+    )
+
+    partitioned = partitioning_enabled(session)
+    exp_message = Table(
+        "exp_message",
+        metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("user_id", Integer, nullable=False),  # This should be set to the relevant user ID
+        Column("channel", String, nullable=False),
+        Column("msg_title", String, nullable=False),
+        Column("msg_content", String, nullable=False),
+        Column("reference_id", Integer, ForeignKey("reference_table.id"), nullable=False),  # Reference to ReferenceTable
+        # Part of the primary key when partitioned by month (see utils/partitions.py)
+        Column("sent_time", DateTime, server_default=func.now(), primary_key=partitioned),  # Time when sent
+        Column("msg_read_time", DateTime, nullable=True),  # Time when read
+        Column("read_status", String, default="unread"),  # Default to "unread"
+        **exp_message_table_options(session)
+    )
+    return [reference_table, exp_message]
+
+
+def ensure_message_tables(session) -> bool:
+    # Create the tables (with their indexes and partitions) if a hierarchy exists and
+    # they are missing. Returns True if anything was created.
+    schema = registry.snapshot(session)
+    if schema.bottom_most is None:
+        return False  # No hierarchy uploaded yet
+    if schema.has_table("reference_table") and schema.has_table("exp_message"):
+        return False
+
+    created = registry.ensure_tables(session, message_tables(session, schema.bottom_most_name))
+    ensure_indexes(session)
+    ensure_partitions(session)
+    return created
@@ -0,0 +1,305 @@
+# Request-level observability: latency histograms per route, database time per request,
+# a slow-query log with statement fingerprints, optional cProfile dumps, all exported in
+# the Prometheus text format (GET /api/v1/metrics/prometheus). Numbers are per worker.
+#
+#   LOG_LEVEL             root log level (default INFO)
+#   SLOW_QUERY_MS         statements slower than this are logged and counted (default 200)
+#   PROFILING             "true" lets a request ask for a profile with `X-Profile: 1`
+#   PROFILE_SAMPLE_RATE   fraction of requests profiled anyway (default 0)
+#   PROFILE_DIR           where .prof files are written (default /tmp/profiles)
+#
+# DB time: SQLAlchemy before/after_cursor_execute events add each statement's duration to
+# the RequestStats of the current request, found through a context variable (run_db keeps
+# the request's context, in the thread pool and in AsyncSession.run_sync alike).
+#
+# Profiles: cProfile only sees the event loop thread (and run_db on Postgres, which runs
+# there), and it records every coroutine that runs meanwhile, so one profile at a time.
+from contextvars import ContextVar
+from sqlalchemy import event
+from typing import Dict, Optional, Tuple
+import cProfile
+import hashlib
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+PROFILING = os.getenv("PROFILING", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Slow-query fingerprints kept (the slowest ones stay)
+SLOW_QUERY_LIMIT = 200
+
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: dict):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", dict(labels, le=str(bound)), cumulative
+        yield f"{name}_bucket", dict(labels, le="+Inf"), self.count
+        yield f"{name}_sum", labels, round(self.sum, 6)
+        yield f"{name}_count", labels, self.count
+
+
+class RequestStats:
+    def __init__(self, route: str):
+        self.route = route
+        self.db_seconds = 0.0
+        self.queries = 0
+
+
+class SlowQuery:
+    def __init__(self, fingerprint: str, statement: str):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r"%\([^)]+\)s|%s|\$\d+|(?<![:\w]):\w+|\?")
+_CAST = re.compile(r"\?::\w+(?:\[\])?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_REPEATED = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+")
+_SPACES = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> Tuple[str, str]:
+    # Statement with literals, parameters and IN/VALUES lists folded: (id, normalized)
+    normalized = _STRING.sub("?", statement)
+    normalized = _PARAM.sub("?", normalized)
+    normalized = _NUMBER.sub("?", normalized)
+    normalized = _CAST.sub("?", normalized)
+    normalized = _LIST.sub("(...)", normalized)
+    normalized = _REPEATED.sub(r"\1, ...", normalized)
+    normalized = _SPACES.sub(" ", normalized).strip()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()  # Queries are observed from run_db threads
+        self.requests: Dict[tuple, int] = {}  # (method, route, status) -> count
+        self.latency: Dict[tuple, Histogram] = {}  # (method, route)
+        self.db_time: Dict[tuple, Histogram] = {}  # (method, route)
+        self.query_latency = Histogram()
+        self.slow_queries: Dict[str, SlowQuery] = {}
+        self.profiles = 0
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        with self._lock:
+            key = (method, route, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault((method, route), Histogram()).observe(seconds)
+            self.db_time.setdefault((method, route), Histogram()).observe(stats.db_seconds)
+
+    def observe_query(self, statement: str, seconds: float):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.db_seconds += seconds
+            stats.queries += 1
+
+        with self._lock:
+            self.query_latency.observe(seconds)
+        if seconds * 1000 < SLOW_QUERY_MS:
+            return
+
+        query_id, normalized = fingerprint(statement)
+        route = stats.route if stats is not None else "-"
+        logging.warning(f'slow query {query_id} {seconds * 1000:.1f} ms ({route}): {normalized[:500]}')
+        with self._lock:
+            slow = self.slow_queries.get(query_id)
+            if slow is None:
+                if len(self.slow_queries) >= SLOW_QUERY_LIMIT:
+                    fastest = min(self.slow_queries.values(), key=lambda entry: entry.max)
+                    del self.slow_queries[fastest.fingerprint]
+                slow = self.slow_queries[query_id] = SlowQuery(query_id, normalized)
+            slow.count += 1
+            slow.total += seconds
+            slow.max = max(slow.max, seconds)
+
+    def slow_query_report(self) -> list:
+        with self._lock:
+            entries = sorted(self.slow_queries.values(), key=lambda entry: entry.total, reverse=True)
+            return [
+                {
+                    "fingerprint": entry.fingerprint,
+                    "count": entry.count,
+                    "total_ms": round(entry.total * 1000, 1),
+                    "max_ms": round(entry.max * 1000, 1),
+                    "statement": entry.statement,
+                }
+                for entry in entries
+            ]
+
+    def render(self, gauges: Dict[str, Tuple[str, float]] = None,
+               counters: Dict[str, Tuple[str, float]] = None) -> str:
+        # Prometheus text exposition format (version 0.0.4)
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{format_labels(labels)} {value}")
+
+        with self._lock:
+            family("http_requests_total", "counter", "HTTP requests by route and status", (
+                ("http_requests_total", {"method": m, "route": r, "status": s}, count)
+                for (m, r, s), count in sorted(self.requests.items())
+            ))
+            family("http_request_duration_seconds", "histogram", "HTTP request latency", (
+                sample for (m, r), histogram in sorted(self.latency.items())
+                for sample in histogram.samples("http_request_duration_seconds", {"method": m, "route": r})
+            ))
+            family("http_request_db_seconds", "histogram", "Database time per HTTP request", (
+                sample for (m, r), histogram in sorted(self.db_time.items())
+                for sample in histogram.samples("http_request_db_seconds", {"method": m, "route": r})
+            ))
+            family("db_query_duration_seconds", "histogram", "Duration of every SQL statement",
+                   self.query_latency.samples("db_query_duration_seconds", {}))
+            family("db_slow_queries_total", "counter", f"Statements slower than {SLOW_QUERY_MS} ms", (
+                ("db_slow_queries_total", {"fingerprint": slow.fingerprint}, slow.count)
+                for slow in self.slow_queries.values()
+            ))
+            family("db_slow_query_seconds_total", "counter", "Time spent in slow statements", (
+                ("db_slow_query_seconds_total", {"fingerprint": slow.fingerprint}, round(slow.total, 6))
+                for slow in self.slow_queries.values()
+            ))
+            family("profiles_written_total", "counter", "cProfile dumps written",
+                   [("profiles_written_total", {}, self.profiles)])
+
+        for name, (help_text, value) in (counters or {}).items():
+            family(name, "counter", help_text, [(name, {}, value)])
+        for name, (help_text, value) in (gauges or {}).items():
+            family(name, "gauge", help_text, [(name, {}, value)])
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def install_query_events(engine):
+    # Time every statement of the shared engine (the async engine's sync facade included)
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is not None:
+        metrics.observe_query(statement, time.perf_counter() - started)
+
+
+def route_name(scope) -> str:
+    # Path with its parameters folded back ("/api/v1/users/{user_id}"): raw paths would
+    # make one label per id. Routing (or the response cache) sets `path_params` on a match.
+    if "path_params" not in scope:
+        return "unmatched"
+    names = {str(value): f"{{{name}}}" for name, value in scope["path_params"].items()}
+    return "/".join(names.get(segment, segment) for segment in scope["path"].split("/"))
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope["path"])
+        token = _request_stats.set(stats)
+        status = 500
+        profiler, profile_path = self._start_profile(scope)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile_path:
+                    message = dict(message, headers=list(message.get("headers", [])) +
+                                   [(b"x-profile-file", profile_path.encode())])
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stats.reset(token)
+            if profiler is not None:
+                self._finish_profile(profiler, profile_path)
+            route = route_name(scope)
+            metrics.observe_request(scope["method"], route, status, elapsed, stats)
+
+    def _start_profile(self, scope):
+        requested = PROFILING and any(name == b"x-profile" for name, _ in scope["headers"])
+        sampled = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+        if not (requested or sampled) or not _profile_lock.acquire(blocking=False):
+            return None, None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "root"
+        path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{os.getpid()}-{name}.prof")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler, path
+
+    def _finish_profile(self, profiler, path: str):
+        try:
+            profiler.disable()
+            profiler.dump_stats(path)
+            metrics.profiles += 1
+            logging.info(f'profile written to {path}')
+        except Exception:
+            logging.exception('writing the request profile failed')
+        finally:
+            _profile_lock.release()
+
+
+_profile_lock = threading.Lock()
+
+# Shared metrics for the whole process
+metrics = Metrics()
@@ -0,0 +1,35 @@
+# Opaque keyset cursors: the sort key of the last row of a page, JSON + base64.
+#
+# Clients pass `next_cursor` back unchanged to get the following page; the query then
+# continues after that key (WHERE key < :cursor) instead of using OFFSET.
+from fastapi import HTTPException
+from datetime import datetime
+import base64
+import json
+
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    """Decode a cursor into one value per entry of `types` (int, or datetime from ISO text)."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return [_decode_value(value, kind) for value, kind in zip(values, types)]
+
+
+def _decode_value(value, kind):
+    # bool is an int subclass; a forged `true` must not pass as an id
+    if kind is int and isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if kind is datetime and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,146 @@
+# Optional monthly range partitioning of `exp_message` on `sent_time` (Postgres only).
+#
+# With EXP_MESSAGE_PARTITIONS=monthly a new `exp_message` is created as a partitioned
+# table, and one partition per month (exp_message_y2024m05) is created ahead of time by
+# `ensure_partitions`, run at startup, when the table is created and periodically (see main.py).
+# With EXP_MESSAGE_RETENTION_MONTHS > 0, partitions older than that are dropped, which is
+# much cheaper than DELETE-ing old messages.
+#
+# An existing, unpartitioned `exp_message` is left alone (converting it means copying
+# every row); a warning is logged instead.
+from datetime import date, datetime
+from sqlalchemy import text
+from typing import List, Optional
+import logging
+import os
+import threading
+
+# "none" or "monthly"
+PARTITION_MODE = os.getenv("EXP_MESSAGE_PARTITIONS", "none").lower()
+# Months created ahead of the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("EXP_MESSAGE_PARTITIONS_AHEAD", "2"))
+# Months kept (0 keeps everything)
+RETENTION_MONTHS = int(os.getenv("EXP_MESSAGE_RETENTION_MONTHS", "0"))
+# Seconds between two maintenance runs
+PARTITION_CHECK_INTERVAL = float(os.getenv("EXP_MESSAGE_PARTITION_CHECK_INTERVAL", "3600"))
+
+PARENT_TABLE = "exp_message"
+
+# Months whose partition is known to exist in this worker
+_known_months = set()
+_lock = threading.Lock()
+
+
+def partitioning_enabled(bind) -> bool:
+    return PARTITION_MODE == "monthly" and bind.get_bind().dialect.name == "postgresql"
+
+
+def exp_message_table_options(bind) -> dict:
+    # Extra Table() keyword arguments for a new `exp_message`
+    if not partitioning_enabled(bind):
+        return {}
+    return {"postgresql_partition_by": "RANGE (sent_time)"}
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def table_exists(session) -> bool:
+    return session.execute(text("SELECT to_regclass(:name)"), {"name": PARENT_TABLE}).scalar() is not None
+
+
+def is_partitioned(session) -> bool:
+    return session.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name)"),
+        {"name": PARENT_TABLE},
+    ).first() is not None
+
+
+def list_partitions(session) -> List[str]:
+    rows = session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:name) ORDER BY child.relname"
+        ),
+        {"name": PARENT_TABLE},
+    )
+    return [row[0] for row in rows]
+
+
+def ensure_partitions(session, now: Optional[datetime] = None) -> List[str]:
+    # Create the partitions of the current month and the next PARTITION_MONTHS_AHEAD ones.
+    # Cheap when they already exist (in-memory check).
+    if not partitioning_enabled(session):
+        return []
+
+    current = (now or datetime.now()).date().replace(day=1)
+    months = [add_months(current, offset) for offset in range(PARTITION_MONTHS_AHEAD + 1)]
+    with _lock:
+        months = [month for month in months if month not in _known_months]
+    if not months:
+        return []
+
+    if not table_exists(session):
+        return []  # Created (partitioned) with the hierarchy, see utils/message_tables.py
+    if not is_partitioned(session):
+        logging.warning(f'{PARENT_TABLE} is not partitioned, skipping EXP_MESSAGE_PARTITIONS={PARTITION_MODE}')
+        return []
+
+    created = []
+    existing = set(list_partitions(session))
+    for month in months:
+        name = partition_name(month)
+        if name not in existing:
+            session.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT_TABLE}" '
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+            ))
+            created.append(name)
+    session.commit()
+
+    with _lock:
+        _known_months.update(months)
+    if created:
+        logging.info(f'created {PARENT_TABLE} partitions: {created}')
+    return created
+
+
+def drop_expired_partitions(session, now: Optional[datetime] = None) -> List[str]:
+    # Retention: drop whole partitions older than RETENTION_MONTHS
+    if not partitioning_enabled(session) or RETENTION_MONTHS <= 0 or not is_partitioned(session):
+        return []
+
+    cutoff = partition_name(add_months((now or datetime.now()).date().replace(day=1), -RETENTION_MONTHS))
+    # Names sort chronologically (zero-padded months)
+    expired = [name for name in list_partitions(session) if name.startswith(f"{PARENT_TABLE}_y") and name < cutoff]
+    for name in expired:
+        session.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+    session.commit()
+
+    if expired:
+        logging.info(f'dropped expired {PARENT_TABLE} partitions: {expired}')
+    return expired
+
+
+def maintain_partitions(session) -> dict:
+    return {"created": ensure_partitions(session), "dropped": drop_expired_partitions(session)}
+
+
+def partition_report(session) -> dict:
+    if not partitioning_enabled(session):
+        return {"mode": PARTITION_MODE, "enabled": False}
+    partitioned = is_partitioned(session)
+    return {
+        "mode": PARTITION_MODE,
+        "enabled": True,
+        "partitioned": partitioned,
+        "partitions": list_partitions(session) if partitioned else [],
+        "retention_months": RETENTION_MONTHS,
+    }
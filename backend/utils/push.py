@@ -0,0 +1,194 @@
+# Push delivery of new messages to connected users (Server-Sent Events).
+#
+# Every worker keeps a registry of its connected users (user_id -> subscribers). When a
+# send is committed, Postgres NOTIFY (channel PUSH_CHANNEL, payload {"reference_id": n},
+# plus "user_range" for one page of a scheduled send) tells every worker; each one loads
+# the new exp_message rows of *its* connected users only, with one indexed query per
+# chunk of users, and queues them to their streams.
+# LISTEN runs on an asyncpg connection, so it needs the async driver (see DB_ASYNC in
+# utils/database.py). Without it (SQLite, tests, DB_ASYNC=false or asyncpg missing) the
+# notification stays in-process and only reaches this worker's streams.
+#
+# Slow clients: each subscriber has a bounded queue. When it is full the queued messages
+# are dropped and a single "resync" event is sent instead, and the client reloads its
+# inbox. Memory per connection stays bounded whatever the campaign size.
+from datetime import datetime
+from sqlalchemy import select, text
+from sqlalchemy.engine import make_url
+from typing import Optional
+import asyncio
+import json
+import logging
+import os
+
+from utils.database import DATABASE_URL, run_db, use_async_driver
+from utils.schema_registry import registry
+
+PUSH_CHANNEL = os.getenv("PUSH_CHANNEL", "exp_message_sent")
+# Events queued per connection before it is considered too slow
+PUSH_QUEUE_SIZE = int(os.getenv("PUSH_QUEUE_SIZE", "100"))
+# Seconds between keep-alive comments on idle streams
+PUSH_HEARTBEAT = float(os.getenv("PUSH_HEARTBEAT", "15"))
+# Connected users looked up per query
+PUSH_FETCH_CHUNK = 1000
+
+
+class Subscriber:
+    def __init__(self, user_id: int, queue_size: int = PUSH_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def offer(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too slow: forget the backlog, ask the client to reload instead
+            self.dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"event": "resync", "data": {"dropped": self.dropped}})
+
+
+class PushHub:
+    def __init__(self):
+        self._subscribers = {}  # user_id -> set of Subscriber
+        self._loop = None
+        self._listen_task = None
+
+    @property
+    def connections(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        subscriber = Subscriber(user_id)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self._subscribers.get(subscriber.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.user_id]
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        if use_async_driver(DATABASE_URL):
+            self._listen_task = asyncio.create_task(self._listen())
+        elif make_url(DATABASE_URL).get_backend_name() == "postgresql":
+            logging.warning('push: LISTEN needs the asyncpg driver (DB_ASYNC), '
+                            'new messages are only pushed to streams of the worker that sent them')
+
+    async def stop(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            await asyncio.gather(self._listen_task, return_exceptions=True)
+            self._listen_task = None
+
+    def notify_sent(self, session, reference_id: int, user_range: Optional[tuple] = None):
+        # Call after the send is committed (from run_db, any thread). A scheduled send
+        # commits page by page: `user_range` (after_user_id, last_user_id] limits the
+        # lookup to the users of that page.
+        if self._listen_task is not None:
+            payload = {"reference_id": reference_id}
+            if user_range is not None:
+                payload["user_range"] = list(user_range)
+            session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                            {"channel": PUSH_CHANNEL, "payload": json.dumps(payload)})
+            session.commit()
+        elif self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule, reference_id, user_range)
+
+    def _schedule(self, reference_id: int, user_range: Optional[tuple] = None):
+        if self._subscribers:
+            asyncio.ensure_future(self._dispatch(reference_id, user_range))
+
+    async def _dispatch(self, reference_id: int, user_range: Optional[tuple] = None):
+        user_ids = list(self._subscribers)
+        if user_range is not None:
+            user_ids = [user_id for user_id in user_ids if user_range[0] < user_id <= user_range[1]]
+            if not user_ids:
+                return
+        try:
+            rows = await run_db(load_new_messages, reference_id, user_ids)
+        except Exception:
+            logging.exception(f'push: loading messages of reference {reference_id} failed')
+            return
+
+        for row in rows:
+            event = {"event": "message", "data": message_event(row)}
+            for subscriber in list(self._subscribers.get(row.user_id, ())):
+                subscriber.offer(event)
+
+    async def _listen(self):
+        # Dedicated LISTEN connection, reconnected when it drops
+        import asyncpg
+
+        dsn = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                await connection.add_listener(PUSH_CHANNEL, self._on_notify)
+                logging.info(f'push: listening on {PUSH_CHANNEL}')
+                while not connection.is_closed():
+                    await asyncio.sleep(PUSH_HEARTBEAT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'push: LISTEN connection failed: {e}')
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(5)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            notification = json.loads(payload)
+            reference_id = int(notification["reference_id"])
+            user_range = notification.get("user_range")
+            if user_range is not None:
+                user_range = (int(user_range[0]), int(user_range[1]))
+        except (ValueError, KeyError, TypeError, IndexError):
+            logging.warning(f'push: ignoring notification {payload!r}')
+            return
+        self._schedule(reference_id, user_range)
+
+
+def load_new_messages(session, reference_id: int, user_ids: list):
+    # Messages of the reference for the connected users only (index on reference_id, user_id)
+    exp_message_table = registry.snapshot(session).table("exp_message")
+    rows = []
+    for start in range(0, len(user_ids), PUSH_FETCH_CHUNK):
+        rows.extend(session.execute(
+            select(
+                exp_message_table.c.id,
+                exp_message_table.c.user_id,
+                exp_message_table.c.msg_title,
+                exp_message_table.c.read_status,
+                exp_message_table.c.sent_time,
+            )
+            .where(exp_message_table.c.reference_id == reference_id)
+            .where(exp_message_table.c.user_id.in_(user_ids[start:start + PUSH_FETCH_CHUNK]))
+        ))
+    return rows
+
+
+def message_event(row) -> dict:
+    # Same fields as an inbox entry
+    sent_time: Optional[datetime] = row.sent_time
+    return {
+        "exp_message_id": row.id,
+        "message_title": row.msg_title,
+        "read_status": row.read_status,
+        "sent_time": sent_time.strftime("%d/%m/%Y %H:%M:%S") if sent_time else None,
+    }
+
+
+def format_event(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+# Shared hub for the whole process
+push_hub = PushHub()
@@ -0,0 +1,160 @@
+# Buffered read receipts.
+#
+# Opening a message (/users/messages/{id}) only records (message id, read time) in
+# memory. A background task writes the buffer every READ_FLUSH_MS milliseconds, or as
+# soon as READ_BATCH_SIZE receipts are waiting, with a single (on Postgres)
+#   UPDATE exp_message ... FROM (VALUES ...) WHERE read_status != 'read' RETURNING ...
+# and bumps campaign_stats once per reference of the batch, all in one transaction.
+# Cached responses of the affected campaigns and users are invalidated after the commit.
+#
+# Idempotent: a message opened twice keeps its first read time, in the buffer and in
+# the database (already read rows are not matched). The buffer is flushed on shutdown.
+from datetime import datetime
+from sqlalchemy import Integer, DateTime, bindparam, column, select, values
+import asyncio
+import logging
+import os
+import threading
+
+from utils.campaign_stats import record_reads
+from utils.database import run_db
+from utils.http_cache import response_cache
+from utils.schema_registry import registry
+
+READ_FLUSH_MS = int(os.getenv("READ_FLUSH_MS", "200"))
+READ_BATCH_SIZE = int(os.getenv("READ_BATCH_SIZE", "1000"))
+
+
+class ReadReceiptBuffer:
+    def __init__(self, flush_ms: int = READ_FLUSH_MS, batch_size: int = READ_BATCH_SIZE):
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self._pending = {}  # message id -> first read time
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self.flushed = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def add(self, message_id: int, read_time: datetime):
+        # Safe from any thread (run_db handlers)
+        with self._lock:
+            if message_id not in self._pending or read_time < self._pending[message_id]:
+                self._pending[message_id] = read_time
+            full = len(self._pending) >= self.batch_size
+        if full and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()  # Nothing read is lost on a clean shutdown
+
+    async def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+
+        try:
+            await run_db(write_receipts, batch)
+        except Exception:
+            logging.exception(f'read receipts: flushing {len(batch)} receipts failed, retrying later')
+            with self._lock:
+                for message_id, read_time in batch.items():
+                    if message_id not in self._pending or read_time < self._pending[message_id]:
+                        self._pending[message_id] = read_time
+            return 0
+
+        self.flushed += len(batch)
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+def write_receipts(session, batch: dict) -> int:
+    exp_message_table = registry.snapshot(session).table("exp_message")
+    if session.get_bind().dialect.name == "postgresql":
+        changed = _mark_read_from_values(session, exp_message_table, batch)
+    else:
+        changed = _mark_read_executemany(session, exp_message_table, batch)
+
+    per_reference = {}  # reference_id -> [count, first read, last read]
+    user_ids = set()
+    for reference_id, user_id, read_time in changed:
+        user_ids.add(user_id)
+        stats = per_reference.setdefault(reference_id, [0, read_time, read_time])
+        stats[0] += 1
+        stats[1] = min(stats[1], read_time)
+        stats[2] = max(stats[2], read_time)
+
+    for reference_id, (count, first_read, last_read) in per_reference.items():
+        record_reads(session, reference_id, count, first_read, last_read)
+
+    session.commit()
+    if per_reference:
+        response_cache.invalidate(
+            "campaigns",
+            *(f"reference:{reference_id}" for reference_id in per_reference),
+            *(f"user:{user_id}" for user_id in user_ids),
+        )
+    return sum(stats[0] for stats in per_reference.values())
+
+
+def _mark_read_from_values(session, exp_message_table, batch: dict):
+    # One UPDATE ... FROM (VALUES ...) RETURNING for the whole batch
+    receipts = values(
+        column("message_id", Integer), column("read_time", DateTime), name="receipts"
+    ).data(list(batch.items()))
+
+    # Only unread rows change, so a receipt applied twice is a no-op
+    stmt = (
+        exp_message_table.update()
+        .where(exp_message_table.c.id == receipts.c.message_id)
+        .where(exp_message_table.c.read_status != "read")
+        .values(read_status="read", msg_read_time=receipts.c.read_time)
+        .returning(exp_message_table.c.reference_id, exp_message_table.c.user_id, exp_message_table.c.msg_read_time)
+    )
+    return session.execute(stmt).fetchall()
+
+
+def _mark_read_executemany(session, exp_message_table, batch: dict):
+    # Other databases (SQLite): find the unread rows, then one executemany UPDATE
+    unread = session.execute(
+        select(exp_message_table.c.id, exp_message_table.c.reference_id, exp_message_table.c.user_id)
+        .where(exp_message_table.c.id.in_(list(batch)))
+        .where(exp_message_table.c.read_status != "read")
+    ).fetchall()
+    if not unread:
+        return []
+
+    session.execute(
+        exp_message_table.update()
+        .where(exp_message_table.c.id == bindparam("message_id"))
+        .where(exp_message_table.c.read_status != "read")
+        .values(read_status="read", msg_read_time=bindparam("read_time")),
+        [{"message_id": row.id, "read_time": batch[row.id]} for row in unread],
+    )
+    return [(row.reference_id, row.user_id, batch[row.id]) for row in unread]
+
+
+# Shared buffer for the whole process
+read_receipts = ReadReceiptBuffer()
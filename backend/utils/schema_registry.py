@@ -0,0 +1,349 @@
+# Process-wide cache of the reflected database schema.
+#
+# Reflecting the whole database (MetaData.reflect) on every request is slow once there
+# are dozens of tables, so we reflect once and keep the result together with the derived
+# "lvl_*" hierarchy (relationships, top/bottom levels, ordered hierarchy).
+#
+# The cache is only invalidated when the schema actually changes (new tables created
+# through `ensure_tables`). Every change bumps a version counter stored in the
+# `schema_version` table, so other workers can tell that their copy is stale.
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import MetaData, Table, Column, Integer, Index, bindparam, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import NoSuchTableError, SQLAlchemyError
+import logging
+import time
+import os
+
+from utils.db_lock import DbLock
+from utils.table_hierarchy import (
+    relationships_from_metadata,
+    find_top_most_level,
+    find_bottom_most_level,
+    get_ordered_table_hierarchy,
+)
+
+# How often (seconds) a worker checks the shared version counter
+SCHEMA_CHECK_INTERVAL = float(os.getenv("SCHEMA_CHECK_INTERVAL", "5"))
+
+version_metadata = MetaData()
+
+schema_version_table = Table(
+    "schema_version",
+    version_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False, default=0),
+)
+
+
+class SchemaSnapshot:
+    """Immutable view of the reflected schema at a given version."""
+
+    def __init__(self, metadata: MetaData, version: int):
+        self.metadata = metadata
+        self.version = version
+        self.relationships = relationships_from_metadata(metadata)
+
+        if self.relationships:
+            self.top_most = find_top_most_level(self.relationships)
+            self.bottom_most = find_bottom_most_level(self.relationships)
+            self.ordered_hierarchy = get_ordered_table_hierarchy(self.relationships, self.top_most)
+        else:
+            # No hierarchy uploaded yet
+            self.top_most = None
+            self.bottom_most = None
+            self.ordered_hierarchy = []
+
+    @property
+    def bottom_most_name(self):
+        # Bottom-most level without the "lvl_" prefix (e.g. "branch")
+        return self.bottom_most[4:] if self.bottom_most else None
+
+    def has_table(self, table_name: str) -> bool:
+        return table_name in self.metadata.tables
+
+    def table(self, table_name: str) -> Table:
+        table = self.metadata.tables.get(table_name)
+        if table is None:
+            raise NoSuchTableError(table_name)
+        return table
+
+
+@contextmanager
+def _connect(bind, commit=False):
+    # Accept an Engine (own transaction) or a Session/Connection (caller's transaction).
+    # DDL passes commit=True so created tables never depend on the caller's later work.
+    if isinstance(bind, Engine):
+        with bind.begin() as connection:
+            yield connection
+        return
+
+    yield bind.connection() if isinstance(bind, Session) else bind
+    if commit:
+        bind.commit()
+
+
+def _savepoint(connection):
+    # Keep a failed read from aborting the caller's transaction (on Postgres every later
+    # statement would fail with InFailedSqlTransaction). pysqlite's savepoint handling is
+    # unreliable and SQLite doesn't abort transactions on errors, so it reads directly.
+    if connection.dialect.name == "sqlite" or not connection.in_transaction():
+        return nullcontext()
+    return connection.begin_nested()
+
+
+def _index_column(table: Table, column: str):
+    name, _, order = column.partition(" ")
+    return table.c[name].desc() if order.upper() == "DESC" else table.c[name]
+
+
+def _dialect_name(bind) -> str:
+    return (bind.get_bind() if isinstance(bind, Session) else bind).dialect.name
+
+
+# Postgres index DDL that must not hold up writers: CREATE/DROP INDEX CONCURRENTLY. It
+# cannot run in a transaction block and may take long on a big table.
+
+@contextmanager
+def _ddl_connection(bind):
+    # Dedicated autocommit connection without statement_timeout (DB_STATEMENT_TIMEOUT_MS)
+    if isinstance(bind, Engine):
+        engine = bind
+    else:
+        bind.commit()  # A concurrent build waits for every open transaction, the caller's too
+        engine = bind.get_bind() if isinstance(bind, Session) else bind.engine
+
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text("SET statement_timeout = 0"))
+        try:
+            yield connection
+        finally:
+            connection.execute(text("RESET statement_timeout"))
+
+
+def _index_kinds(bind, names) -> dict:
+    # index name -> relkind ("i" index, "I" index of a partitioned table)
+    query = text("SELECT relname, relkind::text FROM pg_class WHERE relkind IN ('i', 'I') AND relname IN :names")
+    with _connect(bind) as connection:
+        return dict(connection.execute(query.bindparams(bindparam("names", expanding=True)), {"names": list(names)}).fetchall())
+
+
+def _invalid_indexes(bind, names) -> dict:
+    # Indexes left invalid by an interrupted concurrent build: name -> relkind
+    query = text(
+        "SELECT c.relname, c.relkind::text FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND c.relname IN :names"
+    )
+    with _connect(bind) as connection:
+        return dict(connection.execute(query.bindparams(bindparam("names", expanding=True)), {"names": list(names)}).fetchall())
+
+
+def _drop_index(connection, name: str, kind: str):
+    # Indexes of partitioned tables can't be dropped concurrently (their partitions' go with them)
+    concurrently = "" if kind == "I" else "CONCURRENTLY "
+    quote = connection.dialect.identifier_preparer.quote
+    connection.execute(text(f"DROP INDEX {concurrently}IF EXISTS {quote(name)}"))
+
+
+def _create_index_concurrently(connection, name: str, table_name: str, columns):
+    quote = connection.dialect.identifier_preparer.quote
+    column_list = ", ".join(
+        quote(column) + (" DESC" if order.upper() == "DESC" else "")
+        for column, _, order in (column.partition(" ") for column in columns)
+    )
+    partitioned = connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name)"), {"name": table_name}
+    ).scalar() is not None
+    if not partitioned:
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(name)} ON {quote(table_name)} ({column_list})"))
+        return
+
+    # A partitioned table can't be indexed concurrently: create the (invalid) parent index
+    # on the table only, build each partition's index concurrently and attach it; the
+    # parent becomes valid once every partition is attached, and later partitions get it.
+    # An interrupted run is resumed: built partition indexes are kept and attached.
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {quote(name)} ON ONLY {quote(table_name)} ({column_list})"))
+    partitions = connection.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:name) ORDER BY 1"),
+        {"name": table_name},
+    ).scalars().all()
+    for partition in partitions:
+        child = f"{partition}_{name}"[:63]
+        invalid = _invalid_indexes(connection, [child])
+        if child in invalid:
+            _drop_index(connection, child, invalid[child])
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(child)} ON {quote(partition)} ({column_list})"))
+        connection.execute(text(f"ALTER INDEX {quote(name)} ATTACH PARTITION {quote(child)}"))
+
+
+class SchemaRegistry:
+    def __init__(self, check_interval: float = SCHEMA_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = DbLock()  # Held across reflection and DDL, see utils/db_lock.py
+        self._snapshot = None
+        self._checked_at = 0.0
+
+    @property
+    def version(self) -> int:
+        # Version of the locally cached copy (0 when nothing is loaded yet)
+        return self._snapshot.version if self._snapshot else 0
+
+    def setup(self, bind) -> SchemaSnapshot:
+        # Startup: make sure the version table exists, then reflect
+        with _connect(bind, commit=True) as connection:
+            version_metadata.create_all(connection)
+        return self.load(bind)
+
+    def load(self, bind) -> SchemaSnapshot:
+        # Reflect the database (used at startup and whenever our copy is stale)
+        with self._lock, _connect(bind) as connection:
+            metadata = MetaData()
+            metadata.reflect(bind=connection)
+
+            version = 0
+            if schema_version_table.name in metadata.tables:
+                version = self._read_version(connection)
+
+            self._snapshot = SchemaSnapshot(metadata, version)
+            self._checked_at = time.monotonic()
+            logging.info(f'schema registry loaded version {version} ({len(metadata.tables)} tables)')
+            return self._snapshot
+
+    def snapshot(self, bind) -> SchemaSnapshot:
+        with self._lock:
+            if self._snapshot is None or self.is_stale(bind):
+                return self.load(bind)
+            return self._snapshot
+
+    def is_stale(self, bind) -> bool:
+        # Compare our copy with the shared counter, at most once per check interval
+        if self._snapshot is None:
+            return True
+        if not self._snapshot.has_table(schema_version_table.name):
+            return False
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return False
+
+        self._checked_at = time.monotonic()
+        try:
+            with _connect(bind) as connection, _savepoint(connection):
+                return self._read_version(connection) != self._snapshot.version
+        except SQLAlchemyError as e:
+            logging.warning(f'schema version check failed: {e}')
+            return False
+
+    def ensure_tables(self, bind, tables) -> bool:
+        # Create the given tables if they are missing. Returns True if the schema changed.
+        with self._lock:
+            snapshot = self.snapshot(bind)
+            missing = [table for table in tables if not snapshot.has_table(table.name)]
+            if not missing:
+                return False
+
+            with _connect(bind, commit=True) as connection:
+                missing[0].metadata.create_all(connection, tables=missing)
+                self._bump_version(connection)
+
+            logging.info(f'schema changed, created tables: {[table.name for table in missing]}')
+            self.load(bind)
+            return True
+
+    def ensure_indexes(self, bind, indexes, concurrently: bool = False) -> bool:
+        # Create missing indexes, given as (index name, table name, [column, ...]) where a
+        # column may end with " DESC". Tables that don't exist yet are skipped.
+        # With `concurrently` (Postgres), tables stay writable while the indexes build.
+        with self._lock:
+            snapshot = self.snapshot(bind)
+            concurrent = concurrently and _dialect_name(bind) == "postgresql"
+            invalid = _invalid_indexes(bind, [name for name, _, _ in indexes]) if concurrent else {}
+            missing = []
+            for name, table_name, columns in indexes:
+                if not snapshot.has_table(table_name):
+                    continue
+                table = snapshot.table(table_name)
+                if name not in {index.name for index in table.indexes} or name in invalid:
+                    missing.append((name, table, columns))
+            if not missing:
+                return False
+
+            if concurrent:
+                with _ddl_connection(bind) as connection:
+                    for name, table, columns in missing:
+                        if invalid.get(name) == "i":
+                            _drop_index(connection, name, "i")  # Left by an interrupted build
+                        _create_index_concurrently(connection, name, table.name, columns)
+                with _connect(bind, commit=True) as connection:
+                    self._bump_version(connection)
+            else:
+                # Build the indexes on copies, the snapshot's tables stay untouched
+                metadata = MetaData()
+                with _connect(bind, commit=True) as connection:
+                    for name, table, columns in missing:
+                        copy = metadata.tables.get(table.key)  # Several indexes on one table
+                        if copy is None:
+                            copy = table.to_metadata(metadata)
+                        Index(name, *[_index_column(copy, column) for column in columns]).create(connection, checkfirst=True)
+                    self._bump_version(connection)
+
+            logging.info(f'schema changed, created indexes: {[name for name, _, _ in missing]}')
+            self.load(bind)
+            return True
+
+    def drop_indexes(self, bind, indexes, concurrently: bool = False) -> bool:
+        # Drop the given (index name, table name) indexes where they exist
+        with self._lock:
+            snapshot = self.snapshot(bind)
+            existing = []
+            for name, table_name in indexes:
+                if snapshot.has_table(table_name):
+                    existing += [index for index in snapshot.table(table_name).indexes if index.name == name]
+            if not existing:
+                return False
+
+            if concurrently and _dialect_name(bind) == "postgresql":
+                kinds = _index_kinds(bind, [index.name for index in existing])
+                with _ddl_connection(bind) as connection:
+                    for index in existing:
+                        _drop_index(connection, index.name, kinds.get(index.name, "i"))
+                with _connect(bind, commit=True) as connection:
+                    self._bump_version(connection)
+            else:
+                with _connect(bind, commit=True) as connection:
+                    for index in existing:
+                        index.drop(connection, checkfirst=True)
+                    self._bump_version(connection)
+
+            logging.info(f'schema changed, dropped indexes: {[index.name for index in existing]}')
+            self.load(bind)
+            return True
+
+    def invalidate(self, bind) -> SchemaSnapshot:
+        # Force a new version after a schema change made outside `ensure_tables`
+        with self._lock:
+            with _connect(bind, commit=True) as connection:
+                self._bump_version(connection)
+            return self.load(bind)
+
+    @staticmethod
+    def _read_version(connection) -> int:
+        version = connection.execute(
+            select(schema_version_table.c.version).where(schema_version_table.c.id == 1)
+        ).scalar()
+        return version or 0
+
+    @staticmethod
+    def _bump_version(connection):
+        version_metadata.create_all(connection)
+        result = connection.execute(
+            update(schema_version_table)
+            .where(schema_version_table.c.id == 1)
+            .values(version=schema_version_table.c.version + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(schema_version_table.insert().values(id=1, version=1))
+
+
+# Shared registry for the whole process
+registry = SchemaRegistry()
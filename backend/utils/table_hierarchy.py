@@ -5,13 +5,18 @@ def find_relationships(engine):
     metadata = MetaData()
     metadata.reflect(engine)
 
+    return relationships_from_metadata(metadata)
+
+
+# Same as find_relationships, but works on already reflected metadata (no database round trip)
+def relationships_from_metadata(metadata):
     relationships = {}
     for table in metadata.tables.values():
         if not table.name.lower().startswith("lvl_"):
             continue
 
         parent_columns = []
-        
+
         for column in table.columns:
             if hasattr(column, "foreign_keys"):
                 for fk in column.foreign_keys:
@@ -39,4 +44,30 @@ def find_bottom_most_level(relationships):
             parent_tables.add(parent_table)
 
     bottom_most_levels = list(all_tables - parent_tables)
-    return bottom_most_levels[0]
\ No newline at end of file
+    return bottom_most_levels[0]
+
+
+# Function to traverse the hierarchy and return an ordered list of tables
+def get_ordered_table_hierarchy(relationships, top_most_level):
+    # Create an ordered list with the topmost level at the start
+    ordered_hierarchy = [top_most_level]
+    current_level = top_most_level
+
+    # Traverse the relationships to build the hierarchy
+    while True:
+        # Get the child tables that have the current level as their parent
+        child_tables = []
+        for table, parent_columns in relationships.items():
+            # Check if the current level is a parent to any other table
+            if current_level in [parent[0] for parent in parent_columns]:
+                child_tables.append(table)
+
+        if not child_tables:
+            # If no child tables found, we've reached the bottommost level
+            break
+
+        # Add the first child table to the hierarchy (assuming a single hierarchy path)
+        ordered_hierarchy.append(child_tables[0])
+        current_level = child_tables[0]
+
+    return ordered_hierarchy
@@ -0,0 +1,152 @@
+# Templates: the table, a read cache of its rows and batched use counts.
+#
+# TemplateStore keeps recently read rows by template_id (LRU). An entry is trusted for
+# TEMPLATE_ROW_TTL seconds; updates and deletes in this worker drop it at once, other
+# workers' changes are seen when it expires.
+#
+# UseCountBuffer: every send built from a template adds one use in memory; a background
+# task writes the totals every TEMPLATE_USE_FLUSH_MS milliseconds with one executemany
+# UPDATE (template_useCount = template_useCount + n), and on shutdown. Cached rows are
+# bumped by what was written, so the counts they show lag by one flush at most.
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, select, bindparam, func
+from typing import Optional
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from utils.database import run_db
+
+TEMPLATE_ROW_CACHE_SIZE = int(os.getenv("TEMPLATE_ROW_CACHE_SIZE", "256"))
+TEMPLATE_ROW_TTL = float(os.getenv("TEMPLATE_ROW_TTL", "30"))
+TEMPLATE_USE_FLUSH_MS = int(os.getenv("TEMPLATE_USE_FLUSH_MS", "1000"))
+
+metadata = MetaData()
+
+# Define the templates table (created at startup, see utils/bootstrap.py)
+templates = Table(
+    "templates",
+    metadata,
+    Column("template_id", Integer, primary_key=True),
+    Column("template_name", String),
+    Column("message_title", String),
+    Column("message_content", String),
+    Column("template_useCount", Integer, default=0),
+    Column("createdAt", DateTime, default=datetime.now),  # Evaluated per insert
+    Column("modifiedAt", DateTime, default=datetime.now),  # Set by updates, not by use counts
+)
+
+
+def template_to_dict(row) -> dict:
+    template = row._asdict()
+    template["template_useCount"] = template["template_useCount"] or 0
+    return template
+
+
+class TemplateStore:
+    def __init__(self, size: int = TEMPLATE_ROW_CACHE_SIZE, ttl: float = TEMPLATE_ROW_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._rows = OrderedDict()  # template_id -> (loaded at, row dict)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, template_id: int) -> Optional[dict]:
+        with self._lock:
+            entry = self._rows.get(template_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._rows.move_to_end(template_id)
+                self.hits += 1
+                return dict(entry[1])
+
+        self.misses += 1
+        row = session.execute(select(templates).where(templates.c.template_id == template_id)).first()
+        if row is None:
+            return None
+        template = template_to_dict(row)
+        with self._lock:
+            self._rows[template_id] = (time.monotonic(), template)
+            self._rows.move_to_end(template_id)
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+        return dict(template)
+
+    def invalidate(self, template_id: int):
+        with self._lock:
+            self._rows.pop(template_id, None)
+
+    def add_uses(self, counts: dict):
+        # Keep cached rows in step with a flush of the use counts
+        with self._lock:
+            for template_id, uses in counts.items():
+                entry = self._rows.get(template_id)
+                if entry is not None:
+                    entry[1]["template_useCount"] += uses
+
+
+class UseCountBuffer:
+    def __init__(self, flush_ms: int = TEMPLATE_USE_FLUSH_MS):
+        self.flush_interval = flush_ms / 1000
+        self._pending = {}  # template_id -> uses not written yet
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def add(self, template_id: int, uses: int = 1):
+        # Safe from any thread (run_db handlers)
+        with self._lock:
+            self._pending[template_id] = self._pending.get(template_id, 0) + uses
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()  # Nothing counted is lost on a clean shutdown
+
+    async def flush(self) -> int:
+        with self._lock:
+            counts, self._pending = self._pending, {}
+        if not counts:
+            return 0
+
+        try:
+            await run_db(write_use_counts, counts)
+        except Exception:
+            logging.exception(f'template use counts: flushing {len(counts)} templates failed, retrying later')
+            for template_id, uses in counts.items():
+                self.add(template_id, uses)
+            return 0
+        return len(counts)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+def write_use_counts(session, counts: dict):
+    # One executemany UPDATE for every template used since the last flush
+    session.execute(
+        templates.update()
+        .where(templates.c.template_id == bindparam("used_template_id"))
+        .values(template_useCount=func.coalesce(templates.c.template_useCount, 0) + bindparam("uses")),
+        [{"used_template_id": template_id, "uses": uses} for template_id, uses in counts.items()],
+    )
+    session.commit()
+    template_store.add_uses(counts)
+
+
+# Shared cache and counters for the whole process
+template_store = TemplateStore()
+template_usage = UseCountBuffer()
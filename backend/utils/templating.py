@@ -0,0 +1,149 @@
+# Message templates with {{variable}} placeholders.
+#
+# A template is parsed once into literal and placeholder segments; rendering a user is
+# then a single join over those segments instead of one regex substitution per variable.
+# Compiled templates are kept in a small LRU cache keyed by template id / content hash.
+#
+# Placeholders accept filters, applied left to right:
+#   {{username | upper}}
+#   {{role | default:"member" | title}}
+#   {{created_at | date:"%d/%m/%Y"}}
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Iterable, List, Optional
+import hashlib
+import os
+import re
+import threading
+
+# Compiled templates kept in memory per worker
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "256"))
+
+FILTER_PATTERN = r'\s*\|\s*[a-z_]+(?:\s*:\s*"[^"]*")?'
+VARIABLE_PATTERN = re.compile(r'\{\{\s*([a-zA-Z_]\w*)((?:' + FILTER_PATTERN + r')*)\s*\}\}')
+FILTER_ITEM = re.compile(r'\|\s*([a-z_]+)(?:\s*:\s*"([^"]*)")?')
+# Braces left in the literal text once placeholders are taken out, e.g. {{user-name}}
+STRAY_PATTERN = re.compile(r'\{\{.*?\}\}|\{\{|\}\}', re.DOTALL)
+
+DEFAULT_DATE_FORMAT = "%d/%m/%Y"
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def _format_date(value, fmt: Optional[str]):
+    if isinstance(value, str):
+        # SQLite hands dates back as ISO strings
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    if isinstance(value, (date, datetime)):
+        return value.strftime(fmt or DEFAULT_DATE_FORMAT)
+    return value
+
+
+# name -> fn(value, argument)
+FILTERS = {
+    "upper": lambda value, arg: str(value).upper(),
+    "lower": lambda value, arg: str(value).lower(),
+    "title": lambda value, arg: str(value).title(),
+    "capitalize": lambda value, arg: str(value).capitalize(),
+    "trim": lambda value, arg: str(value).strip(),
+    "date": _format_date,
+}
+
+
+class Placeholder:
+    def __init__(self, source: str, variable: str, filters: str = ""):
+        self.source = source  # original text, rendered when there is no value
+        self.variable = variable
+        self.default = None
+        self.filters = []
+
+        for name, arg in FILTER_ITEM.findall(filters):
+            if name == "default":
+                self.default = arg
+            elif name in FILTERS:
+                self.filters.append((FILTERS[name], arg or None))
+            else:
+                raise TemplateError(f"Unknown filter '{name}' in {source}")
+
+    def render(self, values) -> str:
+        value = values.get(self.variable)
+        # Only a missing value falls back: 0, False or "" are real values
+        if value is None:
+            if self.default is None:
+                return self.source
+            value = self.default
+        for fn, arg in self.filters:
+            value = fn(value, arg)
+        return str(value)
+
+
+class CompiledTemplate:
+    def __init__(self, content: str):
+        self.segments = []  # str literals and Placeholders, in order
+        position = 0
+        for match in VARIABLE_PATTERN.finditer(content):
+            if match.start() > position:
+                self.segments.append(content[position:match.start()])
+            self.segments.append(Placeholder(match.group(0), match.group(1), match.group(2)))
+            position = match.end()
+        if position < len(content):
+            self.segments.append(content[position:])
+
+        self.variables = list(dict.fromkeys(s.variable for s in self.segments if isinstance(s, Placeholder)))
+
+    def render(self, values) -> str:
+        # `values` is any mapping (e.g. a row's _mapping)
+        return "".join([s if isinstance(s, str) else s.render(values) for s in self.segments])
+
+    def unknown_variables(self, columns: Iterable[str]) -> List[str]:
+        columns = set(columns)
+        return [variable for variable in self.variables if variable not in columns]
+
+    def malformed_placeholders(self) -> List[str]:
+        # Text that looks like a placeholder but didn't parse as one (it would render verbatim)
+        return [m.group(0) for s in self.segments if isinstance(s, str) for m in STRAY_PATTERN.finditer(s)]
+
+
+class TemplateCache:
+    def __init__(self, max_size: int = TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content: str, template_id: Optional[int] = None) -> CompiledTemplate:
+        key = (template_id, hashlib.sha1(content.encode()).hexdigest())
+        with self._lock:
+            compiled = self._items.get(key)
+            if compiled is not None:
+                self._items.move_to_end(key)
+                return compiled
+
+        compiled = CompiledTemplate(content)
+        with self._lock:
+            self._items[key] = compiled
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return compiled
+
+    def discard(self, template_id: int):
+        # Forget every compiled version of a template (updated or deleted)
+        with self._lock:
+            for key in [key for key in self._items if key[0] == template_id]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# Shared cache for the whole process
+template_cache = TemplateCache()
+
+
+def compile_template(content: str, template_id: Optional[int] = None) -> CompiledTemplate:
+    return template_cache.get(content, template_id)
@@ -0,0 +1,72 @@
+# Incremental parsing of chunked upload bodies (CSV or NDJSON).
+#
+# Everything here is an async generator, so only the current chunk and the current
+# batch of rows are ever held in memory, whatever the size of the upload.
+import codecs
+import csv
+import json
+from fastapi import HTTPException
+from typing import AsyncIterator, Dict, List, Optional
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], encoding: str = "utf-8") -> AsyncIterator[str]:
+    # Split a stream of byte chunks into text lines (multi-byte characters may span chunks)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_csv_rows(lines: AsyncIterator[str], header: Optional[List[str]] = None) -> AsyncIterator[Dict[str, str]]:
+    # First line is the header unless one is given. Quoted fields can't contain newlines.
+    async for line in lines:
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        if len(values) != len(header):
+            raise HTTPException(status_code=400, detail=f"CSV row has {len(values)} values, expected {len(header)}")
+        yield dict(zip(header, values))
+
+
+async def iter_ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[Dict[str, str]]:
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid NDJSON line: {str(e)}")
+        if not isinstance(row, dict):
+            raise HTTPException(status_code=400, detail="Each NDJSON line must be an object")
+        yield row
+
+
+def iter_rows(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[Dict[str, str]]:
+    lines = iter_lines(chunks)
+    if fmt == "csv":
+        return iter_csv_rows(lines)
+    if fmt == "ndjson":
+        return iter_ndjson_rows(lines)
+    raise HTTPException(status_code=400, detail="Format must be 'csv' or 'ndjson'")
+
+
+async def batched(rows: AsyncIterator[dict], size: int) -> AsyncIterator[List[dict]]:
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,156 @@
+# Bulk user import.
+#
+# Rows are COPY'd into a temporary staging table, validated with one set-based UPDATE
+# (existing/duplicate username or email, unknown bottom-level id) and every valid row is
+# inserted with a single INSERT ... SELECT. Invalid rows are reported back with a reason
+# instead of aborting the whole batch.
+from sqlalchemy import MetaData, Table, Column, Integer, String, ForeignKey, select, update, case, exists, func, insert, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+import logging
+
+from utils.database import copy_rows
+from utils.schema_registry import registry
+
+STAGING_COLUMNS = ["row_no", "username", "email", "role", "btm_lvl_id"]
+
+
+def ensure_users_table(session):
+    # Create the 'users' table (linked to the bottom-most level) if needed
+    schema = registry.snapshot(session)
+    bottom_most_id = f"{schema.bottom_most_name}_id"
+
+    if not schema.has_table("users"):
+        metadata = MetaData()
+        # The foreign key needs the bottom-most table in the same metadata
+        schema.table(schema.bottom_most).to_metadata(metadata)
+        user_table = Table(
+            'users', metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('username', String(50), unique=True, nullable=False),
+            Column('email', String(100), unique=True, nullable=False),
+            Column('role', String(50), nullable=False),
+            Column(bottom_most_id, Integer, ForeignKey(f'{schema.bottom_most}.id')),  # Ensure correct foreign key
+        )
+        registry.ensure_tables(session, [user_table])
+        schema = registry.snapshot(session)
+
+    return schema.table('users'), bottom_most_id
+
+
+def staging_table():
+    return Table(
+        "users_staging",
+        MetaData(),
+        Column("row_no", Integer, primary_key=True),
+        Column("username", String),
+        Column("email", String),
+        Column("role", String),
+        Column("btm_lvl_id", Integer),
+        Column("reason", String),
+        prefixes=["TEMPORARY"],
+    )
+
+
+def _insert(session, table):
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table)
+    if dialect == "sqlite":
+        return sqlite.insert(table)
+    return insert(table)
+
+
+def _begin_write(session):
+    # SQLite: take the write lock before the checks read `users`. A deferred transaction
+    # reads under a shared lock and upgrades at the INSERT, and two imports doing that at
+    # once fail with "database is locked" instead of waiting (busy timeout) for each other.
+    if session.get_bind().dialect.name != "sqlite":
+        return
+    if not session.connection().connection.dbapi_connection.in_transaction:
+        session.execute(text("BEGIN IMMEDIATE"))
+
+
+def lock_contention(error: SQLAlchemyError) -> bool:
+    # Busy database / lock timeout / deadlock: worth retrying, not a server error
+    orig = getattr(error, "orig", None)
+    code = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    return code in ("40001", "40P01", "55P03") or "database is locked" in str(orig)
+
+
+def import_users(session, rows, rejected=None, atomic=False):
+    """Import `rows` ((row_no, username, email, role, btm_lvl_id) tuples).
+
+    `rejected` holds rows already refused by the caller (e.g. invalid CSV lines).
+    With `atomic`, nothing is inserted when any row is rejected.
+    Returns {"inserted": n, "rejected": [...]} and commits.
+    """
+    rejected = list(rejected or [])
+    users, bottom_most_id = ensure_users_table(session)
+    _begin_write(session)
+    schema = registry.snapshot(session)
+    bottom_table = schema.table(schema.bottom_most)
+    staging = staging_table()
+    connection = session.connection()
+
+    try:
+        staging.drop(connection, checkfirst=True)
+        staging.create(connection)
+        copy_rows(session, staging, STAGING_COLUMNS, rows)
+
+        # Rank rows sharing a username/email: only the first one of the batch may pass
+        name_rank = func.row_number().over(partition_by=staging.c.username, order_by=staging.c.row_no)
+        email_rank = func.row_number().over(partition_by=staging.c.email, order_by=staging.c.row_no)
+        ranked = select(
+            staging.c.row_no, staging.c.username, staging.c.email, staging.c.btm_lvl_id,
+            name_rank.label("name_rank"), email_rank.label("email_rank"),
+        ).subquery()
+
+        reason = case(
+            (exists().where(users.c.username == ranked.c.username), "Username already exists"),
+            (exists().where(users.c.email == ranked.c.email), "Email already exists"),
+            (ranked.c.name_rank > 1, "Duplicate username in batch"),
+            (ranked.c.email_rank > 1, "Duplicate email in batch"),
+            (~exists().where(bottom_table.c.id == ranked.c.btm_lvl_id), f"Unknown {bottom_most_id}"),
+            else_=None,
+        )
+        checked = select(ranked.c.row_no, reason.label("reason")).subquery()
+        session.execute(
+            update(staging)
+            .where(staging.c.row_no == checked.c.row_no)
+            .where(checked.c.reason.is_not(None))
+            .values(reason=checked.c.reason)
+        )
+
+        # One INSERT for every valid row; a concurrent import may still win a conflict
+        valid = select(staging.c.username, staging.c.email, staging.c.role, staging.c.btm_lvl_id).where(staging.c.reason.is_(None))
+        stmt = _insert(session, users).from_select(["username", "email", "role", bottom_most_id], valid)
+        if hasattr(stmt, "on_conflict_do_nothing"):
+            stmt = stmt.on_conflict_do_nothing()
+        inserted = {row.username for row in session.execute(stmt.returning(users.c.username))}
+
+        report = select(staging.c.row_no, staging.c.username, staging.c.email, staging.c.reason)
+        for row in session.execute(report.where(staging.c.reason.is_not(None))):
+            rejected.append({"row": row.row_no, "username": row.username, "email": row.email, "reason": row.reason})
+
+        valid_count = session.execute(select(func.count()).select_from(staging).where(staging.c.reason.is_(None))).scalar()
+        if len(inserted) < valid_count:
+            for row in session.execute(report.where(staging.c.reason.is_(None))):
+                if row.username not in inserted:
+                    rejected.append({"row": row.row_no, "username": row.username, "email": row.email,
+                                     "reason": "Username or email already exists"})
+
+        staging.drop(connection)
+        if atomic and rejected:
+            session.rollback()
+            inserted = set()
+        else:
+            session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+    rejected.sort(key=lambda item: item["row"])
+    logging.info(f'user import: {len(inserted)} inserted, {len(rejected)} rejected')
+    return {"inserted": len(inserted), "rejected": rejected}
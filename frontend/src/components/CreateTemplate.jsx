@@ -4,6 +4,7 @@ import { Input } from 'react-aria-components'
 import { useEffect, useState, useRef } from 'react'
 import Header from './Header'
 import { ArrowBigLeft, CirclePlus, FilePlus2 } from 'lucide-react'
+import axios from 'axios'
 
 const CreateTemplate = () => {
   const navigate = useNavigate()
@@ -11,6 +12,7 @@ const CreateTemplate = () => {
   const [errors, setErrors] = useState({})
   const location = useLocation()
   const textAreaRef = useRef(null)
+  const [savedTemplates, setSavedTemplates] = useState([])
 
   useEffect(() => {
     if (location?.state) {
@@ -18,6 +20,37 @@ const CreateTemplate = () => {
     }
   }, [location?.state, setTemplateData])
 
+  useEffect(() => {
+    // Saved templates, most used first
+    const fetchTemplates = async () => {
+      try {
+        const response = await axios.get('http://localhost:8000/api/v1/templates/', {
+          params: { sort: 'popular', limit: 100 },
+        })
+        setSavedTemplates(response.data.templates)
+      } catch (error) {
+        console.error('Error fetching templates:', error)
+      }
+    }
+
+    fetchTemplates()
+  }, [])
+
+  const handleTemplateSelect = (e) => {
+    // The chosen template's id goes with the send (use count, compiled template cache)
+    const template = savedTemplates.find((t) => String(t.template_id) === e.target.value)
+    if (!template) {
+      setTemplateData({ ...templateData, template_id: undefined })
+      return
+    }
+    setTemplateData({
+      template_id: template.template_id,
+      template_name: template.template_name,
+      message_title: template.message_title,
+      message_content: template.message_content,
+    })
+  }
+
   const validateForm = () => {
     const validationErrors = {}
 
@@ -113,6 +146,20 @@ const CreateTemplate = () => {
           <div className="inputs w-3/4">
             <h2 className="font-semibold uppercase text-secondary mx-1">Enter Template Details</h2>
             <form onSubmit={handleSubmit} className="flex flex-col">
+              <label htmlFor="saved_template">Start From a Saved Template:</label>
+              <select
+                id="saved_template"
+                value={templateData.template_id ?? ''}
+                onChange={handleTemplateSelect}
+                className="select select-bordered font-poppins border-2 border-accent rounded-[8px] p-2">
+                <option value="">New template</option>
+                {savedTemplates.map((template) => (
+                  <option key={template.template_id} value={template.template_id}>
+                    {template.template_name}
+                  </option>
+                ))}
+              </select>
+
               <label htmlFor="temp_name">Enter Template Name: {errors.template_name && <span className="text-red-500 font-medium m-0">({errors.template_name})</span>}</label>
               <Input
                 type="text"
@@ -17,6 +17,7 @@ const Preview = () => {
     // Navigate back to `SelectFilter`, passing the current state
     navigate('/select-filter', {
       state: {
+        template_id: data.template_id,
         template_name: data.template_name,
         message_title: data.message_title,
         message_content: data.message_content,
@@ -54,6 +55,7 @@ const Preview = () => {
         return
       } else {
         const response = await axios.post('http://localhost:8000/api/v1/expMessages/', {
+          template_id: data.template_id, // Saved template chosen in CreateTemplate (omitted when undefined)
           template_name: data.template_name,
           message_title: data.message_title,
           message_content: data.message_content,
@@ -61,8 +63,9 @@ const Preview = () => {
           user_count: userCount,
         })
 
-        if (response.data.exp_message_count) {
-          alert('Message Sent Successfully..')
+        // The send runs in the background, progress at /api/v1/jobs/{job_id}
+        if (response.data.job_id) {
+          alert('Message Queued Successfully..')
           navigate('/admin', {
             state: {
               template_name: '',
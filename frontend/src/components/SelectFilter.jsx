@@ -58,6 +58,7 @@ const SelectFilter = () => {
     // Navigate back to `CreateTemplate` with the current context state, without `selected_branch`
     navigate('/create-template', {
       state: {
+        template_id: passedState?.template_id,
         template_name: passedState?.template_name,
         message_title: passedState?.message_title,
         message_content: passedState?.message_content,
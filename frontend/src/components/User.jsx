@@ -8,22 +8,39 @@ const User = () => {
   const navigate = useNavigate()
 
   const [referenceData, setReferenceData] = useState([])
+  const [unreadCount, setUnreadCount] = useState(0)
+  const [nextCursor, setNextCursor] = useState(null)
 
-  useEffect(() => {
-    const fetchReferenceData = async () => {
-      try {
-        const response = await axios.get(`http://localhost:8000/api/v1/users/${user_data.user_id}`)
-        let data = response.data.reference_data
-        console.log(data)
-        setReferenceData(data)
-      } catch (error) {
-        console.error('Error fetching reference data:', error)
-      }
+  // The inbox is paginated: `cursor` continues after the last message already shown
+  const fetchReferenceData = async (cursor = null) => {
+    try {
+      const response = await axios.get(`http://localhost:8000/api/v1/users/${user_data.user_id}/inbox`, {
+        params: cursor ? { cursor } : {},
+      })
+      const data = response.data
+      setReferenceData((previous) => (cursor ? [...previous, ...data.messages] : data.messages))
+      setUnreadCount(data.unread_count)
+      setNextCursor(data.next_cursor)
+    } catch (error) {
+      console.error('Error fetching reference data:', error)
     }
+  }
 
+  useEffect(() => {
     fetchReferenceData()
   }, [user_data.user_id])
 
+  // New messages are pushed by the server; "resync" means we fell behind, reload the inbox
+  useEffect(() => {
+    const source = new EventSource(`http://localhost:8000/api/v1/push/users/${user_data.user_id}`)
+    source.addEventListener('message', (event) => {
+      setReferenceData((previous) => [JSON.parse(event.data), ...previous])
+      setUnreadCount((count) => count + 1)
+    })
+    source.addEventListener('resync', () => fetchReferenceData())
+    return () => source.close()
+  }, [user_data.user_id])
+
   const handleClick = (message_id) => {
     navigate(`/messages/${message_id}`) // Navigate to the new page with `message_id`
   }
@@ -34,7 +51,7 @@ const User = () => {
 
       {referenceData.length > 0 ? (
         <div className="w-2/3">
-          <h2 className="text-xl font-semibold">Messages:</h2>
+          <h2 className="text-xl font-semibold">Messages ({unreadCount} unread):</h2>
           {referenceData.map((ref) => (
             <div key={ref.exp_message_id} onClick={() => handleClick(ref.exp_message_id)}>
               <div className="flex justify-between bg-primary my-3 px-4 rounded-md cursor-pointer">
@@ -43,6 +60,11 @@ const User = () => {
               </div>
             </div>
           ))}
+          {nextCursor && (
+            <button className="bg-secondary text-white rounded-[8px] text-[16px] px-2 font-poppins hover:cursor-pointer" onClick={() => fetchReferenceData(nextCursor)}>
+              Load more
+            </button>
+          )}
         </div>
       ) : (
         <p>No messages found.</p>